@@ -1,21 +1,26 @@
 # -*- coding: utf-8 -*-
+# 起動を速くするため、Flask・line-bot-sdk・psycopg2 はこのモジュールの読み込み時には import しない。
+# アプリは create_app() で作成し、LINE APIのクライアントは最初の返信時に作成する。
+# 起動方法: flask --app InOut_system_test run（create_app が自動で使われる）
 import os
-import psycopg2
+import atexit
+import hmac
+import threading
 from dotenv import load_dotenv
-from flask import Flask, request, abort
-from linebot.v3 import WebhookHandler
-from linebot.v3.exceptions import InvalidSignatureError
-from linebot.v3.messaging import (
-    ApiClient, Configuration, MessagingApi,
-    ReplyMessageRequest, TextMessage
-)
-from linebot.v3.webhooks import (
-    MessageEvent, TextMessageContent
-)
 import logging
 import traceback
-import re
-from datetime import datetime
+from datetime import date
+from db_pool import ConnectionPool
+from state_store import create_state_store
+from event_dedup import create_event_deduplicator
+from dialog_flow import DialogEngine, Flow, Step
+from validators import validate_date, validate_time
+from schema import conflict_clause, pending_migrations
+import rollup
+from monthly_report import MonthlyCache, load_month
+from metrics import METRICS
+from rate_limit import ConcurrencyLimiter, UserRateLimiter
+from reply_templates import ReplyTemplates
 
 
 # .envファイルを読み込む
@@ -29,24 +34,136 @@ DATABASE_USER = os.getenv('DATABASE_USER')
 DATABASE_PASSWORD = os.getenv('DATABASE_PASSWORD')
 DATABASE_HOST = os.getenv('DATABASE_HOST')
 DATABASE_PORT = os.getenv('DATABASE_PORT')
+# LINE APIの接続先（ベンチマーク等でローカルのスタブに向ける場合のみ指定）
+LINE_API_HOST = os.getenv('LINE_API_HOST')
+# LINE APIへの同時接続数（SDKの既定値はCPU数×5で、並行する返信が詰まるため広げる）
+LINE_CONNECTION_POOL_SIZE = int(os.getenv('LINE_CONNECTION_POOL_SIZE', '100'))
+# LINE APIの接続・読み込みのタイムアウト（秒）
+LINE_CONNECT_TIMEOUT = float(os.getenv('LINE_CONNECT_TIMEOUT', '3'))
+LINE_READ_TIMEOUT = float(os.getenv('LINE_READ_TIMEOUT', '10'))
+# 返信が一時的に失敗した場合の再試行回数と、バックオフの初期値（秒）
+REPLY_RETRIES = int(os.getenv('REPLY_RETRIES', '2'))
+REPLY_BACKOFF = float(os.getenv('REPLY_BACKOFF', '0.2'))
+# この回数続けて失敗したら REPLY_BREAKER_RESET 秒の間はLINE APIを呼ばない
+REPLY_BREAKER_THRESHOLD = int(os.getenv('REPLY_BREAKER_THRESHOLD', '5'))
+REPLY_BREAKER_RESET = float(os.getenv('REPLY_BREAKER_RESET', '30'))
+# 1 の場合、応答トークンが期限切れならプッシュメッセージで送る（送信数の上限に数えられる）
+REPLY_PUSH_FALLBACK = os.getenv('REPLY_PUSH_FALLBACK', '1') == '1'
+# イベントの受信からこの秒数を過ぎたら応答トークンは期限切れとみなす
+REPLY_TOKEN_TTL = float(os.getenv('REPLY_TOKEN_TTL', '50'))
+DATABASE_POOL_MIN = int(os.getenv('DATABASE_POOL_MIN', '1'))
+DATABASE_POOL_MAX = int(os.getenv('DATABASE_POOL_MAX', '10'))
+DATABASE_POOL_TIMEOUT = float(os.getenv('DATABASE_POOL_TIMEOUT', '5'))
+# この秒数より長く使われていないコネクションは、貸し出す前に切れていないかを確かめる
+DATABASE_POOL_VALIDATE_AFTER = float(os.getenv('DATABASE_POOL_VALIDATE_AFTER', '30'))
+STATE_STORE = os.getenv('STATE_STORE', 'memory')
+STATE_TTL_SECONDS = int(os.getenv('STATE_TTL_SECONDS', '3600'))
+STATE_MAX_SESSIONS = int(os.getenv('STATE_MAX_SESSIONS', '10000'))
+# 入力途中の状態が期限切れになった場合に次のメッセージで通知するか
+STATE_EXPIRED_NOTICE = os.getenv('STATE_EXPIRED_NOTICE', '1') == '1'
+# 1 の場合、Webhookには即座に応答し、イベントはバックグラウンドのワーカーで処理する
+ASYNC_DISPATCH = os.getenv('ASYNC_DISPATCH', '0') == '1'
+EVENT_WORKERS = int(os.getenv('EVENT_WORKERS', '4'))
+EVENT_QUEUE_SIZE = int(os.getenv('EVENT_QUEUE_SIZE', '1000'))
+EVENT_DRAIN_TIMEOUT = float(os.getenv('EVENT_DRAIN_TIMEOUT', '30'))
+# 処理済みの webhookEventId を覚えておく方法（memory / postgres / off）と期間
+EVENT_DEDUP = os.getenv('EVENT_DEDUP', 'memory')
+EVENT_DEDUP_TTL_SECONDS = int(os.getenv('EVENT_DEDUP_TTL_SECONDS', '86400'))
+EVENT_DEDUP_MAX_ENTRIES = int(os.getenv('EVENT_DEDUP_MAX_ENTRIES', '100000'))
+# 「確認」で返す今月の登録内容をキャッシュする期間と件数
+MONTHLY_CACHE_TTL_SECONDS = int(os.getenv('MONTHLY_CACHE_TTL_SECONDS', '300'))
+MONTHLY_CACHE_MAX_ENTRIES = int(os.getenv('MONTHLY_CACHE_MAX_ENTRIES', '10000'))
+# ユーザごとに1秒あたり処理するメッセージ数と、続けて送れる件数（0 の場合は制限しない）
+RATE_LIMIT_RATE = float(os.getenv('RATE_LIMIT_RATE', '1'))
+RATE_LIMIT_BURST = int(os.getenv('RATE_LIMIT_BURST', '10'))
+RATE_LIMIT_MAX_USERS = int(os.getenv('RATE_LIMIT_MAX_USERS', '10000'))
+# 制限したメッセージへの対応: reply（制限されてから最初の1件に定型文を返す）または drop（返信しない）
+RATE_LIMIT_ACTION = os.getenv('RATE_LIMIT_ACTION', 'reply')
+# 同時に処理するイベント数の上限と、空きを待つ秒数（0 の場合は制限しない）
+MAX_CONCURRENT_EVENTS = int(os.getenv('MAX_CONCURRENT_EVENTS', '64'))
+CONCURRENCY_WAIT = float(os.getenv('CONCURRENCY_WAIT', '1'))
+# 1回の配信に含まれるテキストメッセージがこの件数以上の場合はまとめて処理する（0 の場合はまとめない）
+BATCH_MIN_EVENTS = int(os.getenv('BATCH_MIN_EVENTS', '2'))
+# まとめて処理した場合に、同時に送る返信の数
+REPLY_CONCURRENCY = int(os.getenv('REPLY_CONCURRENCY', '8'))
+# この秒数以上かかった処理を段階ごとの内訳付きでログに出す（未設定の場合は出さない）
+SLOW_REQUEST_SECONDS = os.getenv('SLOW_REQUEST_SECONDS')
+# /metrics の認証トークン（未設定の場合は認証なし）
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+# 1 の場合、保存処理をまとめて複数行INSERTで書き込む
+WRITE_BEHIND = os.getenv('WRITE_BEHIND', '0') == '1'
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', '100'))
+WRITE_BATCH_DELAY = float(os.getenv('WRITE_BATCH_DELAY', '0.05'))
+WRITE_TIMEOUT = float(os.getenv('WRITE_TIMEOUT', '10'))
+# 1 の場合、保存と同じトランザクションで日別・月別の集計(worked_daily / worked_monthly)を更新する
+ROLLUP = os.getenv('ROLLUP', '1') == '1'
+# 1 の場合、起動時にマイグレーションが全て適用済みかを確かめ、未適用があれば起動しない
+SCHEMA_CHECK = os.getenv('SCHEMA_CHECK', '1') == '1'
+# 勤務時間エクスポート(/export/timesheet)の認証トークン（未設定の場合は無効）
+EXPORT_TOKEN = os.getenv('EXPORT_TOKEN')
+# 返信文の言語（ja / en）。チャットのコマンド（勤怠・休暇・確認）は言語によらず同じ
+REPLY_LOCALE = os.getenv('REPLY_LOCALE', 'ja')
+# 1 の場合、固定の返信文は変換済みのJSONをそのまま送る（0 の場合は line-bot-sdk のモデルを使う）
+REPLY_RAW_JSON = os.getenv('REPLY_RAW_JSON', '1') == '1'
+# 起動時にLINE APIのクライアントをバックグラウンドで作成する（最初の返信が遅くならないようにする）
+# 作成が終わるまで /healthz は503を返す
+WARM_UP = os.getenv('WARM_UP', '1') == '1'
 
-# Flaskアプリのインスタンス化
-app = Flask(__name__)
+if SLOW_REQUEST_SECONDS:
+    METRICS.slow_seconds = float(SLOW_REQUEST_SECONDS)
 
 # ログ設定
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# LINE bot APIの設定
-config = Configuration(
-    access_token=CHANNEL_ACCESS_TOKEN,
-)
-api_client = ApiClient(configuration=config)
-messaging_api = MessagingApi(api_client=api_client)
-handler = WebhookHandler(CHANNEL_SECRET)
+# LINE bot APIの設定（最初の返信時に作成する）
+messaging_api = None
+reply_client = None
+_reply_client_lock = threading.Lock()
+
+
+def reply_options():
+    # 同期版・非同期版の返信クライアントで共通の設定
+    from reply_client import CircuitBreaker
+
+    return {
+        "timeout": (LINE_CONNECT_TIMEOUT, LINE_READ_TIMEOUT),
+        "retries": REPLY_RETRIES,
+        "backoff": REPLY_BACKOFF,
+        "breaker": CircuitBreaker(REPLY_BREAKER_THRESHOLD, REPLY_BREAKER_RESET),
+        "push_fallback": REPLY_PUSH_FALLBACK,
+        "token_ttl": REPLY_TOKEN_TTL,
+        "raw_json": REPLY_RAW_JSON,
+    }
+
+
+def get_reply_client():
+    global messaging_api, reply_client
+    if reply_client is not None:
+        return reply_client
+    with _reply_client_lock:
+        if reply_client is None:
+            from linebot.v3.messaging import ApiClient, Configuration, MessagingApi
+            from reply_client import ReplyClient
+
+            config = Configuration(
+                access_token=CHANNEL_ACCESS_TOKEN,
+            )
+            # 接続はプールに残して使い回す（keep-alive）
+            config.connection_pool_maxsize = LINE_CONNECTION_POOL_SIZE
+            api_client = ApiClient(configuration=config)
+            messaging_api = MessagingApi(api_client=api_client)
+            if LINE_API_HOST:
+                messaging_api.line_base_path = LINE_API_HOST
+            client = ReplyClient(messaging_api, **reply_options())
+            METRICS.register_stats("reply", client.stats)
+            reply_client = client
+    return reply_client
 
 # データベース接続のための関数
 def get_db_connection():
+    import psycopg2
+
     conn = psycopg2.connect(
         dbname=DATABASE_NAME,
         user=DATABASE_USER,
@@ -56,27 +173,229 @@ def get_db_connection():
     )
     return conn
 
-# ユーザごとの勤怠入力状態と休暇入力状態を保持する辞書
-user_states = {}
+def check_schema():
+    """
+    保存（主キーへの ON CONFLICT と集計の更新）はマイグレーション後のテーブルを前提とするため、
+    未適用のマイグレーションがあれば RuntimeError で起動を止める。
+    データベースに接続できない場合は警告のみ出して続ける（接続は最初の利用時に行う）。
+    """
+    try:
+        conn = get_db_connection()
+    except Exception as e:
+        logger.warning(f"Skipping schema check, database is unavailable: {e}")
+        return
+    try:
+        pending = pending_migrations(conn)
+    finally:
+        conn.close()
+    if pending:
+        versions = ", ".join(f"{version} ({description})" for version, description in pending)
+        message = (
+            f"Database schema is out of date, pending migrations: {versions}. "
+            "Run `python schema.py migrate` before starting the server."
+        )
+        logger.error(message)
+        raise RuntimeError(message)
+
+# 以下は init_runtime() で作成する
+db_pool = None
+write_buffer = None
+dispatcher = None
+user_states = None
+event_dedup = None
+handler = None
+monthly_cache = None
+rate_limiter = None
+concurrency_limiter = None
+reply_executor = None
+_runtime_lock = threading.Lock()
+
+
+def init_runtime():
+    """
+    コネクションプール、状態ストア、Webhookハンドラなどを作成する（2回目以降は何もしない）。
+    Flask版は create_app() から、asyncio版は async_app.create_app() から呼ぶ。
+    """
+    global db_pool, write_buffer, dispatcher, user_states, event_dedup, handler, monthly_cache
+    global rate_limiter, concurrency_limiter, reply_executor
+    with _runtime_lock:
+        if handler is not None:
+            return
+        from linebot.v3.webhooks import MessageEvent, TextMessageContent
+        from event_queue import EventDispatcher, QueuedWebhookHandler
+
+        if SCHEMA_CHECK:
+            check_schema()
+
+        # コネクションプール（保存のたびに接続し直さない）
+        db_pool = ConnectionPool(
+            get_db_connection,
+            minconn=DATABASE_POOL_MIN,
+            maxconn=DATABASE_POOL_MAX,
+            timeout=DATABASE_POOL_TIMEOUT,
+            validate_after=DATABASE_POOL_VALIDATE_AFTER
+        )
+        atexit.register(db_pool.closeall)
+
+        # 書き込みバッファ（WRITE_BEHIND=1 の場合のみ）
+        if WRITE_BEHIND:
+            from write_behind import WriteBehindBuffer
+
+            write_buffer = WriteBehindBuffer(
+                db_pool, max_batch=WRITE_BATCH_SIZE, max_delay=WRITE_BATCH_DELAY,
+                after_insert=refresh_rollup if ROLLUP else None
+            )
+            atexit.register(write_buffer.shutdown, WRITE_TIMEOUT)
+
+        # まとめて処理したイベントの返信を並行して送る（BATCH_MIN_EVENTS > 0 の場合のみ）
+        # atexitは登録の逆順に実行されるため、ワーカーのキューを処理し終えてから閉じる
+        # （閉じた後に送る返信は send_replies() が順に送る）
+        if BATCH_MIN_EVENTS > 0:
+            from concurrent.futures import ThreadPoolExecutor
+
+            reply_executor = ThreadPoolExecutor(
+                max_workers=REPLY_CONCURRENCY, thread_name_prefix="reply"
+            )
+            atexit.register(reply_executor.shutdown)
+
+        # イベント処理用のワーカー（ASYNC_DISPATCH=1 の場合のみ）
+        if ASYNC_DISPATCH:
+            dispatcher = EventDispatcher(workers=EVENT_WORKERS, queue_size=EVENT_QUEUE_SIZE)
+            # atexitは登録の逆順に実行されるため、プールを閉じる前にキューを処理し終える
+            atexit.register(dispatcher.shutdown, EVENT_DRAIN_TIMEOUT)
+
+        # ユーザごとの勤怠入力状態と休暇入力状態を保持するストア
+        # 複数ワーカーで動かす場合は STATE_STORE=postgres を指定する
+        user_states = create_state_store(
+            STATE_STORE, pool=db_pool, ttl=STATE_TTL_SECONDS, max_entries=STATE_MAX_SESSIONS
+        )
+
+        # LINEから再送されたイベントの検出（複数ワーカーで動かす場合は EVENT_DEDUP=postgres）
+        event_dedup = create_event_deduplicator(
+            EVENT_DEDUP, pool=db_pool, ttl=EVENT_DEDUP_TTL_SECONDS,
+            max_entries=EVENT_DEDUP_MAX_ENTRIES
+        )
+
+        # 「確認」の返信文のキャッシュ（保存時に該当月を無効にする）
+        monthly_cache = MonthlyCache(
+            ttl=MONTHLY_CACHE_TTL_SECONDS, max_entries=MONTHLY_CACHE_MAX_ENTRIES
+        )
+
+        # 送りすぎるユーザと同時処理数の制限（状態の読み込みより前に判定する）
+        if RATE_LIMIT_RATE > 0:
+            rate_limiter = UserRateLimiter(
+                rate=RATE_LIMIT_RATE, burst=RATE_LIMIT_BURST, max_entries=RATE_LIMIT_MAX_USERS
+            )
+            METRICS.register_stats("rate_limit", rate_limiter.stats)
+        if MAX_CONCURRENT_EVENTS > 0:
+            concurrency_limiter = ConcurrencyLimiter(MAX_CONCURRENT_EVENTS, timeout=CONCURRENCY_WAIT)
+            METRICS.register_stats("concurrency", concurrency_limiter.stats)
+
+        # /metrics に出力する各部品の状態
+        METRICS.register_stats("db_pool", db_pool.stats)
+        METRICS.register_stats("state", user_states.stats)
+        METRICS.register_stats("monthly_cache", monthly_cache.stats)
+        if dispatcher is not None:
+            METRICS.register_stats("dispatcher", dispatcher.stats)
+        if write_buffer is not None:
+            METRICS.register_stats("write_buffer", write_buffer.stats)
+        if event_dedup is not None:
+            METRICS.register_stats("event_dedup", event_dedup.stats)
+
+        webhook_handler = QueuedWebhookHandler(
+            CHANNEL_SECRET, dispatcher=dispatcher, deduplicator=event_dedup,
+            batch_min=max(BATCH_MIN_EVENTS, 2)
+        )
+        webhook_handler.add(MessageEvent, message=TextMessageContent)(handle_message)
+        if BATCH_MIN_EVENTS > 0:
+            webhook_handler.add_batch(MessageEvent, message=TextMessageContent)(handle_message_batch)
+        handler = webhook_handler
+
+# Webhookリクエストの結果ごとの件数と、入力ステップごとの処理結果の件数
+webhook_requests = METRICS.counter(
+    "webhook_requests_total", "Webhook requests by result", ("result",)
+)
+dialog_events = METRICS.counter(
+    "dialog_events_total", "Dialog inputs by flow, step and outcome", ("flow", "step", "outcome")
+)
+# 制限したイベントの件数（reason: user / concurrency、action: reply / drop）
+throttled_events = METRICS.counter(
+    "throttled_events_total", "Events throttled before processing", ("reason", "action")
+)
+
+# 保存するテーブルの列
+ATTENDANCE_COLUMNS = (
+    "name", "work_day", "work_start", "work_end", "break_start", "break_end",
+    "work_summary", "device", "line_id"
+)
+VACATION_COLUMNS = ("vacation_date", "vacation_type", "line_id")
+
+def refresh_rollup(cur, table, columns, rows):
+    # 保存した行の日別・月別の集計を、コミット前に計算し直す
+    if ROLLUP:
+        rollup.refresh(cur, rollup.keys_of(table, columns, rows))
+
+def insert_record(table, columns, values):
+    """
+    1行をINSERTしてコミットする。書き込みバッファが有効な場合は、その行を含むバッチが
+    コミットされるまで待つ。
+    """
+    with METRICS.stage("db_write"):
+        if write_buffer is not None:
+            write_buffer.submit(table, columns, values).result(timeout=WRITE_TIMEOUT)
+            return
+        with db_pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"INSERT INTO {table} ({', '.join(columns)}) "
+                    f"VALUES ({', '.join(['%s'] * len(columns))})"
+                    + conflict_clause(table, columns),
+                    values
+                )
+                refresh_rollup(cur, table, columns, [values])
+            conn.commit()  # コミットすることでデータベースに保存される
+
+def insert_records(rows):
+    """
+    (テーブル, 列, 値) の行をまとめてINSERTし、1つのトランザクションでコミットする。
+    書き込みバッファが有効な場合は、すべての行がコミットされるまで待つ。
+    """
+    with METRICS.stage("db_write"):
+        if write_buffer is not None:
+            futures = [write_buffer.submit(table, columns, values) for table, columns, values in rows]
+            for future in futures:
+                future.result(timeout=WRITE_TIMEOUT)
+            return
+        from psycopg2.extras import execute_values
+
+        grouped = {}
+        for table, columns, values in rows:
+            grouped.setdefault((table, columns), []).append(values)
+        keys = set()
+        with db_pool.connection() as conn:
+            with conn.cursor() as cur:
+                for (table, columns), values in grouped.items():
+                    execute_values(
+                        cur,
+                        f"INSERT INTO {table} ({', '.join(columns)}) VALUES %s"
+                        + conflict_clause(table, columns),
+                        values, page_size=len(values)
+                    )
+                    keys |= rollup.keys_of(table, columns, values)
+                if ROLLUP:
+                    rollup.refresh(cur, keys)
+            conn.commit()
 
 # データベースに保存する処理
 def save_attendance_to_db(state, user_id):
     try:
         # データベースに保存
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO attendance (name, work_day, work_start, work_end, break_start, break_end, work_summary, device, line_id) "
-            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)",
-            (
-                state["name"], state["work_day"], state["work_start"], state["work_end"],
-                state["break_start"], state["break_end"], state["work_summary"],
-                state["device"], user_id
-            )
-        )
-        conn.commit()  # コミットすることでデータベースに保存される
-        cur.close()
-        conn.close()
+        insert_record("attendance", ATTENDANCE_COLUMNS, (
+            state["name"], state["work_day"], state["work_start"], state["work_end"],
+            state["break_start"], state["break_end"], state["work_summary"],
+            state["device"], user_id
+        ))
+        monthly_cache.invalidate(user_id, state["work_day"][:7])
         return True
     except Exception as e:
         # エラー内容をログに記録
@@ -84,217 +403,456 @@ def save_attendance_to_db(state, user_id):
         logger.error(traceback.format_exc())
         return False
 
-import re
-from datetime import datetime
+def save_vacation_to_db(state, user_id):
+    try:
+        insert_record("vacation", VACATION_COLUMNS, (
+            state["vacation_date"], state["vacation_type"], user_id
+        ))
+        monthly_cache.invalidate(user_id, state["vacation_date"][:7])
+        return True
+    except Exception as e:
+        logger.error(f"Failed to save vacation: {e}")
+        logger.error(traceback.format_exc())
+        return False
+
+# 確認で「Y」が入力され、データベースへの保存が必要なことを表す戻り値
+SAVE_ATTENDANCE = "__save_attendance__"
+SAVE_VACATION = "__save_vacation__"
+# 今月の登録内容を返信することを表す戻り値
+SHOW_MONTHLY = "__show_monthly__"
+
+# 返信文（固定の文は変換済みのJSONを使い回す）
+templates = ReplyTemplates(REPLY_LOCALE)
+METRICS.register_stats("reply_templates", templates.stats)
+text = templates.text
+
+REPORT_COMMAND = "確認"
+MONTHLY_FAILED = text("monthly_failed")
+THROTTLED_MESSAGE = text("throttled")
+PROCESS_FAILED = text("process_failed")
+
+
+# 勤怠入力の確認文
+def attendance_summary(record):
+    return templates.render("attendance.confirm", **record)
+
+# 休暇入力の確認文
+def vacation_summary(record):
+    return templates.render("vacation.confirm", **record)
+
+
+# 勤怠入力のステップ定義
+ATTENDANCE_FLOW = Flow(
+    id="attendance",
+    command="勤怠",
+    entry=text("attendance.entry"),
+    steps=[
+        Step("name", text("attendance.name")),
+        Step("work_day", text("attendance.work_day"), text("attendance.work_day.invalid"),
+             validate_date),
+        Step("work_start", text("attendance.work_start"), text("attendance.work_start.invalid"),
+             validate_time),
+        Step("work_end", text("attendance.work_end"), text("attendance.work_end.invalid"),
+             validate_time),
+        Step("break_start", text("attendance.break_start"), text("attendance.break_start.invalid"),
+             validate_time),
+        Step("break_end", text("attendance.break_end"), text("attendance.break_end.invalid"),
+             validate_time),
+        Step("work_summary", text("attendance.work_summary")),
+    ],
+    fixed={"device": "SP"},  # デバイスを "SP" に設定
+    confirm=attendance_summary,
+    yes=['y', 'yes', 'はい'],
+    no=['n', 'no', 'いいえ'],
+    retry=text("attendance.retry"),
+    invalid_answer=text("attendance.invalid_answer"),
+    save_kind=SAVE_ATTENDANCE,
+    saved=text("attendance.saved"),
+    save_failed=text("attendance.save_failed"),
+)
+
+# 休暇入力のステップ定義
+VACATION_FLOW = Flow(
+    id="vacation",
+    command="休暇",
+    entry=text("vacation.entry"),
+    steps=[
+        Step("vacation_date", text("vacation.vacation_date"), text("vacation.vacation_date.invalid"),
+             validate_date),
+        Step("vacation_type", text("vacation.vacation_type")),
+    ],
+    confirm=vacation_summary,
+    yes=['y'],
+    no=None,  # y 以外はすべてやり直し
+    retry=text("vacation.retry"),
+    save_kind=SAVE_VACATION,
+    saved=text("vacation.saved"),
+    save_failed=text("vacation.save_failed"),
+)
+
+dialog = DialogEngine([ATTENDANCE_FLOW, VACATION_FLOW], observer=dialog_events.inc)
+
+# 保存の種類ごとの保存関数
+SAVE_FUNCTIONS = {
+    SAVE_ATTENDANCE: save_attendance_to_db,
+    SAVE_VACATION: save_vacation_to_db,
+}
+# 保存の種類ごとのフロー
+SAVE_FLOWS = {flow.save_kind: flow for flow in (ATTENDANCE_FLOW, VACATION_FLOW)}
+# まとめて保存する場合の保存先（テーブル, 列, 月の判定に使う項目）
+SAVE_TARGETS = {
+    SAVE_ATTENDANCE: ("attendance", ATTENDANCE_COLUMNS, "work_day"),
+    SAVE_VACATION: ("vacation", VACATION_COLUMNS, "vacation_date"),
+}
+
+
+# 入力内容に応じて状態を進め、返信文を返す
+# 保存が必要な場合は SAVE_ATTENDANCE / SAVE_VACATION を、「確認」の場合は SHOW_MONTHLY を返す
+# （同期版・非同期版で共通）
+def route_message(user_id, user_input, state):
+    reply_text = dialog.handle(user_input, state)
+    if reply_text is not None:
+        return reply_text
+    if user_input == REPORT_COMMAND:
+        dialog_events.inc("none", "command", "report")
+        return SHOW_MONTHLY
+    if getattr(state, "expired", False) and STATE_EXPIRED_NOTICE:
+        # 入力途中のまま一定時間が経過した場合
+        dialog_events.inc("none", "none", "expired")
+        return text("expired")
+    # 勤怠または休暇入力モードに入っていない場合、一般的なメッセージに対応
+    dialog_events.inc("none", "none", "help")
+    return text("help")
+
+# 今月の登録内容の返信文（キャッシュになければデータベースから読み込む）
+def monthly_reply(user_id):
+    month = date.today().strftime("%Y-%m")
+
+    def load():
+        with METRICS.stage("db_read"), db_pool.connection() as conn:
+            return load_month(conn, user_id, month, templates)
 
-# バリデーション関数
-def validate_date(input_date):
-    """
-    日付入力を検証し、YYYY-MM-DD形式に変換する。
-    """
     try:
-        # 例: 20240101 -> 2024-01-01
-        if re.match(r"^\d{8}$", input_date):  # 8桁の場合
-            return datetime.strptime(input_date, "%Y%m%d").strftime("%Y-%m-%d")
-        # 例: 2024-01-01 はそのまま
-        elif re.match(r"^\d{4}-\d{2}-\d{2}$", input_date):  # 正しい形式の場合
-            return input_date
-        else:
-            return None  # 無効な形式
-    except ValueError:
-        return None  # 無効な日付
-
-def validate_time(input_time):
+        return monthly_cache.fetch(user_id, month, load)
+    except Exception as e:
+        logger.error(f"Failed to load monthly records: {e}")
+        logger.error(traceback.format_exc())
+        return MONTHLY_FAILED
+
+# 制限したイベントはデータベースを使わずに終える
+def throttle_action(reason, notify):
+    action = "reply" if notify and RATE_LIMIT_ACTION == "reply" else "drop"
+    throttled_events.inc(reason, action)
+    return action
+
+# 送りすぎるユーザのイベントを止める。処理してよい場合は None を返す
+def rate_limited(user_id):
+    if rate_limiter is not None:
+        allowed, notify = rate_limiter.check(user_id)
+        if not allowed:
+            return throttle_action("user", notify)
+    return None
+
+# 送りすぎるユーザのイベントと、同時処理数の上限を超えたイベントを止める。
+# 処理してよい場合は None、止めた場合は throttle_action() の結果を返す
+def admit(user_id):
+    throttled = rate_limited(user_id)
+    if throttled is not None:
+        return throttled
+    if concurrency_limiter is not None and not concurrency_limiter.acquire():
+        return throttle_action("concurrency", True)
+    return None
+
+def finish_save(user_id, kind, record, saved):
     """
-    時間入力を検証し、HH:MM形式に変換する。
+    保存結果をユーザの状態に反映し、返信文を返す（保存は状態のセッションの外で行う）。
+    保存の間に同じユーザの別の入力で状態が変わった場合（確認への二重の回答など）は、
+    状態には触れずに保存結果だけを返す。
     """
-    try:
-        # 1. 1桁または2桁のみ（例: "8" -> "08:00"）
-        if re.match(r"^\d{1,2}$", input_time):
-            hour = int(input_time)
-            return f"{hour:02}:00"
-        # 2. 1桁または2桁の時と1桁の分（例: "8:0" -> "08:00"）
-        elif re.match(r"^\d{1,2}:\d{1}$", input_time):
-            hour, minute = map(int, input_time.split(":"))
-            return f"{hour:02}:{minute:02}"
-        # 3. 1桁または2桁の時と2桁の分（例: "8:30" -> "08:30"）
-        elif re.match(r"^\d{1,2}:\d{2}$", input_time):
-            hour, minute = map(int, input_time.split(":"))
-            return f"{hour:02}:{minute:02}"
-        # 4. 4桁の数字（例: "0800" -> "08:00"）
-        elif re.match(r"^\d{4}$", input_time):
-            return datetime.strptime(input_time, "%H%M").strftime("%H:%M")
-        else:
-            return None  # 無効な形式
-    except ValueError:
-        return None  # 無効な時間
-
-
-# 修正された勤怠入力ステップ関数
-def process_step(user_id, user_input):
-    state = user_states.get(user_id, {"step": 0})
-    step = state.get("step", 0)
-
-    if step == 1:
-        state["name"] = user_input
-        reply_text = "勤務日を入力してください (YYYY-MM-DD) 例えば2024-01-01でも20240101でも認識されます:"
-        state["step"] = 2
-    elif step == 2:
-        work_day = validate_date(user_input)
-        if work_day:
-            state["work_day"] = work_day
-            reply_text = "出勤時間を入力してください (HH:MM) 例えば8:00でも8でも800でも08:00と認識されます:"
-            state["step"] = 3
-        else:
-            reply_text = "無効な勤務日です。もう一度入力してください (YYYY-MM-DD) 例 2024-01-01 or 20240101:"
-    elif step == 3:
-        work_start = validate_time(user_input)
-        if work_start:
-            state["work_start"] = work_start
-            reply_text = "退勤時間を入力してください (HH:MM) 例えば17:00でも17でも1700でも17:00と認識されます :"
-            state["step"] = 4
-        else:
-            reply_text = "無効な出勤時間です。もう一度入力してください (HH:MM) 例 8:00 or 800:"
-    elif step == 4:
-        work_end = validate_time(user_input)
-        if work_end:
-            state["work_end"] = work_end
-            reply_text = "休憩開始時間を入力してください (HH:MM) 例えば12:00でも12でも1200でも12:00と認識されます:"
-            state["step"] = 5
-        else:
-            reply_text = "無効な退勤時間です。もう一度入力してください (HH:MM) 例 17:00 or 1700:"
-    elif step == 5:
-        break_start = validate_time(user_input)
-        if break_start:
-            state["break_start"] = break_start
-            reply_text = "休憩終了時間を入力してください (HH:MM) 例えば13:00でも13でも1300でも13:00と認識されます:"
-            state["step"] = 6
-        else:
-            reply_text = "無効な休憩開始時間です。もう一度入力してください (HH:MM) 例 12:00 or 1200:"
-    elif step == 6:
-        break_end = validate_time(user_input)
-        if break_end:
-            state["break_end"] = break_end
-            reply_text = "業務日報を入力してください 例 アプリ開発:"
-            state["step"] = 7
-        else:
-            reply_text = "無効な休憩終了時間です。もう一度入力してください (HH:MM) 例 13:00 or 1300:"
-    elif step == 7:
-        state["work_summary"] = user_input
-        state["device"] = "SP"  # デバイスを "SP" に設定
-        reply_text = (
-            f"確認してください:\n"
-            f"名前: {state['name']}\n"
-            f"勤務日: {state['work_day']}\n"
-            f"出勤時間: {state['work_start']}\n"
-            f"退勤時間: {state['work_end']}\n"
-            f"休憩開始時間: {state['break_start']}\n"
-            f"休憩終了時間: {state['break_end']}\n"
-            f"業務日報: {state['work_summary']}\n"
-            f"勤怠打刻デバイス: {state['device']}\n"
-            "この内容でよろしいですか? [Y or N] 例えば、yでもYでもはいでもYと認識されます"
-        )
-        state["step"] = 8
-    elif step == 8:
-        if user_input.lower() in ['y', 'yes', 'はい']:
-            if save_attendance_to_db(state, user_id):
-                reply_text = "勤怠情報が保存されました。"
-                state.clear()  # 状態のクリア
-                state["step"] = 0
-            else:
-                reply_text = "勤怠情報の保存に失敗しました。もう一度お試しください。"
-        elif user_input.lower() in ['n', 'no', 'いいえ']:
-            reply_text = "もう一度最初から入力してください。名前を入力してください:"
-            state["step"] = 1
-        else:
-            reply_text = "無効な入力です。「Y」または「N」を入力してください。"
-
-    user_states[user_id] = state
-    return reply_text
+    with METRICS.stage("session"), user_states.session(user_id) as state:
+        if dialog.confirming(state, kind) and dialog.record(state) == record:
+            return dialog.finish(state, saved)
+    flow = SAVE_FLOWS[kind]
+    return flow.saved if saved else flow.save_failed
 
+def route_session(user_id, user_input):
+    """
+    状態の読み込みから書き戻しまでを1つのセッション（ユーザ単位の排他）で行い、
+    返信文と保存する記録（保存しない場合は None）を返す。
+    """
+    with METRICS.stage("session"), user_states.session(user_id) as state:
+        with METRICS.stage("dialog"):
+            reply_text = route_message(user_id, user_input, state)
+        record = dialog.record(state) if reply_text in SAVE_FLOWS else None
+    return reply_text, record
 
-# 休暇入力ステップの処理関数
-def process_vacation_step(user_id, user_input):
-    state = user_states.get(user_id, {"vacation_step": 0})
-    step = state.get("vacation_step", 0)
-
-    if step == 1:
-        state["vacation_date"] = user_input
-        reply_text = "休暇の種類を選択してください (全日休, 午前休, 午後休):"
-        state["vacation_step"] = 2
-    elif step == 2:
-        state["vacation_type"] = user_input
-        reply_text = f"確認してください:\n休暇日: {state['vacation_date']}\n休暇種類: {state['vacation_type']}\nこの内容でよろしいですか? (y/n) 例 y"
-        state["vacation_step"] = 3
-    elif step == 3:
-        if user_input.lower() == 'y':
-            # データベースに保存
-            try:
-                conn = get_db_connection()
-                cur = conn.cursor()
-                cur.execute(
-                    "INSERT INTO vacation (vacation_date, vacation_type, line_id) VALUES (%s, %s, %s)",
-                    (state["vacation_date"], state["vacation_type"], user_id)
-                )
-                conn.commit()
-                cur.close()
-                conn.close()
-                reply_text = "休暇情報が保存されました。"
-                state["vacation_step"] = 0  # 状態をリセット
-            except Exception as e:
-                logger.error(f"Failed to save vacation: {e}")
-                logger.error(traceback.format_exc())
-                reply_text = "休暇情報の保存に失敗しました。もう一度お試しください。"
-        else:
-            reply_text = "もう一度最初から入力してください。休暇日を入力してください (YYYY-MM-DD):"
-            state["vacation_step"] = 1
-
-    user_states[user_id] = state
+def process_message(user_id, user_input):
+    reply_text, record = route_session(user_id, user_input)
+    if record is not None:
+        # 保存はセッションを閉じてから行う（状態のストアと保存で同時に2本の接続を使わない）
+        saved = SAVE_FUNCTIONS[reply_text](record, user_id)
+        reply_text = finish_save(user_id, reply_text, record, saved)
+    if reply_text == SHOW_MONTHLY:
+        # 読み込みの間はユーザの状態をロックしない
+        reply_text = monthly_reply(user_id)
     return reply_text
 
-# メッセージイベントの処理
-@handler.add(MessageEvent, message=TextMessageContent)
+def send_reply(event, user_id, reply_text):
+    with METRICS.stage("reply"):
+        get_reply_client().reply(
+            event.reply_token, user_id, templates.prepare(reply_text), event.timestamp
+        )
+
+# メッセージイベントの処理（init_runtime() でハンドラに登録する）
 def handle_message(event):
     user_id = event.source.user_id
     user_input = event.message.text.strip()
 
-    if user_input == "勤怠":
-        # 勤怠入力モードに入る
-        user_states[user_id] = {"step": 1, "mode": "attendance"}
-        reply_text = "勤怠入力モードに入りました。名前を入力してください:"
-    elif user_input == "休暇":
-        # 休暇入力モードに入る
-        user_states[user_id] = {"vacation_step": 1, "mode": "vacation"}
-        reply_text = "休暇入力モードに入りました。休暇日を入力してください (YYYY-MM-DD):"
-    elif user_id in user_states and user_states[user_id].get("step", 0) > 0:
-        # 勤怠入力ステップの処理を続ける
-        reply_text = process_step(user_id, user_input)
-    elif user_id in user_states and user_states[user_id].get("vacation_step", 0) > 0:
-        # 休暇入力ステップの処理を続ける
-        reply_text = process_vacation_step(user_id, user_input)
-    else:
-        # 勤怠または休暇入力モードに入っていない場合、一般的なメッセージに対応
-        reply_text = "勤怠または休暇情報を入力する場合は、「勤怠」または「休暇」というメッセージを書いてください。"
-
-    # メッセージを返信
-    reply_message = ReplyMessageRequest(
-        reply_token=event.reply_token,
-        messages=[TextMessage(text=reply_text)]
-    )
-    messaging_api.reply_message(reply_message)
+    with METRICS.trace("event"):
+        throttled = admit(user_id)
+        if throttled == "reply":
+            send_reply(event, user_id, THROTTLED_MESSAGE)
+        if throttled is not None:
+            return
+        # データベースとLINE APIを使う間、同時処理数の枠を使う
+        try:
+            send_reply(event, user_id, process_message(user_id, user_input))
+        finally:
+            if concurrency_limiter is not None:
+                concurrency_limiter.release()
+
+# 1回の配信に含まれる複数のメッセージイベントをまとめて処理する（init_runtime() でハンドラに登録する）
+# ユーザごとに受信順で入力を進め、保存する行は全ユーザ分を1つのトランザクションでコミットする。
+# 保存が必要になったユーザはそこで区切り、保存結果を反映してから残りの入力を次の回で処理する
+def handle_message_batch(events):
+    with METRICS.trace("batch"):
+        replies = []
+        pending = {}
+        for event in events:
+            user_id = event.source.user_id
+            throttled = rate_limited(user_id)
+            if throttled == "reply":
+                replies.append((event, user_id, THROTTLED_MESSAGE))
+            elif throttled is None:
+                pending.setdefault(user_id, []).append(event)
 
-# LINEからのリクエストを処理
-@app.route("/callback", methods=['POST'])
-def callback():
-    signature = request.headers['X-Line-Signature']
+        # まとめて1件として同時処理数の枠を使う
+        acquired = False
+        if pending and concurrency_limiter is not None:
+            acquired = concurrency_limiter.acquire()
+            if not acquired:
+                for user_id, user_events in pending.items():
+                    if throttle_action("concurrency", True) == "reply":
+                        replies.append((user_events[0], user_id, THROTTLED_MESSAGE))
+                pending = {}
+        try:
+            monthly = []
+            while pending:
+                saves = []
+                for user_id, user_events in list(pending.items()):
+                    attempted = list(user_events)
+                    replied, asked = len(replies), len(monthly)
+                    try:
+                        save = advance_user(user_id, user_events, replies, monthly)
+                    except Exception as e:
+                        # 他のユーザの処理は続ける。状態の変更は破棄されるため、このユーザの
+                        # 未処理のイベントは返信せずに処理失敗を知らせ、再送された場合は処理し直す
+                        logger.error(f"Failed to process events of {user_id}: {e}")
+                        logger.error(traceback.format_exc())
+                        del replies[replied:], monthly[asked:]
+                        replies.append((attempted[0], user_id, PROCESS_FAILED))
+                        forget_events(attempted)
+                        user_events.clear()
+                        save = None
+                    if save is not None:
+                        saves.append(save)
+                    if not user_events:
+                        del pending[user_id]
+                if saves:
+                    replies.extend(save_batch(saves))
+            # 読み込みは保存の後に行い、ユーザの状態をロックしない
+            for event, user_id in monthly:
+                replies.append((event, user_id, monthly_reply(user_id)))
+            send_replies(replies)
+        finally:
+            if acquired:
+                concurrency_limiter.release()
 
-    # リクエストの検証
+def forget_events(events):
+    # 処理済みの記録を消し、LINEから再送された場合に処理し直せるようにする
+    if event_dedup is None:
+        return
+    for event in events:
+        if event.webhook_event_id is None:
+            continue
+        try:
+            event_dedup.forget(event.webhook_event_id)
+        except Exception as e:
+            logger.error(f"Failed to forget event {event.webhook_event_id}: {e}")
+
+def advance_user(user_id, user_events, replies, monthly):
+    """
+    1ユーザの入力を受信順に処理し、返信文を replies に、「確認」を monthly に加える。
+    保存が必要になった場合はそこで止め、(イベント, ユーザID, 保存の種類, 入力内容) を返す。
+    """
+    with METRICS.stage("session"), user_states.session(user_id) as state:
+        while user_events:
+            event = user_events.pop(0)
+            with METRICS.stage("dialog"):
+                reply_text = route_message(user_id, event.message.text.strip(), state)
+            if reply_text in SAVE_TARGETS:
+                return event, user_id, reply_text, dialog.record(state)
+            if reply_text == SHOW_MONTHLY:
+                monthly.append((event, user_id))
+            else:
+                replies.append((event, user_id, reply_text))
+    return None
+
+def save_batch(saves):
+    """
+    (イベント, ユーザID, 保存の種類, 入力内容) の一覧を1つのトランザクションで保存し、
+    保存結果を各ユーザの状態に反映して (イベント, ユーザID, 返信文) の一覧を返す。
+    """
+    rows = []
+    for _, user_id, kind, record in saves:
+        table, columns, _ = SAVE_TARGETS[kind]
+        rows.append((table, columns, tuple(
+            user_id if column == "line_id" else record[column] for column in columns
+        )))
     try:
-        handler.handle(request.get_data(as_text=True), signature)
-    except InvalidSignatureError:
-        abort(400)
+        insert_records(rows)
+        saved = True
+    except Exception as e:
+        logger.error(f"Failed to save {len(rows)} records: {e}")
+        logger.error(traceback.format_exc())
+        saved = False
+
+    replies = []
+    for event, user_id, kind, record in saves:
+        if saved:
+            month_field = SAVE_TARGETS[kind][2]
+            monthly_cache.invalidate(user_id, record[month_field][:7])
+        # 保存の間に同じユーザの別の配信で状態が変わっていても、他のユーザの返信は続ける
+        replies.append((event, user_id, finish_save(user_id, kind, record, saved)))
+    return replies
+
+def send_replies(replies):
+    # 返信トークンはイベントごとに異なるため、並行して送ってよい
+    if len(replies) <= 1 or reply_executor is None:
+        for event, user_id, reply_text in replies:
+            send_reply(event, user_id, reply_text)
+        return
+    futures = []
+    for index, (event, user_id, reply_text) in enumerate(replies):
+        try:
+            futures.append(reply_executor.submit(send_reply, event, user_id, reply_text))
+        except RuntimeError:
+            # 終了処理中は executor が先に止まる（インタプリタの終了時に atexit より先に閉じられる）ため、
+            # キューに残っていたイベントの返信は順に送る
+            for event, user_id, reply_text in replies[index:]:
+                send_reply(event, user_id, reply_text)
+            break
+    for future in futures:
+        future.result()
+
+def create_app():
+    """
+    Flaskアプリを作成する。flask --app InOut_system_test run や gunicorn 'InOut_system_test:create_app()'
+    から呼ばれる。WARM_UP=1 の場合はLINE APIのクライアントをバックグラウンドで作成し始める。
+    """
+    from flask import Flask, Response, request, abort, stream_with_context
+    from linebot.v3.exceptions import InvalidSignatureError
+    from event_queue import QueueFullError
+    from export_timesheet import export as export_records
+
+    init_runtime()
+    if WARM_UP:
+        threading.Thread(target=get_reply_client, name="reply-client-warm-up", daemon=True).start()
+
+    # Flaskアプリのインスタンス化
+    app = Flask(__name__)
+
+    # LINEからのリクエストを処理
+    @app.route("/callback", methods=['POST'])
+    def callback():
+        signature = request.headers['X-Line-Signature']
+
+        # リクエストの検証
+        with METRICS.trace("callback"):
+            try:
+                handler.handle(request.get_data(as_text=True), signature)
+            except InvalidSignatureError:
+                webhook_requests.inc("bad_signature")
+                abort(400)
+            except QueueFullError:
+                # 処理が追いつかない場合は503を返し、LINEからの再送に任せる
+                webhook_requests.inc("queue_full")
+                logger.warning("Event queue is full, rejecting webhook")
+                abort(503)
+            except Exception:
+                webhook_requests.inc("error")
+                raise
+
+        webhook_requests.inc("ok")
+        return 'OK'
+
+    # 起動確認用（オートスケーラーの readiness probe など）
+    @app.route("/healthz", methods=['GET'])
+    def healthz():
+        if WARM_UP and reply_client is None:
+            return Response('warming up', status=503, mimetype='text/plain')
+        return 'OK'
+
+    # Prometheus形式のメトリクス
+    @app.route("/metrics", methods=['GET'])
+    def metrics():
+        if METRICS_TOKEN:
+            authorization = request.headers.get('Authorization', '')
+            if not hmac.compare_digest(authorization, f"Bearer {METRICS_TOKEN}"):
+                abort(401)
+        return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
+
+    # 勤務時間のエクスポート（給与計算用）
+    # 例: GET /export/timesheet?from=2024-01-01&to=2024-01-31&format=csv&totals=1
+    @app.route("/export/timesheet", methods=['GET'])
+    def export_timesheet():
+        authorization = request.headers.get('Authorization', '')
+        if not EXPORT_TOKEN or not hmac.compare_digest(authorization, f"Bearer {EXPORT_TOKEN}"):
+            abort(401)
+
+        fmt = request.args.get('format', 'csv')
+        if fmt not in ('csv', 'jsonl'):
+            abort(400)
+        date_from = request.args.get('from')
+        date_to = request.args.get('to')
+        if date_from:
+            date_from = validate_date(date_from) or abort(400)
+        if date_to:
+            date_to = validate_date(date_to) or abort(400)
+        totals = request.args.get('totals') == '1'
+        line_id = request.args.get('line_id')
+
+        def generate():
+            # ストリーミングが終わるまでコネクションを借りたままにする
+            with db_pool.connection() as conn:
+                yield from export_records(conn, fmt, totals, line_id, date_from, date_to)
+                conn.commit()
+
+        mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+        return Response(stream_with_context(generate()), mimetype=mimetype)
+
+    return app
+
+_app = None
 
-    return 'OK'
+def __getattr__(name):
+    # 以前の起動方法（InOut_system_test:app）のため、最初に参照されたときに作成する
+    global _app
+    if name == "app":
+        if _app is None:
+            _app = create_app()
+        return _app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 if __name__ == "__main__":
-    app.run(port=8000)
+    create_app().run(port=8000)
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio版のWebhookサーバー。/callback の仕様と入力ステップの処理は
+InOut_system_test.py と共通で、LINEへの返信とデータベースへの保存を非同期で行う。
+
+起動方法:
+    python async_app.py
+"""
+import asyncio
+import hmac
+import logging
+import os
+import time
+import traceback
+from datetime import date
+from datetime import time as dt_time
+
+import asyncpg
+from aiohttp import web
+from linebot.v3 import WebhookParser
+from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.messaging import AsyncApiClient, AsyncMessagingApi, Configuration
+from linebot.v3.webhooks import MessageEvent, TextMessageContent
+
+import InOut_system_test as base
+import monthly_report
+import rollup
+from event_dedup import MemoryEventDeduplicator
+from metrics import METRICS
+from rate_limit import ConcurrencyLimiter
+from reply_client import AsyncReplyClient
+from schema import column_type, conflict_clause
+from state_store import MemoryStateStore
+
+
+logger = logging.getLogger(__name__)
+
+ASYNC_PORT = int(os.getenv('ASYNC_PORT', '8000'))
+
+# 同じユーザのメッセージを順番に処理するためのロック（ユーザIDのハッシュで振り分け）
+LOCK_STRIPES = 256
+_user_locks = [asyncio.Lock() for _ in range(LOCK_STRIPES)]
+
+parser = WebhookParser(base.CHANNEL_SECRET)
+
+
+def _user_lock(user_id):
+    return _user_locks[hash(user_id) % LOCK_STRIPES]
+
+
+class AsyncConcurrencyLimiter(ConcurrencyLimiter):
+    """
+    asyncio 用の ConcurrencyLimiter。acquire() はイベントループを止めずに空きを待つ。
+    """
+
+    def __init__(self, limit=32, timeout=1.0):
+        super().__init__(limit, timeout)
+        self._slots = asyncio.Semaphore(limit)
+
+    async def acquire(self):
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            return self._record(False)
+        return self._record(True)
+
+
+async def _store_call(func, *args):
+    # メモリ上のストアはそのまま呼び、データベースを使うストアはスレッドで実行する
+    if isinstance(base.user_states, MemoryStateStore):
+        return func(*args)
+    return await asyncio.to_thread(func, *args)
+
+
+# asyncpg は DATE / TIME 列に文字列を渡せないため、列の型に合わせて変換する
+_CONVERTERS = {"DATE": date.fromisoformat, "TIME": dt_time.fromisoformat}
+
+
+async def insert_record(db, table, columns, values):
+    placeholders = ", ".join(f"${i}" for i in range(1, len(columns) + 1))
+    args = []
+    for column, value in zip(columns, values):
+        convert = _CONVERTERS.get(column_type(table, column))
+        args.append(convert(value) if convert and isinstance(value, str) else value)
+    sql = (
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})"
+        + conflict_clause(table, columns)
+    )
+    with METRICS.stage("db_write"):
+        if not base.ROLLUP:
+            await db.execute(sql, *args)
+            return
+        # 日別・月別の集計も同じトランザクションで更新する
+        async with db.acquire() as conn, conn.transaction():
+            await conn.execute(sql, *args)
+            for statement, params in rollup.refresh_statements(rollup.keys_of(table, columns, [args])):
+                await conn.execute(_numbered(statement), *params)
+
+
+async def save_attendance_to_db(db, state, user_id):
+    try:
+        await insert_record(db, "attendance", base.ATTENDANCE_COLUMNS, (
+            state["name"], state["work_day"], state["work_start"], state["work_end"],
+            state["break_start"], state["break_end"], state["work_summary"],
+            state["device"], user_id
+        ))
+        base.monthly_cache.invalidate(user_id, state["work_day"][:7])
+        return True
+    except Exception as e:
+        logger.error(f"Failed to save attendance: {e}")
+        logger.error(traceback.format_exc())
+        return False
+
+
+async def save_vacation_to_db(db, state, user_id):
+    try:
+        await insert_record(db, "vacation", base.VACATION_COLUMNS, (
+            state["vacation_date"], state["vacation_type"], user_id
+        ))
+        base.monthly_cache.invalidate(user_id, state["vacation_date"][:7])
+        return True
+    except Exception as e:
+        logger.error(f"Failed to save vacation: {e}")
+        logger.error(traceback.format_exc())
+        return False
+
+
+# 保存の種類ごとの保存関数
+SAVE_FUNCTIONS = {
+    base.SAVE_ATTENDANCE: save_attendance_to_db,
+    base.SAVE_VACATION: save_vacation_to_db,
+}
+
+
+def _numbered(sql):
+    # %s を asyncpg の $1, $2, ... に置き換える
+    parts = sql.split("%s")
+    return "".join(f"{part}${i}" for i, part in enumerate(parts[:-1], 1)) + parts[-1]
+
+
+ATTENDANCE_SQL = _numbered(monthly_report.ATTENDANCE_SQL)
+VACATION_SQL = _numbered(monthly_report.VACATION_SQL)
+
+
+async def monthly_reply(db, user_id):
+    month = date.today().strftime("%Y-%m")
+    cache = base.monthly_cache
+    text = cache.get(user_id, month)
+    if text is not None:
+        return text
+    try:
+        generation = cache.generation()
+        started = time.monotonic()
+        first, following = monthly_report.month_range(month)
+        with METRICS.stage("db_read"):
+            attendance = await db.fetch(ATTENDANCE_SQL, user_id, first, following)
+            vacation = await db.fetch(VACATION_SQL, user_id, first, following)
+        text = monthly_report.format_month(month, attendance, vacation, base.templates)
+        cache.record_load(time.monotonic() - started)
+    except Exception as e:
+        logger.error(f"Failed to load monthly records: {e}")
+        logger.error(traceback.format_exc())
+        return base.MONTHLY_FAILED
+    cache.put(user_id, month, text, generation)
+    return text
+
+
+async def send_reply(app, event, user_id, reply_text):
+    with METRICS.stage("reply"):
+        await app["reply_client"].reply(
+            event.reply_token, user_id, base.templates.prepare(reply_text), event.timestamp
+        )
+
+
+async def process_message(app, user_id, user_input):
+    # プロセス内はロックで順番に処理し、プロセス間の排他はストアのセッションに任せる
+    # （読み込みと書き戻しを別のセッションに分けると、その間に他のワーカーの更新を上書きする）
+    async with _user_lock(user_id):
+        reply_text, record = await _store_call(base.route_session, user_id, user_input)
+        if record is not None:
+            saved = await SAVE_FUNCTIONS[reply_text](app["db"], record, user_id)
+            reply_text = await _store_call(base.finish_save, user_id, reply_text, record, saved)
+    if reply_text == base.SHOW_MONTHLY:
+        reply_text = await monthly_reply(app["db"], user_id)
+    return reply_text
+
+
+async def handle_message(app, event):
+    user_id = event.source.user_id
+    user_input = event.message.text.strip()
+
+    # 送りすぎるユーザのイベントと、同時処理数の上限を超えたイベントは状態を読み込まずに終える
+    throttled = None
+    if base.rate_limiter is not None:
+        allowed, notify = base.rate_limiter.check(user_id)
+        if not allowed:
+            throttled = base.throttle_action("user", notify)
+    limiter = app["concurrency"]
+    if throttled is None and limiter is not None and not await limiter.acquire():
+        throttled = base.throttle_action("concurrency", True)
+    if throttled == "reply":
+        await send_reply(app, event, user_id, base.THROTTLED_MESSAGE)
+    if throttled is not None:
+        return
+
+    try:
+        await send_reply(app, event, user_id, await process_message(app, user_id, user_input))
+    finally:
+        if limiter is not None:
+            limiter.release()
+
+
+async def _is_duplicate(event):
+    # 再送されたイベントはデータベースやLINE APIを使う前に読み飛ばす
+    dedup = base.event_dedup
+    if dedup is None or event.webhook_event_id is None:
+        return False
+    redelivery = bool(event.delivery_context and event.delivery_context.is_redelivery)
+    try:
+        if isinstance(dedup, MemoryEventDeduplicator):
+            duplicate = dedup.seen(event.webhook_event_id, redelivery)
+        else:
+            duplicate = await asyncio.to_thread(dedup.seen, event.webhook_event_id, redelivery)
+    except Exception as e:
+        logger.error(f"Failed to check duplicate event {event.webhook_event_id}: {e}")
+        return False
+    if duplicate:
+        logger.info(f"Skipping duplicate event {event.webhook_event_id}")
+    return duplicate
+
+
+async def callback(request):
+    signature = request.headers.get('X-Line-Signature')
+    if signature is None:
+        raise web.HTTPBadRequest()
+    body = await request.text()
+
+    try:
+        with METRICS.stage("verify"):
+            events = parser.parse(body, signature)
+    except InvalidSignatureError:
+        base.webhook_requests.inc("bad_signature")
+        raise web.HTTPBadRequest()
+
+    for event in events:
+        if isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent):
+            if await _is_duplicate(event):
+                continue
+            try:
+                with METRICS.trace("event"):
+                    await handle_message(request.app, event)
+            except Exception as e:
+                logger.error(f"Failed to handle event: {e}")
+                logger.error(traceback.format_exc())
+
+    base.webhook_requests.inc("ok")
+    return web.Response(text='OK')
+
+
+async def metrics(request):
+    if base.METRICS_TOKEN:
+        authorization = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(authorization, f"Bearer {base.METRICS_TOKEN}"):
+            raise web.HTTPUnauthorized()
+    return web.Response(text=METRICS.render(), content_type='text/plain')
+
+
+async def _startup(app):
+    app["db"] = await asyncpg.create_pool(
+        database=base.DATABASE_NAME,
+        user=base.DATABASE_USER,
+        password=base.DATABASE_PASSWORD,
+        host=base.DATABASE_HOST,
+        port=int(base.DATABASE_PORT) if base.DATABASE_PORT else None,
+        min_size=base.DATABASE_POOL_MIN,
+        max_size=base.DATABASE_POOL_MAX,
+    )
+    config = Configuration(access_token=base.CHANNEL_ACCESS_TOKEN)
+    config.connection_pool_maxsize = base.LINE_CONNECTION_POOL_SIZE
+    api_client = AsyncApiClient(config)
+    messaging_api = AsyncMessagingApi(api_client)
+    if base.LINE_API_HOST:
+        messaging_api.line_base_path = base.LINE_API_HOST
+    app["api_client"] = api_client
+    app["reply_client"] = AsyncReplyClient(messaging_api, **base.reply_options())
+    METRICS.register_stats("async_reply", app["reply_client"].stats)
+
+
+async def _cleanup(app):
+    await app["api_client"].close()
+    await app["db"].close()
+
+
+def create_app():
+    # 状態ストアや重複検出などは同期版と共通のものを使う
+    base.init_runtime()
+    app = web.Application()
+    app["concurrency"] = None
+    if base.MAX_CONCURRENT_EVENTS > 0:
+        app["concurrency"] = AsyncConcurrencyLimiter(
+            base.MAX_CONCURRENT_EVENTS, timeout=base.CONCURRENCY_WAIT
+        )
+        METRICS.register_stats("async_concurrency", app["concurrency"].stats)
+    app.router.add_post("/callback", callback)
+    app.router.add_get("/metrics", metrics)
+    app.on_startup.append(_startup)
+    app.on_cleanup.append(_cleanup)
+    return app
+
+
+if __name__ == "__main__":
+    web.run_app(create_app(), port=ASYNC_PORT)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Flask版(InOut_system_test.py)とasyncio版(async_app.py)のWebhook処理性能を比較する。
+LINE APIはローカルのスタブサーバーで代用し、返信に --line-delay 秒かかるものとする。
+会話は保存の手前までなのでデータベースは不要。
+
+使い方:
+    python benchmarks/bench_async.py --users 200 --line-delay 0.05
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from aiohttp import ClientSession, web
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SECRET = "bench-secret"
+MESSAGES = ["勤怠", "山田", "20240101", "9", "18", "12", "13"]
+
+
+def build_body(user_id, text, seq):
+    event = {
+        "type": "message",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "webhookEventId": f"bench-{user_id}-{seq}",
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": f"token-{user_id}-{seq}",
+        "source": {"type": "user", "userId": user_id},
+        "message": {"id": str(seq), "type": "text", "quoteToken": "q", "text": text},
+    }
+    return json.dumps({"destination": "Ubench", "events": [event]}, ensure_ascii=False)
+
+
+def sign(body, secret=SECRET):
+    digest = hmac.new(secret.encode("utf-8"), body.encode("utf-8"), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("utf-8")
+
+
+async def start_fake_line(port, delay):
+    async def reply(request):
+        await request.read()
+        await asyncio.sleep(delay)
+        return web.json_response({"sentMessages": [{"id": "1", "quoteToken": "q"}]})
+
+    app = web.Application()
+    app.router.add_post("/v2/bot/message/reply", reply)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+def start_server(kind, port, line_port):
+    env = dict(
+        os.environ,
+        CHANNEL_SECRET=SECRET,
+        CHANNEL_ACCESS_TOKEN="bench",
+        LINE_API_HOST=f"http://127.0.0.1:{line_port}",
+        DATABASE_POOL_MIN="0",
+        ASYNC_PORT=str(port),
+    )
+    if kind == "flask":
+        cmd = [sys.executable, "-m", "flask", "--app", "InOut_system_test", "run", "--port", str(port)]
+    else:
+        cmd = [sys.executable, "async_app.py"]
+    return subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def wait_ready(session, url):
+    for _ in range(100):
+        try:
+            async with session.post(url, data="{}", headers={"X-Line-Signature": "x"}):
+                return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"server did not start: {url}")
+
+
+async def drive(url, users):
+    latencies = []
+    errors = 0
+
+    async def conversation(session, n):
+        nonlocal errors
+        user_id = f"Ubench{n:06d}"
+        for seq, text in enumerate(MESSAGES):
+            body = build_body(user_id, text, seq)
+            started = time.perf_counter()
+            async with session.post(url, data=body.encode("utf-8"), headers={
+                "X-Line-Signature": sign(body), "Content-Type": "application/json"
+            }) as resp:
+                await resp.read()
+                if resp.status != 200:
+                    errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    async with ClientSession() as session:
+        await wait_ready(session, url)
+        started = time.perf_counter()
+        await asyncio.gather(*(conversation(session, n) for n in range(users)))
+        elapsed = time.perf_counter() - started
+    return latencies, errors, elapsed
+
+
+def report(kind, latencies, errors, elapsed):
+    latencies.sort()
+    q = statistics.quantiles(latencies, n=100)
+    print(
+        f"{kind:<6} {len(latencies)} req in {elapsed:.2f}s  {len(latencies) / elapsed:,.0f} req/s  "
+        f"p50={q[49] * 1000:.1f}ms p95={q[94] * 1000:.1f}ms p99={q[98] * 1000:.1f}ms errors={errors}"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--line-delay", type=float, default=0.05)
+    parser.add_argument("--port", type=int, default=18000)
+    parser.add_argument("--line-port", type=int, default=18080)
+    parser.add_argument("--only", choices=["flask", "async"])
+    args = parser.parse_args()
+
+    line = await start_fake_line(args.line_port, args.line_delay)
+    try:
+        for kind in ("flask", "async"):
+            if args.only and kind != args.only:
+                continue
+            server = start_server(kind, args.port, args.line_port)
+            try:
+                latencies, errors, elapsed = await drive(
+                    f"http://127.0.0.1:{args.port}/callback", args.users
+                )
+                report(kind, latencies, errors, elapsed)
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        await line.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
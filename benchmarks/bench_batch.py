@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+1回の配信に多数のイベントを含む Webhook を、まとめて処理する場合（BATCH_MIN_EVENTS=2）と
+1件ずつ処理する場合（BATCH_MIN_EVENTS=0）で比較する。
+
+ユーザごとの会話（勤怠・休暇の入力と保存）を受信順を保ったまま交互に並べ、--batch 件ずつの
+配信にして順番に送る。サーバーは同期処理（ASYNC_DISPATCH=0）で起動するため、
+/callback の応答時間がそのまま配信1回分の処理時間になる。
+
+使い方:
+    python benchmarks/bench_batch.py --users 200 --batch 100 --ephemeral-db
+    python benchmarks/bench_batch.py --users 200 --batch 100 --no-db
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import sys
+import time
+
+from aiohttp import ClientSession
+
+from bench_async import ROOT, SECRET, build_body, sign, wait_ready
+from load_test import (
+    EphemeralPostgres, FakeLine, attendance_messages, free_port, migrate, percentile,
+    start_server, vacation_messages, wait_warm
+)
+
+sys.path.insert(0, ROOT)
+
+from dotenv import load_dotenv
+
+
+MODES = (("per-event", "0"), ("batch", "2"))
+
+_DB_WRITES = re.compile(r'^inout_stage_seconds_count\{stage="db_write"\} (\d+)', re.M)
+
+
+def build_deliveries(conversations, batch):
+    # 各ユーザの n 件目を順に並べ（ユーザごとの順序は保つ）、batch 件ずつに分ける
+    events = []
+    longest = max(len(messages) for _, messages in conversations)
+    for seq in range(longest):
+        for user_id, messages in conversations:
+            if seq < len(messages):
+                events.append(json.loads(build_body(user_id, messages[seq], seq))["events"][0])
+    return [
+        json.dumps({"destination": "Ubench", "events": events[i:i + batch]}, ensure_ascii=False)
+        for i in range(0, len(events), batch)
+    ], len(events)
+
+
+async def run_mode(mode, batch_min, args, deliveries, secret, db_env):
+    line = FakeLine(args.line_delay, 0.0, random.Random(args.seed))
+    line_port = free_port()
+    await line.start(line_port)
+    port = free_port()
+    env = {**db_env, "ASYNC_DISPATCH": "0", "BATCH_MIN_EVENTS": batch_min,
+           "RATE_LIMIT_RATE": "0"}
+    server = start_server("flask", port, line_port, secret, env)
+    latencies = []
+    errors = 0
+    try:
+        base_url = f"http://127.0.0.1:{port}"
+        async with ClientSession() as session:
+            await wait_ready(session, f"{base_url}/callback")
+            await wait_warm(session, base_url)
+            started = time.perf_counter()
+            for body in deliveries:
+                sent = time.perf_counter()
+                async with session.post(f"{base_url}/callback", data=body.encode("utf-8"), headers={
+                    "X-Line-Signature": sign(body, secret), "Content-Type": "application/json"
+                }) as resp:
+                    await resp.read()
+                    if resp.status != 200:
+                        errors += 1
+                latencies.append(time.perf_counter() - sent)
+            elapsed = time.perf_counter() - started
+            async with session.get(f"{base_url}/metrics") as resp:
+                match = _DB_WRITES.search(await resp.text())
+    finally:
+        server.terminate()
+        server.wait()
+        await line.stop()
+
+    latencies.sort()
+    return {
+        "mode": mode,
+        "elapsed": elapsed,
+        "p50": percentile(latencies, 0.50) * 1000,
+        "p95": percentile(latencies, 0.95) * 1000,
+        "max": latencies[-1] * 1000 if latencies else 0.0,
+        "errors": errors,
+        "replies": line.replies,
+        "saved": line.saved,
+        "db_writes": int(match.group(1)) if match else 0,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200, help="users (one conversation each)")
+    parser.add_argument("--batch", type=int, default=100, help="events per delivery")
+    parser.add_argument("--vacation-ratio", type=float, default=0.2)
+    parser.add_argument("--line-delay", type=float, default=0.05, help="fake LINE API latency (s)")
+    db = parser.add_mutually_exclusive_group()
+    db.add_argument("--ephemeral-db", action="store_true", help="run a throwaway PostgreSQL")
+    db.add_argument("--no-db", action="store_true", help="stop conversations before saving")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    load_dotenv(os.path.join(ROOT, ".env"))
+    secret = os.getenv("CHANNEL_SECRET") or SECRET
+    rng = random.Random(args.seed)
+
+    postgres = None
+    db_env = {}
+    if args.ephemeral_db:
+        postgres = EphemeralPostgres(free_port())
+        db_env = postgres.start()
+    elif args.no_db:
+        db_env = {"DATABASE_POOL_MIN": "0"}
+    try:
+        if not args.no_db:
+            migrate(db_env)
+        scripts = []
+        for _ in range(args.users):
+            if rng.random() < args.vacation_ratio:
+                scripts.append(vacation_messages(rng, not args.no_db))
+            else:
+                scripts.append(attendance_messages(rng, not args.no_db))
+        results = []
+        for mode, batch_min in MODES:
+            # 同じ内容を保存し直さないよう、実行ごとにユーザIDを変える
+            run = f"{mode[0]}{int(time.time()):x}"
+            conversations = [(f"U{run}{n:06d}", messages) for n, messages in enumerate(scripts)]
+            deliveries, events = build_deliveries(conversations, args.batch)
+            results.append(await run_mode(mode, batch_min, args, deliveries, secret, db_env))
+    finally:
+        if postgres is not None:
+            postgres.stop()
+
+    print(f"{events} events in {len(deliveries)} deliveries of up to {args.batch}, "
+          f"LINE delay {args.line_delay * 1000:.0f}ms")
+    for r in results:
+        print(
+            f"{r['mode']:<10} {r['elapsed']:7.2f}s {events / r['elapsed']:8.0f} events/s  "
+            f"delivery p50={r['p50']:.1f}ms p95={r['p95']:.1f}ms max={r['max']:.1f}ms  "
+            f"replies={r['replies']} saved={r['saved']} db_writes={r['db_writes']} errors={r['errors']}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
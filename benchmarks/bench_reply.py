@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+返信1件あたりの処理時間を、line-bot-sdk のモデル（TextMessage / ReplyMessageRequest）を
+作って送る以前の方法と、reply_templates の変換済みJSONから本文を組み立てる方法で比較する。
+
+- serialize: 送信する本文（bytes）ができるまで
+- client: ReplyClient.reply() 全体（HTTPの送受信は即座に200を返す偽の接続に置き換える）
+
+返信文は入力ステップの固定の文（キャッシュされる）と、確認文（返信のたびに変換する）に分けて測る。
+
+使い方:
+    python benchmarks/bench_reply.py --size 20000
+    python benchmarks/bench_reply.py --locale en
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from linebot.v3.messaging import (
+    ApiClient, Configuration, MessagingApi, ReplyMessageRequest, TextMessage
+)
+
+from reply_client import ReplyClient
+from reply_templates import DYNAMIC_KEYS, PART_KEYS, TEMPLATES, ReplyTemplates
+
+
+RECORD = {
+    "name": "山田太郎", "work_day": "2024-01-15", "work_start": "09:00", "work_end": "18:00",
+    "break_start": "12:00", "break_end": "13:00", "work_summary": "アプリ開発", "device": "SP",
+}
+VACATION = {"vacation_date": "2024-01-16", "vacation_type": "午前休"}
+REPLY_TOKEN = "nHuyWiB7yP5Zw52FIkcQobQuGDXCTA"
+
+
+class _Response:
+    status = 200
+    reason = "OK"
+    data = b'{"sentMessages":[{"id":"1","quoteToken":"q"}]}'
+    headers = {"Content-Type": "application/json"}
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+
+class _PoolManager:
+    # 送信せずに200を返す（ReplyClient と line-bot-sdk の処理だけを測る）
+    def request(self, method, url, **kwargs):
+        return _Response()
+
+
+def build_client(raw_json):
+    api = MessagingApi(ApiClient(Configuration(access_token="bench")))
+    api.api_client.rest_client.pool_manager = _PoolManager()
+    return ReplyClient(api, push_fallback=False, raw_json=raw_json)
+
+
+def corpus(templates, size):
+    static = [
+        templates.text(key) for key in TEMPLATES[templates.locale]
+        if key not in DYNAMIC_KEYS and key not in PART_KEYS
+    ]
+    dynamic = [
+        templates.render("attendance.confirm", **RECORD),
+        templates.render("vacation.confirm", **VACATION),
+    ]
+    return (
+        [static[i % len(static)] for i in range(size)],
+        [dynamic[i % len(dynamic)] for i in range(size)],
+    )
+
+
+def serialize_models(api_client, text):
+    request = ReplyMessageRequest(reply_token=REPLY_TOKEN, messages=[TextMessage(text=text)])
+    return json.dumps(api_client.sanitize_for_serialization(request)).encode("utf-8")
+
+
+def measure(func, texts, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for text in texts:
+            func(text)
+        best = min(best, time.perf_counter() - started)
+    return best / len(texts) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=20000, help="replies per measurement")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--locale", choices=sorted(TEMPLATES), default="ja")
+    args = parser.parse_args()
+
+    templates = ReplyTemplates(args.locale)
+    static, dynamic = corpus(templates, args.size)
+    models_client = build_client(raw_json=False)
+    raw_client = build_client(raw_json=True)
+    api_client = models_client.api.api_client
+
+    # 同じ返信文から同じ内容の本文ができることを確かめる
+    # （line-bot-sdk は既定値の notificationDisabled: false も送る）
+    for text in static[:50] + dynamic[:2]:
+        expected = json.loads(serialize_models(api_client, text))
+        expected.pop("notificationDisabled")
+        assert expected == json.loads(
+            raw_client._request("reply", REPLY_TOKEN, templates.prepare(text))
+        ), text
+
+    cases = (
+        ("serialize", lambda text: serialize_models(api_client, text),
+         lambda text: raw_client._request("reply", REPLY_TOKEN, templates.prepare(text))),
+        ("client", lambda text: models_client.reply(REPLY_TOKEN, "U1", [TextMessage(text=text)]),
+         lambda text: raw_client.reply(REPLY_TOKEN, "U1", templates.prepare(text))),
+    )
+    print(f"locale {args.locale}, {args.size} replies per run, best of {args.repeat}")
+    for name, models, prepared in cases:
+        for kind, texts in (("static", static), ("dynamic", dynamic)):
+            models_us = measure(models, texts, args.repeat)
+            prepared_us = measure(prepared, texts, args.repeat)
+            print(
+                f"{name:<9} {kind:<7}: models {models_us:7.1f} us/reply, "
+                f"prepared {prepared_us:7.1f} us/reply ({models_us / prepared_us:.1f}x)"
+            )
+
+
+if __name__ == "__main__":
+    main()
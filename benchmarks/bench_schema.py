@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+schema.py で作成する型付き・パーティション分割済みの attendance と、索引のない文字列型の
+テーブル（以前の構成）に同じ行数を投入し、ユーザ・月ごとの検索と月ごとの集計の応答時間を比較する。
+
+bench_legacy / bench_managed スキーマを作り直すため、本番のデータベースでは実行しないこと。
+
+使い方（.env の DATABASE_* に接続できるPostgreSQLが必要）:
+    python benchmarks/bench_schema.py --users 2000 --days 1000 --queries 200
+"""
+import argparse
+import io
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from dotenv import load_dotenv
+
+from db_pool import connect_from_env
+from schema import _add_months, ensure_partitions, migrate
+
+
+LEGACY = "bench_legacy"
+MANAGED = "bench_managed"
+
+# 検索する内容（勤怠の確認や月次の出力で使うもの）
+USER_MONTH = (
+    "SELECT work_day, work_start, work_end FROM attendance "
+    "WHERE line_id = %s AND work_day >= %s AND work_day < %s ORDER BY work_day"
+)
+MONTH_TOTAL = (
+    "SELECT line_id, count(*) FROM attendance "
+    "WHERE work_day >= %s AND work_day < %s GROUP BY line_id"
+)
+
+
+def _seed(cur, users, days, cast):
+    # 1ユーザにつき1日1行。cast は work_day の型（legacy では文字列）
+    cur.execute(
+        "INSERT INTO attendance (name, work_day, work_start, work_end, break_start, break_end, "
+        "work_summary, device, line_id) "
+        f"SELECT 'user' || u, {cast}, '09:00', '18:00', '12:00', '13:00', 'bench', 'SP', "
+        "'U' || lpad(u::TEXT, 6, '0') "
+        "FROM generate_series(1, %s) AS u, generate_series(0, %s - 1) AS d",
+        (users, days)
+    )
+    cur.execute("ANALYZE attendance")
+
+
+def setup_legacy(conn, users, days):
+    with conn.cursor() as cur:
+        cur.execute(f"DROP SCHEMA IF EXISTS {LEGACY} CASCADE")
+        cur.execute(f"CREATE SCHEMA {LEGACY}")
+        cur.execute(f"SET search_path TO {LEGACY}")
+        cur.execute(
+            "CREATE TABLE attendance (name TEXT, work_day TEXT, work_start TEXT, work_end TEXT, "
+            "break_start TEXT, break_end TEXT, work_summary TEXT, device TEXT, line_id TEXT)"
+        )
+        _seed(cur, users, days, "to_char(current_date - d, 'YYYY-MM-DD')")
+    conn.commit()
+
+
+def setup_managed(conn, users, days):
+    with conn.cursor() as cur:
+        cur.execute(f"DROP SCHEMA IF EXISTS {MANAGED} CASCADE")
+        cur.execute(f"CREATE SCHEMA {MANAGED}")
+        cur.execute(f"SET search_path TO {MANAGED}")
+    conn.commit()
+    migrate(conn, out=io.StringIO())
+    with conn.cursor() as cur:
+        ensure_partitions(cur, date.fromordinal(date.today().toordinal() - days), date.today())
+        _seed(cur, users, days, "current_date - d")
+    conn.commit()
+
+
+def measure(conn, schema, sql, params_list):
+    latencies = []
+    with conn.cursor() as cur:
+        cur.execute(f"SET search_path TO {schema}")
+        for params in params_list:
+            started = time.perf_counter()
+            cur.execute(sql, params)
+            cur.fetchall()
+            latencies.append((time.perf_counter() - started) * 1000)
+    conn.commit()
+    latencies.sort()
+    return statistics.median(latencies), latencies[int(len(latencies) * 0.95) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--days", type=int, default=1000, help="days of history per user")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep", action="store_true", help="keep the bench schemas")
+    args = parser.parse_args()
+
+    load_dotenv()
+    conn = connect_from_env()
+    rng = random.Random(args.seed)
+    months = [_add_months(date.today(), -i) for i in range(args.days // 31)]
+    user_month = []
+    for _ in range(args.queries):
+        month = rng.choice(months)
+        user_month.append((f"U{rng.randint(1, args.users):06}", month, _add_months(month, 1)))
+    month_total = [(month, _add_months(month, 1)) for month in rng.sample(months, min(12, len(months)))]
+
+    try:
+        rows = args.users * args.days
+        for name, setup in (("legacy", setup_legacy), ("managed", setup_managed)):
+            started = time.perf_counter()
+            setup(conn, args.users, args.days)
+            print(f"{name}: seeded {rows:,} rows in {time.perf_counter() - started:.1f}s")
+
+        for label, sql, params_list in (
+            ("user/month", USER_MONTH, user_month),
+            ("month total", MONTH_TOTAL, month_total),
+        ):
+            # legacy の work_day は文字列なので、同じ条件を文字列で渡す
+            legacy_params = [tuple(str(p) if isinstance(p, date) else p for p in params)
+                             for params in params_list]
+            legacy = measure(conn, LEGACY, sql, legacy_params)
+            managed = measure(conn, MANAGED, sql, params_list)
+            print(
+                f"{label}: legacy p50 {legacy[0]:.2f} ms / p95 {legacy[1]:.2f} ms, "
+                f"managed p50 {managed[0]:.2f} ms / p95 {managed[1]:.2f} ms "
+                f"({legacy[0] / managed[0]:.1f}x)"
+            )
+    finally:
+        if not args.keep:
+            with conn.cursor() as cur:
+                cur.execute(f"DROP SCHEMA IF EXISTS {LEGACY} CASCADE")
+                cur.execute(f"DROP SCHEMA IF EXISTS {MANAGED} CASCADE")
+            conn.commit()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
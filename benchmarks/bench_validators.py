@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+validators.py の validate_date / validate_time と、以前の正規表現 + strptime 版の
+処理時間を比較する。入力はスマートフォンから実際に送られてくる形式を模したもの。
+日付の入力は1,000件程度の日付の繰り返しで validate_date のキャッシュに当たるため、
+キャッシュを使わないパーサ（parse_date）の処理時間も別に示す。
+
+使い方:
+    python benchmarks/bench_validators.py --size 200000
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import validators
+from validators import parse_date, validate_date, validate_time
+
+
+# 以前の実装（比較用にそのまま残す）
+def legacy_validate_date(input_date):
+    try:
+        if re.match(r"^\d{8}$", input_date):
+            return datetime.strptime(input_date, "%Y%m%d").strftime("%Y-%m-%d")
+        elif re.match(r"^\d{4}-\d{2}-\d{2}$", input_date):
+            return input_date
+        else:
+            return None
+    except ValueError:
+        return None
+
+
+def legacy_validate_time(input_time):
+    try:
+        if re.match(r"^\d{1,2}$", input_time):
+            hour = int(input_time)
+            return f"{hour:02}:00"
+        elif re.match(r"^\d{1,2}:\d{1}$", input_time):
+            hour, minute = map(int, input_time.split(":"))
+            return f"{hour:02}:{minute:02}"
+        elif re.match(r"^\d{1,2}:\d{2}$", input_time):
+            hour, minute = map(int, input_time.split(":"))
+            return f"{hour:02}:{minute:02}"
+        elif re.match(r"^\d{4}$", input_time):
+            return datetime.strptime(input_time, "%H%M").strftime("%H:%M")
+        else:
+            return None
+    except ValueError:
+        return None
+
+
+def parse_date_only(input_date):
+    # validate_date からキャッシュを除いたもの
+    parsed = parse_date(input_date)
+    return None if parsed is None else "%04d-%02d-%02d" % parsed
+
+
+FULLWIDTH = str.maketrans("0123456789:-", "０１２３４５６７８９：－")
+
+
+def time_corpus(size, rng):
+    samples = []
+    for _ in range(size):
+        h = rng.randint(0, 23)
+        m = rng.choice((0, 0, 0, 15, 30, 30, 45, rng.randint(0, 59)))
+        form = rng.random()
+        if form < 0.25:
+            text = str(h)
+        elif form < 0.55:
+            text = f"{h}:{m:02}"
+        elif form < 0.65:
+            text = f"{h}:{m}"
+        elif form < 0.85:
+            text = f"{h:02}{m:02}"
+        elif form < 0.92:
+            text = rng.choice(("", "あ", "25", "8:61", "12345", "８時", "9時半"))
+        else:
+            text = f"{h}:{m:02}".translate(FULLWIDTH)
+        samples.append(text)
+    return samples
+
+
+def date_corpus(size, rng):
+    samples = []
+    for _ in range(size):
+        y = rng.choice((2023, 2024, 2025))
+        m = rng.randint(1, 12)
+        d = rng.randint(1, 28)
+        form = rng.random()
+        if form < 0.45:
+            text = f"{y}{m:02}{d:02}"
+        elif form < 0.85:
+            text = f"{y}-{m:02}-{d:02}"
+        elif form < 0.93:
+            text = rng.choice(("", "明日", "2024/01/01", "20241301", "2024-02-30"))
+        else:
+            text = f"{y}-{m:02}-{d:02}".translate(FULLWIDTH)
+        samples.append(text)
+    return samples
+
+
+def measure(func, corpus, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for text in corpus:
+            func(text)
+        best = min(best, time.perf_counter() - started)
+    return best / len(corpus) * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=200000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    dates = date_corpus(args.size, rng)
+    cases = (
+        ("time", time_corpus(args.size, rng), legacy_validate_time, validate_time),
+        ("date", dates, legacy_validate_date, validate_date),
+        ("date (no cache)", dates, legacy_validate_date, parse_date_only),
+    )
+    for name, corpus, legacy, current in cases:
+        validators._DATE_CACHE.clear()
+        legacy_ns = measure(legacy, corpus, args.repeat)
+        current_ns = measure(current, corpus, args.repeat)
+        changed = sum(1 for text in corpus if legacy(text) != current(text))
+        print(
+            f"{name}: legacy {legacy_ns:.0f} ns/call, current {current_ns:.0f} ns/call "
+            f"({legacy_ns / current_ns:.1f}x), results differ on {changed}/{len(corpus)} inputs"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+1行ずつINSERT+コミットする従来の保存処理と、WriteBehindBuffer による
+まとめ書きのスループットを比較する。
+まとめ書きの前に、空のバッファに1行だけ登録した場合も max_delay 程度でコミットされることを確かめる
+（時間がかかりすぎた場合は終了コード 1 で終わる）。
+
+使い方（.env の DATABASE_* に接続できるPostgreSQLが必要）:
+    python benchmarks/bench_write_behind.py --rows 5000 --threads 16
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from dotenv import load_dotenv
+
+from db_pool import ConnectionPool, connect_from_env
+from write_behind import WriteBehindBuffer
+
+
+TABLE = "bench_attendance"
+COLUMNS = (
+    "name", "work_day", "work_start", "work_end", "break_start", "break_end",
+    "work_summary", "device", "line_id"
+)
+
+
+def setup(pool):
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {TABLE}")
+            cur.execute(
+                f"CREATE TABLE {TABLE} (name TEXT, work_day TEXT, work_start TEXT, work_end TEXT, "
+                "break_start TEXT, break_end TEXT, work_summary TEXT, device TEXT, line_id TEXT)"
+            )
+        conn.commit()
+
+
+def row(i):
+    return ("bench", "2024-01-01", "09:00", "18:00", "12:00", "13:00", "bench", "SP", f"U{i % 1000}")
+
+
+def per_row(pool, i):
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"INSERT INTO {TABLE} ({', '.join(COLUMNS)}) VALUES ({', '.join(['%s'] * len(COLUMNS))})",
+                row(i)
+            )
+        conn.commit()
+
+
+def check_idle_latency(buffer, delay):
+    # 件数が溜まらない場合（利用者の少ない時間帯）も待ち時間で書き込まれること
+    limit = max(1.0, delay * 20)
+    started = time.perf_counter()
+    try:
+        buffer.submit(TABLE, COLUMNS, row(0)).result(timeout=limit)
+    except FutureTimeoutError:
+        print(f"idle submit    not committed within {limit:.1f}s")
+        return False
+    elapsed = time.perf_counter() - started
+    print(f"idle submit    1 row in {elapsed * 1000:.1f}ms (max_delay {delay * 1000:.0f}ms)")
+    return True
+
+
+def run(label, func, rows, threads):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(func, range(rows)))
+    elapsed = time.perf_counter() - started
+    print(f"{label:<14} {rows} rows in {elapsed:.2f}s  ({rows / elapsed:,.0f} rows/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--batch", type=int, default=100)
+    parser.add_argument("--delay", type=float, default=0.05)
+    args = parser.parse_args()
+
+    load_dotenv()
+    pool = ConnectionPool(connect_from_env, minconn=1, maxconn=args.threads)
+    setup(pool)
+
+    run("per-row", lambda i: per_row(pool, i), args.rows, args.threads)
+
+    buffer = WriteBehindBuffer(pool, max_batch=args.batch, max_delay=args.delay)
+    idle_ok = check_idle_latency(buffer, args.delay)
+    run("write-behind", lambda i: buffer.submit(TABLE, COLUMNS, row(i)).result(), args.rows, args.threads)
+    buffer.shutdown()
+    print(buffer.stats())
+
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {TABLE}")
+        conn.commit()
+    pool.closeall()
+    if not idle_ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+InOut_system_test の読み込み時間（コールドスタート）を python -X importtime で測り、
+予算を超えた場合や、読み込み時に重いモジュール（Flask・line-bot-sdk・asyncio・psycopg2）を import した場合は
+終了コード 1 で終わる。CIやデプロイ前の確認に使う。
+
+--create-app を付けると create_app() までの時間（Flaskアプリの作成）も測る。
+
+使い方:
+    python benchmarks/check_import_time.py --budget-ms 300
+    python benchmarks/check_import_time.py --budget-ms 300 --create-app-budget-ms 1500 --create-app
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+MODULE = "InOut_system_test"
+
+# 読み込み時に import してはいけないモジュール（最初のリクエストまで遅らせるもの）
+FORBIDDEN = ("flask", "linebot", "aiohttp", "pydantic", "asyncio", "psycopg2")
+
+_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(\S+)")
+
+CREATE_APP = (
+    "import time; started = time.perf_counter(); "
+    f"import {MODULE}; {MODULE}.create_app(); "
+    "print(f'create_app {(time.perf_counter() - started) * 1000:.1f}')"
+)
+
+
+def _env():
+    env = dict(os.environ)
+    # 読み込みには設定値のみ必要（接続はしない）
+    env.setdefault("CHANNEL_SECRET", "import-time-check")
+    env.setdefault("CHANNEL_ACCESS_TOKEN", "import-time-check")
+    return env
+
+
+def measure_import():
+    """
+    1回分の -X importtime の結果を、InOut_system_test から読み込まれたモジュールの
+    {モジュール: (自身のμs, 累積のμs, 深さ)} と、InOut_system_test の累積ミリ秒で返す。
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {MODULE}"],
+        cwd=ROOT, env=_env(), capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        sys.stderr.write(result.stderr)
+        raise SystemExit(f"import {MODULE} failed")
+    rows = []
+    for line in result.stderr.splitlines():
+        match = _LINE.match(line)
+        if match:
+            own, cumulative, indent, name = match.groups()
+            rows.append((name, int(own), int(cumulative), len(indent) // 2))
+    # 子モジュールは親より先に出力されるため、InOut_system_test の行から遡る
+    # （インタプリタの起動時に読み込まれる site などは含めない）
+    end = next(i for i, row in enumerate(rows) if row[0] == MODULE and row[3] == 0)
+    start = end
+    while start > 0 and rows[start - 1][3] > 0:
+        start -= 1
+    modules = {name: (own, cumulative, depth) for name, own, cumulative, depth in rows[start:end]}
+    return modules, rows[end][2] / 1000
+
+
+def measure_create_app():
+    result = subprocess.run(
+        [sys.executable, "-c", CREATE_APP],
+        cwd=ROOT, env=_env(), capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        sys.stderr.write(result.stderr)
+        raise SystemExit("create_app() failed")
+    return float(result.stdout.split()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the cold start import time budget")
+    parser.add_argument("--budget-ms", type=float, default=300.0,
+                        help="import InOut_system_test の上限（中央値、ミリ秒）")
+    parser.add_argument("--runs", type=int, default=5, help="測定回数")
+    parser.add_argument("--top", type=int, default=10, help="表示する累積時間の上位件数")
+    parser.add_argument("--create-app", action="store_true", help="create_app() までの時間も測る")
+    parser.add_argument("--create-app-budget-ms", type=float, default=None,
+                        help="create_app() までの上限（中央値、ミリ秒）")
+    args = parser.parse_args()
+
+    timings = []
+    modules = {}
+    for _ in range(args.runs):
+        modules, elapsed = measure_import()
+        timings.append(elapsed)
+    median = statistics.median(timings)
+    failed = False
+
+    print(f"import {MODULE}: median {median:.1f}ms "
+          f"(min {min(timings):.1f}ms, max {max(timings):.1f}ms, budget {args.budget_ms:.0f}ms)")
+    print(f"top {args.top} by cumulative time (last run):")
+    ranked = sorted(
+        ((cumulative, name) for name, (_, cumulative, depth) in modules.items() if depth == 1),
+        reverse=True
+    )
+    for cumulative, name in ranked[:args.top]:
+        print(f"  {cumulative / 1000:8.1f}ms  {name}")
+
+    if median > args.budget_ms:
+        print(f"FAIL: import time {median:.1f}ms exceeds budget {args.budget_ms:.0f}ms")
+        failed = True
+    heavy = sorted(name for name in modules if name.split(".")[0] in FORBIDDEN)
+    if heavy:
+        print(f"FAIL: imported at module load: {', '.join(heavy[:10])}")
+        failed = True
+
+    if args.create_app or args.create_app_budget_ms is not None:
+        app_timings = [measure_create_app() for _ in range(args.runs)]
+        app_median = statistics.median(app_timings)
+        print(f"create_app(): median {app_median:.1f}ms")
+        if args.create_app_budget_ms is not None and app_median > args.create_app_budget_ms:
+            print(f"FAIL: create_app() {app_median:.1f}ms exceeds budget "
+                  f"{args.create_app_budget_ms:.0f}ms")
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
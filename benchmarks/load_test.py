@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+"""
+Webhookサーバーの負荷試験。多数のユーザが勤怠・休暇の会話を最後（保存）まで行い、
+スループット・応答時間の分位点・エラー率を測定する。
+
+- Webhookの署名は CHANNEL_SECRET（未設定の場合は試験用の値）で作成し、同じ値でサーバーを起動する
+- LINE APIはローカルの偽サーバーで代用する（返信の遅延と失敗率を指定できる）
+- データベースは .env の DATABASE_* を使う。--ephemeral-db を指定すると initdb で一時的な
+  PostgreSQLを起動し、終了時に削除する。--no-db の場合は保存の手前で会話を止める
+- 結果を --save で JSON に保存し、--compare で以前の結果と比較できる
+
+使い方:
+    python benchmarks/load_test.py --users 2000 --concurrency 200 --ephemeral-db --save baseline.json
+    python benchmarks/load_test.py --users 2000 --concurrency 200 --ephemeral-db --compare baseline.json
+    python benchmarks/load_test.py --no-db --env ASYNC_DISPATCH=1 --env EVENT_WORKERS=8
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from aiohttp import ClientError, ClientSession, web
+
+from bench_async import ROOT, SECRET, build_body, sign, wait_ready
+
+sys.path.insert(0, ROOT)
+
+from dotenv import load_dotenv
+
+
+SAVED_TEXT = "保存されました"
+FAILED_TEXT = "失敗しました"
+THROTTLED_TEXT = "メッセージが多すぎます"
+
+# 比較する項目と、値が大きいほど良いかどうか
+COMPARED = (
+    ("throughput", True),
+    ("latency_ms.p50", False),
+    ("latency_ms.p95", False),
+    ("latency_ms.p99", False),
+    ("error_rate", False),
+)
+
+
+def attendance_messages(rng, with_save):
+    day = f"2024{rng.randint(1, 12):02}{rng.randint(1, 28):02}"
+    start = rng.randint(7, 10)
+    messages = [
+        "勤怠", f"ユーザ{rng.randint(1, 999)}", day, str(start), str(start + 9),
+        "12", "13", "開発",
+    ]
+    if rng.random() < 0.1:
+        # 入力ミスの再入力も混ぜる
+        messages.insert(3, "25")
+    return messages + (["y"] if with_save else [])
+
+
+def vacation_messages(rng, with_save):
+    day = f"2024-{rng.randint(1, 12):02}-{rng.randint(1, 28):02}"
+    messages = ["休暇", day, rng.choice(("全日休", "午前休", "午後休"))]
+    return messages + (["y"] if with_save else [])
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class FakeLine:
+    """
+    LINE Messaging API の返信・プッシュを受ける偽サーバー。
+    """
+
+    def __init__(self, delay, error_rate, rng):
+        self.delay = delay
+        self.error_rate = error_rate
+        self.rng = rng
+        self.replies = 0
+        self.saved = 0
+        self.save_failed = 0
+        self.throttled = 0
+        self.injected_errors = 0
+        self._runner = None
+
+    async def _handle(self, request):
+        body = await request.json()
+        await asyncio.sleep(self.delay)
+        if self.error_rate and self.rng.random() < self.error_rate:
+            self.injected_errors += 1
+            return web.json_response({"message": "injected error"}, status=500)
+        self.replies += 1
+        for message in body.get("messages", []):
+            text = message.get("text", "")
+            if SAVED_TEXT in text:
+                self.saved += 1
+            elif FAILED_TEXT in text:
+                self.save_failed += 1
+            elif THROTTLED_TEXT in text:
+                self.throttled += 1
+        return web.json_response({"sentMessages": [{"id": "1", "quoteToken": "q"}]})
+
+    async def start(self, port):
+        app = web.Application()
+        app.router.add_post("/v2/bot/message/reply", self._handle)
+        app.router.add_post("/v2/bot/message/push", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", port).start()
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+class EphemeralPostgres:
+    """
+    initdb / pg_ctl で一時ディレクトリにPostgreSQLを起動する。
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.directory = None
+
+    def _bin(self, name):
+        path = shutil.which(name)
+        if path is None and shutil.which("pg_config"):
+            bindir = subprocess.check_output(["pg_config", "--bindir"], text=True).strip()
+            path = os.path.join(bindir, name)
+        if path is None or not os.path.exists(path):
+            raise SystemExit(f"{name} not found; install PostgreSQL or drop --ephemeral-db")
+        return path
+
+    def start(self):
+        self.directory = tempfile.mkdtemp(prefix="inout-pg-")
+        data = os.path.join(self.directory, "data")
+        subprocess.run(
+            [self._bin("initdb"), "-D", data, "-U", "bench", "--auth=trust", "-E", "UTF8"],
+            check=True, stdout=subprocess.DEVNULL
+        )
+        subprocess.run(
+            [self._bin("pg_ctl"), "-D", data, "-w", "-l", os.path.join(self.directory, "log"),
+             "-o", f"-p {self.port} -k {self.directory} -c listen_addresses=127.0.0.1", "start"],
+            check=True, stdout=subprocess.DEVNULL
+        )
+        return {
+            "DATABASE_NAME": "postgres",
+            "DATABASE_USER": "bench",
+            "DATABASE_PASSWORD": "",
+            "DATABASE_HOST": "127.0.0.1",
+            "DATABASE_PORT": str(self.port),
+        }
+
+    def stop(self):
+        if self.directory is None:
+            return
+        subprocess.run(
+            [self._bin("pg_ctl"), "-D", os.path.join(self.directory, "data"), "-m", "fast", "stop"],
+            stdout=subprocess.DEVNULL
+        )
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def migrate(db_env):
+    # 試験用のデータベースにテーブルを作成する（schema.py は DATABASE_* を読む）
+    os.environ.update(db_env)
+    from db_pool import connect_from_env
+    from schema import migrate as apply_migrations
+
+    conn = connect_from_env()
+    try:
+        apply_migrations(conn, out=io.StringIO())
+    finally:
+        conn.close()
+
+
+def start_server(kind, port, line_port, secret, extra_env):
+    env = dict(
+        os.environ,
+        CHANNEL_SECRET=secret,
+        CHANNEL_ACCESS_TOKEN="bench",
+        LINE_API_HOST=f"http://127.0.0.1:{line_port}",
+        ASYNC_PORT=str(port),
+    )
+    env.update(extra_env)
+    if kind == "flask":
+        cmd = [sys.executable, "-m", "flask", "--app", "InOut_system_test", "run", "--port", str(port)]
+    else:
+        cmd = [sys.executable, "async_app.py"]
+    return subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(q * len(sorted_values)))
+    return sorted_values[index]
+
+
+async def wait_warm(session, base_url):
+    # /healthz がある場合は、LINE APIのクライアントの作成が終わるまで待つ
+    for _ in range(100):
+        async with session.get(f"{base_url}/healthz") as resp:
+            if resp.status != 503:
+                return
+        await asyncio.sleep(0.1)
+    raise RuntimeError(f"server did not warm up: {base_url}")
+
+
+async def run_load(url, conversations, concurrency, secret):
+    latencies = []
+    http_errors = 0
+    transport_errors = 0
+    limit = asyncio.Semaphore(concurrency)
+
+    async def conversation(session, user_id, messages):
+        nonlocal http_errors, transport_errors
+        async with limit:
+            for seq, text in enumerate(messages):
+                body = build_body(user_id, text, seq)
+                started = time.perf_counter()
+                try:
+                    async with session.post(url, data=body.encode("utf-8"), headers={
+                        "X-Line-Signature": sign(body, secret), "Content-Type": "application/json"
+                    }) as resp:
+                        await resp.read()
+                        if resp.status != 200:
+                            http_errors += 1
+                except (ClientError, asyncio.TimeoutError):
+                    transport_errors += 1
+                latencies.append(time.perf_counter() - started)
+
+    async with ClientSession() as session:
+        await wait_ready(session, url)
+        await wait_warm(session, url.rsplit("/", 1)[0])
+        started = time.perf_counter()
+        await asyncio.gather(*(conversation(session, u, m) for u, m in conversations))
+        elapsed = time.perf_counter() - started
+    return latencies, http_errors, transport_errors, elapsed
+
+
+async def fetch_stage_quantiles(base_url):
+    # サーバーの /metrics から段階ごとの分位点を取り出す
+    stages = {}
+    try:
+        async with ClientSession() as session:
+            async with session.get(f"{base_url}/metrics") as resp:
+                text = await resp.text()
+    except ClientError:
+        return stages
+    for line in text.splitlines():
+        if not line.startswith("inout_stage_seconds_quantile{"):
+            continue
+        labels, value = line[len("inout_stage_seconds_quantile{"):].split("} ")
+        fields = dict(part.split("=", 1) for part in labels.split(","))
+        stage = fields["stage"].strip('"')
+        quantile = "p" + str(int(float(fields["quantile"].strip('"')) * 100))
+        stages.setdefault(stage, {})[quantile] = round(float(value) * 1000, 3)
+    return stages
+
+
+def _git_version():
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"], cwd=ROOT, text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _get(result, dotted):
+    for key in dotted.split("."):
+        result = result[key]
+    return result
+
+
+def compare(result, baseline, tolerance):
+    """
+    以前の結果と比較して表示し、tolerance を超えて悪化した項目の一覧を返す。
+    """
+    regressions = []
+    print(f"compared with {baseline.get('version')} ({baseline.get('timestamp')}):")
+    for key, higher_is_better in COMPARED:
+        old = _get(baseline, key)
+        new = _get(result, key)
+        change = (new - old) / old if old else 0.0
+        worse = -change if higher_is_better else change
+        mark = ""
+        if worse > tolerance and not (key == "error_rate" and new - old < 0.001):
+            mark = "  REGRESSION"
+            regressions.append(key)
+        print(f"  {key:<16} {old:>10.4g} -> {new:>10.4g} ({change:+.1%}){mark}")
+    return regressions
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000, help="simulated users (one conversation each)")
+    parser.add_argument("--concurrency", type=int, default=100, help="conversations in flight")
+    parser.add_argument("--vacation-ratio", type=float, default=0.2)
+    parser.add_argument("--server", choices=["flask", "async"], default="flask")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra environment for the server, e.g. EVENT_WORKERS=8")
+    parser.add_argument("--line-delay", type=float, default=0.05, help="fake LINE API latency (s)")
+    parser.add_argument("--line-error-rate", type=float, default=0.0)
+    db = parser.add_mutually_exclusive_group()
+    db.add_argument("--ephemeral-db", action="store_true", help="run a throwaway PostgreSQL")
+    db.add_argument("--no-db", action="store_true", help="stop conversations before saving")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="write the result JSON here")
+    parser.add_argument("--compare", help="baseline JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed regression (ratio)")
+    args = parser.parse_args()
+
+    load_dotenv(os.path.join(ROOT, ".env"))
+    secret = os.getenv("CHANNEL_SECRET") or SECRET
+    extra_env = dict(item.split("=", 1) for item in args.env)
+    rng = random.Random(args.seed)
+    run = f"{int(time.time()):x}"
+
+    postgres = None
+    db_env = {}
+    if args.ephemeral_db:
+        postgres = EphemeralPostgres(free_port())
+        db_env = postgres.start()
+    elif args.no_db:
+        db_env = {"DATABASE_POOL_MIN": "0"}
+    try:
+        if not args.no_db:
+            migrate(db_env)
+
+        conversations = []
+        for n in range(args.users):
+            user_id = f"U{run}{n:06d}"
+            if rng.random() < args.vacation_ratio:
+                messages = vacation_messages(rng, not args.no_db)
+            else:
+                messages = attendance_messages(rng, not args.no_db)
+            conversations.append((user_id, messages))
+        expected_saves = 0 if args.no_db else args.users
+
+        line = FakeLine(args.line_delay, args.line_error_rate, rng)
+        line_port = free_port()
+        await line.start(line_port)
+        port = free_port()
+        server = start_server(args.server, port, line_port, secret, {**db_env, **extra_env})
+        try:
+            base_url = f"http://127.0.0.1:{port}"
+            latencies, http_errors, transport_errors, elapsed = await run_load(
+                f"{base_url}/callback", conversations, args.concurrency, secret
+            )
+            # 非同期処理の場合は返信が終わるまで待つ
+            deadline = time.monotonic() + 30
+            expected_replies = len(latencies) - http_errors - transport_errors
+            while (line.replies + line.injected_errors < expected_replies
+                   and time.monotonic() < deadline):
+                await asyncio.sleep(0.1)
+            stages = await fetch_stage_quantiles(base_url)
+        finally:
+            server.terminate()
+            server.wait()
+            await line.stop()
+    finally:
+        if postgres is not None:
+            postgres.stop()
+
+    latencies.sort()
+    requests = len(latencies)
+    errors = http_errors + transport_errors
+    result = {
+        "version": _git_version(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "config": {
+            "server": args.server, "users": args.users, "concurrency": args.concurrency,
+            "vacation_ratio": args.vacation_ratio, "line_delay": args.line_delay,
+            "line_error_rate": args.line_error_rate, "database": not args.no_db,
+            "env": extra_env,
+        },
+        "requests": requests,
+        "elapsed": round(elapsed, 3),
+        "throughput": round(requests / elapsed, 1),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50) * 1000, 2),
+            "p95": round(percentile(latencies, 0.95) * 1000, 2),
+            "p99": round(percentile(latencies, 0.99) * 1000, 2),
+            "max": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+        },
+        "errors": {"http": http_errors, "transport": transport_errors},
+        "error_rate": round(errors / requests, 5) if requests else 0.0,
+        "line": {
+            "replies": line.replies,
+            "injected_errors": line.injected_errors,
+            "saved": line.saved,
+            "save_failed": line.save_failed,
+            "throttled": line.throttled,
+            "saves_expected": expected_saves,
+        },
+        "stages_ms": stages,
+    }
+
+    print(
+        f"{args.server}: {requests} req in {elapsed:.2f}s  {result['throughput']:,.0f} req/s  "
+        f"p50={result['latency_ms']['p50']}ms p95={result['latency_ms']['p95']}ms "
+        f"p99={result['latency_ms']['p99']}ms  errors={errors} ({result['error_rate']:.2%})"
+    )
+    print(
+        f"LINE: {line.replies} replies, {line.injected_errors} injected errors, "
+        f"saved {line.saved}/{expected_saves}, save failed {line.save_failed}, "
+        f"throttled {line.throttled}"
+    )
+    for stage, quantiles in sorted(stages.items()):
+        print(f"  {stage:<12} " + " ".join(f"{q}={v}ms" for q, v in quantiles.items()))
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare(result, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# psycopg2 は読み込みに時間がかかるため、使う関数の中で import する（アプリの起動を遅くしない）
+
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeoutError(Exception):
+    """
+    指定時間内にコネクションを取得できなかった場合の例外。
+    """
+
+
+class ConnectionPool:
+    """
+    PostgreSQLコネクションを使い回すスレッドセーフなプール。
+    connect_func で新しいコネクションを作成し、最大 maxconn 本まで保持する。
+    validate_after 秒より長く使われていないコネクションと、別のコネクションが接続エラーで
+    破棄される前に戻されたコネクションは、貸し出す前に SELECT 1 で確かめる
+    （DBの再起動やアイドル切断の後、切れたコネクションを保存処理に渡さないため）。
+    """
+
+    def __init__(self, connect_func, minconn=1, maxconn=10, timeout=5.0, validate_after=30.0):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("invalid pool size: min=%s max=%s" % (minconn, maxconn))
+        self._connect = connect_func
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.validate_after = validate_after
+        self._idle = deque()  # (コネクション, 戻された時刻)
+        self._in_use = set()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._filled = False
+        # この時刻より前に戻されたコネクションは貸し出す前に確かめる
+        self._suspect_before = 0.0
+
+        # メトリクス
+        self._checkouts = 0
+        self._checkout_failures = 0
+        self._broken = 0
+        self._validated = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _fill(self):
+        # 最小接続数は最初の利用時に確保する（起動時にDBへ接続しない）
+        # 接続はロックの外で行い、他のスレッドの取得を待たせない
+        import psycopg2
+
+        with self._cond:
+            if self._filled:
+                return
+            self._filled = True
+            missing = self.minconn - len(self._idle) - len(self._in_use)
+        for _ in range(missing):
+            try:
+                conn = self._connect()
+            except psycopg2.Error as e:
+                logger.warning(f"Failed to pre-open pooled connection: {e}")
+                return
+            with self._cond:
+                if self._closed or len(self._idle) + len(self._in_use) >= self.maxconn:
+                    conn.close()
+                    return
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    @staticmethod
+    def _is_usable(conn):
+        from psycopg2 import extensions
+
+        if conn.closed:
+            return False
+        status = conn.get_transaction_status()
+        return status != extensions.TRANSACTION_STATUS_UNKNOWN
+
+    def _is_alive(self, conn):
+        # サーバ側で切断されていても closed は変わらないため、実際に問い合わせる
+        import psycopg2
+
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error as e:
+            logger.warning(f"Discarding stale pooled connection: {e}")
+            return False
+
+    def _discard(self, conn):
+        self._broken += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def getconn(self, timeout=None):
+        """
+        プールからコネクションを取り出す。空きがなく上限に達している場合は待機する。
+        """
+        if timeout is None:
+            timeout = self.timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        if not self._filled:
+            self._fill()
+        while True:
+            conn, suspect = self._reserve(timeout, deadline)
+            if suspect is None:
+                return self._open(conn, started)
+            if suspect and not self._is_alive(conn):
+                with self._cond:
+                    self._in_use.discard(conn)
+                    self._discard(conn)
+                    self._cond.notify()
+                continue
+            with self._cond:
+                self._checkout(conn, started)
+            return conn
+
+    def _reserve(self, timeout, deadline):
+        # 空いているコネクションと確かめる必要があるかどうかを返す
+        # 空きがなく上限にも達していない場合は、新しく接続する枠を確保して (枠, None) を返す
+        import psycopg2
+
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise psycopg2.InterfaceError("connection pool is closed")
+                # 切断されたコネクションは捨てて次を試す
+                while self._idle:
+                    conn, returned_at = self._idle.pop()
+                    if not self._is_usable(conn):
+                        self._discard(conn)
+                        continue
+                    self._in_use.add(conn)
+                    suspect = (
+                        returned_at < self._suspect_before
+                        or time.monotonic() - returned_at > self.validate_after
+                    )
+                    if suspect:
+                        self._validated += 1
+                    return conn, suspect
+                if len(self._in_use) < self.maxconn:
+                    # 枠を確保してからロック外で接続する
+                    placeholder = object()
+                    self._in_use.add(placeholder)
+                    return placeholder, None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._checkout_failures += 1
+                    raise PoolTimeoutError(
+                        f"no connection available within {timeout:.1f}s (max={self.maxconn})"
+                    )
+                self._cond.wait(remaining)
+
+    def _open(self, placeholder, started):
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._in_use.discard(placeholder)
+                self._checkout_failures += 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._in_use.discard(placeholder)
+            self._checkout(conn, started)
+        return conn
+
+    def _checkout(self, conn, started):
+        waited = time.monotonic() - started
+        self._in_use.add(conn)
+        self._checkouts += 1
+        self._wait_total += waited
+        if waited > self._wait_max:
+            self._wait_max = waited
+
+    def putconn(self, conn, broken=False):
+        """
+        コネクションをプールに戻す。壊れている場合は閉じて破棄する。
+        """
+        import psycopg2
+        from psycopg2 import extensions
+
+        with self._cond:
+            self._in_use.discard(conn)
+            if broken or self._closed or not self._is_usable(conn):
+                self._discard(conn)
+                if broken:
+                    # 同じ原因（DBの再起動など）で空いているコネクションも切れている可能性がある
+                    self._suspect_before = time.monotonic()
+            else:
+                try:
+                    # 未完了のトランザクションを残したまま戻さない
+                    if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                        conn.rollback()
+                    self._idle.append((conn, time.monotonic()))
+                except psycopg2.Error:
+                    self._discard(conn)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+        with文でコネクションを借り、終了時に自動で返却する。
+        例外時はロールバックし、接続エラーであればコネクションを破棄する。
+        """
+        import psycopg2
+
+        conn = self.getconn(timeout)
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        except Exception:
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+            raise
+        finally:
+            self.putconn(conn, broken=broken)
+
+    def closeall(self):
+        """
+        全てのコネクションを閉じ、以降の取得を拒否する。
+        """
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                try:
+                    self._idle.pop()[0].close()
+                except Exception:
+                    pass
+            for conn in list(self._in_use):
+                if hasattr(conn, "close"):
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            self._in_use.clear()
+            self._cond.notify_all()
+
+    def stats(self):
+        """
+        プールの利用状況を辞書で返す。
+        """
+        with self._cond:
+            return {
+                "in_use": len(self._in_use),
+                "idle": len(self._idle),
+                "max": self.maxconn,
+                "checkouts": self._checkouts,
+                "checkout_failures": self._checkout_failures,
+                "broken_discarded": self._broken,
+                "validated": self._validated,
+                "wait_seconds_total": self._wait_total,
+                "wait_seconds_max": self._wait_max,
+            }
+
+
+def connect_from_env():
+    """
+    DATABASE_* 環境変数の設定で接続する（コマンドラインツール用）。
+    """
+    import psycopg2
+
+    return psycopg2.connect(
+        dbname=os.getenv('DATABASE_NAME'),
+        user=os.getenv('DATABASE_USER'),
+        password=os.getenv('DATABASE_PASSWORD'),
+        host=os.getenv('DATABASE_HOST'),
+        port=os.getenv('DATABASE_PORT')
+    )
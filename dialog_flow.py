@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+
+class Step:
+    """
+    入力ステップの定義。validator は入力を正規化した値を返し、無効な場合は None を返す。
+    validator が None の場合は入力をそのまま受け付ける。
+    """
+
+    __slots__ = ("field", "prompt", "error", "validator")
+
+    def __init__(self, field, prompt, error=None, validator=None):
+        self.field = field
+        self.prompt = prompt
+        self.error = error
+        self.validator = validator
+
+
+class Flow:
+    """
+    1つの入力モード（勤怠、休暇など）の定義。
+    command で開始し、steps を順に入力した後、confirm で確認文を作って Y/N を尋ねる。
+    yes の入力で save_kind を返し、保存は呼び出し元が行う。
+    no が None の場合は yes 以外の入力をすべてやり直しとして扱う。
+    """
+
+    __slots__ = (
+        "id", "command", "entry", "steps", "fields", "fixed", "confirm", "yes", "no",
+        "retry", "invalid_answer", "save_kind", "saved", "save_failed"
+    )
+
+    def __init__(self, id, command, entry, steps, confirm, yes, no, retry, save_kind,
+                 saved, save_failed, invalid_answer=None, fixed=None):
+        self.id = id
+        self.command = command
+        self.entry = entry
+        self.steps = tuple(steps)
+        self.fields = tuple(step.field for step in self.steps)
+        self.fixed = dict(fixed or {})
+        self.confirm = confirm
+        self.yes = frozenset(yes)
+        self.no = frozenset(no) if no is not None else None
+        self.retry = retry
+        self.invalid_answer = invalid_answer
+        self.save_kind = save_kind
+        self.saved = saved
+        self.save_failed = save_failed
+
+
+class DialogEngine:
+    """
+    Flow の表に従って入力ステップを進める。
+    状態は {"mode": フローID, "step": ステップ番号, "values": [入力値...]} の小さな dict で、
+    ステップ番号が len(steps) のときは確認待ちを表す。
+    observer を指定すると、入力を処理するたびに observer(フローID, ステップ, 結果) を呼ぶ。
+    """
+
+    def __init__(self, flows, observer=None):
+        self._by_command = {flow.command: flow for flow in flows}
+        self._by_id = {flow.id: flow for flow in flows}
+        self.observer = observer
+
+    def _observe(self, flow, step, outcome):
+        if self.observer is not None:
+            self.observer(flow.id, step, outcome)
+
+    def flow_of(self, state):
+        return self._by_id.get(state.get("mode"))
+
+    def handle(self, user_input, state):
+        """
+        入力に応じて state を更新し、返信文を返す。確認で yes が入力された場合は
+        flow.save_kind を返す。どのモードにも入っていない場合は None を返す。
+        """
+        flow = self._by_command.get(user_input)
+        if flow is not None:
+            state.clear()
+            state.update({"mode": flow.id, "step": 0, "values": []})
+            self._observe(flow, "command", "started")
+            return flow.entry
+
+        flow = self.flow_of(state)
+        if flow is None:
+            return None
+
+        index = state["step"]
+        values = state["values"]
+        if index < len(flow.steps):
+            step = flow.steps[index]
+            value = user_input if step.validator is None else step.validator(user_input)
+            if value is None:
+                self._observe(flow, step.field, "invalid")
+                return step.error
+            # 保存済みの状態と list を共有しないよう新しい list にする
+            state["values"] = values + [value]
+            state["step"] = index + 1
+            self._observe(flow, step.field, "accepted")
+            if index + 1 < len(flow.steps):
+                return flow.steps[index + 1].prompt
+            return flow.confirm(self.record(state))
+
+        answer = user_input.lower()
+        if answer in flow.yes:
+            self._observe(flow, "confirm", "confirmed")
+            return flow.save_kind
+        if flow.no is None or answer in flow.no:
+            state["step"] = 0
+            state["values"] = []
+            self._observe(flow, "confirm", "retry")
+            return flow.retry
+        self._observe(flow, "confirm", "invalid")
+        return flow.invalid_answer
+
+    def confirming(self, state, save_kind):
+        """
+        state が save_kind を返すフローの確認待ち（yes で保存する段階）であれば True を返す。
+        """
+        flow = self.flow_of(state)
+        return flow is not None and flow.save_kind == save_kind and state["step"] == len(flow.steps)
+
+    def record(self, state):
+        """
+        入力済みの値をフィールド名の dict にして返す。
+        """
+        flow = self.flow_of(state)
+        record = dict(zip(flow.fields, state["values"]))
+        record.update(flow.fixed)
+        return record
+
+    def finish(self, state, saved):
+        """
+        保存結果に応じて状態を片付け、返信文を返す。どのモードにも入っていない場合
+        （別の入力で状態が変わった場合など）は何もせず None を返す。
+        """
+        flow = self.flow_of(state)
+        if flow is None:
+            return None
+        if not saved:
+            self._observe(flow, "save", "failed")
+            return flow.save_failed
+        self._observe(flow, "save", "saved")
+        state.clear()  # 状態のクリア（ストアからも削除される）
+        return flow.saved
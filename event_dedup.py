@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import OrderedDict
+
+
+class EventDeduplicator:
+    """
+    webhookEventId を覚えておき、LINEから再送された同じイベントを検出する共通インターフェース。
+    """
+
+    def __init__(self, ttl=86400):
+        self.ttl = ttl
+        self._counter_lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._redeliveries = 0
+
+    def seen(self, event_id, redelivery=False):
+        """
+        event_id が処理済み（または処理中）なら True を返す。
+        初めてのイベントなら記録して False を返す。redelivery は deliveryContext.isRedelivery。
+        """
+        duplicate = self._check_and_mark(event_id)
+        with self._counter_lock:
+            if duplicate:
+                self._hits += 1
+            else:
+                self._misses += 1
+            if redelivery:
+                self._redeliveries += 1
+        return duplicate
+
+    def forget(self, event_id):
+        """
+        処理を受け付けられなかったイベントの記録を消し、再送されたときに処理できるようにする。
+        """
+        raise NotImplementedError
+
+    def _check_and_mark(self, event_id):
+        raise NotImplementedError
+
+    def stats(self):
+        with self._counter_lock:
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "redeliveries": self._redeliveries,
+            }
+
+
+class MemoryEventDeduplicator(EventDeduplicator):
+    """
+    プロセス内に event_id を保持する（ワーカー1つの場合用）。
+    記録から ttl 秒経過したものと、max_entries を超えた古いものを破棄する。
+    """
+
+    def __init__(self, ttl=86400, max_entries=100000):
+        super().__init__(ttl)
+        self.max_entries = max_entries
+        # event_id -> 期限。記録した順に並ぶ（期限も同じ順になる）
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _check_and_mark(self, event_id):
+        now = time.monotonic()
+        with self._lock:
+            while self._entries:
+                oldest, expires = next(iter(self._entries.items()))
+                if expires > now:
+                    break
+                del self._entries[oldest]
+            if event_id in self._entries:
+                return True
+            self._entries[event_id] = now + self.ttl
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return False
+
+    def forget(self, event_id):
+        with self._lock:
+            self._entries.pop(event_id, None)
+
+    def stats(self):
+        stats = super().stats()
+        with self._lock:
+            stats["entries"] = len(self._entries)
+        stats["max_entries"] = self.max_entries
+        return stats
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class PostgresEventDeduplicator(EventDeduplicator):
+    """
+    PostgreSQLのテーブルで event_id を共有する（複数ワーカーの場合用）。
+    同じプロセスで記録したものはメモリ上でも覚えておき、再送の判定にデータベースを使わない。
+    """
+
+    PURGE_INTERVAL = 600
+
+    def __init__(self, pool, ttl=86400, max_entries=100000, table="webhook_event"):
+        super().__init__(ttl)
+        self.pool = pool
+        self.table = table
+        self._local = MemoryEventDeduplicator(ttl=ttl, max_entries=max_entries)
+        self._table_ready = False
+        self._purge_lock = threading.Lock()
+        self._next_purge = time.monotonic() + self.PURGE_INTERVAL
+
+    def _ensure_table(self, cur):
+        if self._table_ready:
+            return
+        cur.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.table} ("
+            "event_id TEXT PRIMARY KEY, "
+            "seen_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+        )
+        self._table_ready = True
+
+    def _check_and_mark(self, event_id):
+        if self._local._check_and_mark(event_id):
+            return True
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                self._ensure_table(cur)
+                # 期限切れの行は新しいイベントとして上書きする
+                cur.execute(
+                    f"INSERT INTO {self.table} (event_id) VALUES (%s) "
+                    f"ON CONFLICT (event_id) DO UPDATE SET seen_at = now() "
+                    f"WHERE {self.table}.seen_at <= now() - make_interval(secs => %s)",
+                    (event_id, self.ttl)
+                )
+                duplicate = cur.rowcount == 0
+            conn.commit()
+        self._maybe_purge()
+        return duplicate
+
+    def forget(self, event_id):
+        self._local.forget(event_id)
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                self._ensure_table(cur)
+                cur.execute(f"DELETE FROM {self.table} WHERE event_id = %s", (event_id,))
+            conn.commit()
+
+    def _maybe_purge(self):
+        now = time.monotonic()
+        if now < self._next_purge or not self._purge_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_purge = now + self.PURGE_INTERVAL
+            self.purge_expired()
+        finally:
+            self._purge_lock.release()
+
+    def purge_expired(self):
+        """
+        期限切れの記録を削除し、削除件数を返す。
+        """
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                self._ensure_table(cur)
+                cur.execute(
+                    f"DELETE FROM {self.table} WHERE seen_at <= now() - make_interval(secs => %s)",
+                    (self.ttl,)
+                )
+                deleted = cur.rowcount
+            conn.commit()
+        return deleted
+
+    def stats(self):
+        stats = super().stats()
+        stats["local_entries"] = len(self._local)
+        return stats
+
+
+def create_event_deduplicator(kind, pool=None, ttl=86400, max_entries=100000):
+    """
+    設定値から重複検出を作成する。kind は "memory"、"postgres" または "off"（None を返す）。
+    """
+    if kind == "off":
+        return None
+    if kind == "memory":
+        return MemoryEventDeduplicator(ttl=ttl, max_entries=max_entries)
+    if kind == "postgres":
+        if pool is None:
+            raise ValueError("postgres event deduplicator requires a connection pool")
+        return PostgresEventDeduplicator(pool, ttl=ttl, max_entries=max_entries)
+    raise ValueError(f"unknown event deduplicator: {kind}")
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+import logging
+import queue
+import threading
+import time
+import traceback
+import zlib
+
+from linebot.v3 import WebhookHandler
+from linebot.v3.webhooks import MessageEvent
+
+from metrics import METRICS
+
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class QueueFullError(Exception):
+    """
+    キューが満杯でイベントを受け付けられなかった場合の例外。
+    """
+
+
+class EventDispatcher:
+    """
+    イベントをバックグラウンドのワーカースレッドで処理する。
+    同じキー（ユーザID）のイベントは必ず同じワーカーに振り分け、受信順に処理する。
+    """
+
+    def __init__(self, workers=4, queue_size=1000, put_timeout=1.0):
+        self.workers = workers
+        self.put_timeout = put_timeout
+        per_worker = max(1, queue_size // workers)
+        self._queues = [queue.Queue(maxsize=per_worker) for _ in range(workers)]
+        self._threads = []
+        self._lock = threading.Lock()
+        self._stopped = False
+
+        # メトリクス
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._run_total = 0.0
+        self._run_max = 0.0
+
+        for i in range(workers):
+            thread = threading.Thread(
+                target=self._worker, args=(self._queues[i],),
+                name=f"event-worker-{i}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def _partition(self, key):
+        if key is None:
+            return 0
+        return zlib.crc32(key.encode("utf-8")) % self.workers
+
+    def submit(self, key, func, *args):
+        """
+        func(*args) をキーに対応するワーカーのキューに積む。
+        put_timeout 秒待っても空きがなければ QueueFullError を送出する。
+        """
+        if self._stopped:
+            raise QueueFullError("dispatcher is shutting down")
+        q = self._queues[self._partition(key)]
+        try:
+            q.put((time.monotonic(), func, args), timeout=self.put_timeout)
+        except queue.Full:
+            with self._lock:
+                self._rejected += 1
+            raise QueueFullError(f"event queue is full (size={q.maxsize})")
+        with self._lock:
+            self._submitted += 1
+
+    def _worker(self, q):
+        while True:
+            item = q.get()
+            try:
+                if item is _STOP:
+                    return
+                enqueued_at, func, args = item
+                started = time.monotonic()
+                failed = False
+                try:
+                    func(*args)
+                except Exception as e:
+                    failed = True
+                    logger.error(f"Failed to process event: {e}")
+                    logger.error(traceback.format_exc())
+                finished = time.monotonic()
+                self._record(started - enqueued_at, finished - started, failed)
+            finally:
+                q.task_done()
+
+    def _record(self, waited, ran, failed):
+        METRICS.stage_seconds.observe(waited, "queue_wait")
+        with self._lock:
+            if failed:
+                self._failed += 1
+            else:
+                self._completed += 1
+            self._wait_total += waited
+            self._run_total += ran
+            if waited > self._wait_max:
+                self._wait_max = waited
+            if ran > self._run_max:
+                self._run_max = ran
+
+    def shutdown(self, timeout=30.0):
+        """
+        新規受付を止め、キューに残ったイベントを処理し終えるまで待つ。
+        """
+        if self._stopped:
+            return
+        self._stopped = True
+        deadline = time.monotonic() + timeout
+        for q in self._queues:
+            # キューが満杯のまま空かない場合も timeout を超えて待たない
+            try:
+                q.put(_STOP, timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                pass
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        remaining = sum(q.qsize() for q in self._queues)
+        if remaining:
+            logger.warning(f"Event dispatcher stopped with {remaining} events left in queue")
+
+    def stats(self):
+        """
+        キューの状態を辞書で返す。
+        """
+        depths = [q.qsize() for q in self._queues]
+        with self._lock:
+            processed = self._completed + self._failed
+            return {
+                "queue_depth": sum(depths),
+                "queue_depth_max": max(depths),
+                "submitted": self._submitted,
+                "completed": self._completed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "wait_seconds_avg": self._wait_total / processed if processed else 0.0,
+                "wait_seconds_max": self._wait_max,
+                "run_seconds_avg": self._run_total / processed if processed else 0.0,
+                "run_seconds_max": self._run_max,
+            }
+
+
+class QueuedWebhookHandler(WebhookHandler):
+    """
+    署名検証とイベントの解析だけを行い、ハンドラの実行は EventDispatcher に任せる
+    WebhookHandler。dispatcher が None の場合は通常どおり同期で処理する。
+    deduplicator を指定すると、処理済みの webhookEventId のイベントはハンドラを呼ばずに読み飛ばす。
+
+    add_batch() で登録した種類のイベントが1回の配信に batch_min 件以上含まれる場合は、
+    それらをまとめて1回のバッチハンドラの呼び出しで処理する（イベントの一覧を受信順に渡す）。
+    dispatcher を使う場合は、ユーザごとの処理順を保つためユーザ単位に分けて呼び出す。
+    """
+
+    def __init__(self, channel_secret, dispatcher=None, deduplicator=None, batch_min=2):
+        super().__init__(channel_secret)
+        self.dispatcher = dispatcher
+        self.deduplicator = deduplicator
+        self.batch_min = batch_min
+        self._batch_handlers = {}
+
+    def add_batch(self, event, message=None):
+        """
+        add() と同じ指定で、イベントの一覧を受け取るハンドラを登録するデコレータ。
+        """
+        def decorator(func):
+            key = event.__name__ if message is None else event.__name__ + "_" + message.__name__
+            self._batch_handlers[key] = func
+            return func
+
+        return decorator
+
+    def handle(self, body, signature):
+        with METRICS.stage("verify"):
+            payload = self.parser.parse(body, signature, as_payload=True)
+        targets = []
+        for event in payload.events:
+            func = self._find_handler(event)
+            if func is None:
+                logger.info(f"No handler of {event.__class__.__name__}")
+                continue
+            with METRICS.stage("dedup"):
+                event_id = self._mark(event)
+            if event_id is False:
+                continue
+            targets.append((func, event, event_id))
+
+        batches = {}
+        for func, event, event_id in targets:
+            batch_func = self._batch_handlers.get(self._key(event))
+            if batch_func is not None:
+                batches.setdefault(batch_func, []).append((event, event_id))
+        batches = {func: items for func, items in batches.items() if len(items) >= self.batch_min}
+
+        # 記録したまま処理（または dispatcher への登録）が終わっていない event_id
+        pending = {event_id for _, _, event_id in targets if event_id is not None}
+        done = set()
+        try:
+            for func, event, event_id in targets:
+                batch_func = self._batch_handlers.get(self._key(event))
+                if batch_func in batches:
+                    # まとめて処理するイベントは、最初のイベントの位置で処理する
+                    if batch_func not in done:
+                        done.add(batch_func)
+                        self._run_batch(batch_func, batches[batch_func], pending)
+                    continue
+                self._run(func, [(event, event_id)], pending, event)
+        except Exception:
+            # 失敗したイベントと、その後のまだ処理していないイベントは、LINEからの再送時に処理する
+            for event_id in pending:
+                self.deduplicator.forget(event_id)
+            raise
+
+    def _run(self, func, items, pending, *args):
+        user_id = getattr(getattr(items[0][0], "source", None), "user_id", None)
+        if self.dispatcher is None:
+            func(*args)
+        else:
+            self.dispatcher.submit(user_id, func, *args)
+        pending.difference_update(event_id for _, event_id in items)
+
+    def _run_batch(self, func, items, pending):
+        if self.dispatcher is None:
+            self._run(func, items, pending, [event for event, _ in items])
+            return
+        by_user = {}
+        for event, event_id in items:
+            user_id = getattr(getattr(event, "source", None), "user_id", None)
+            by_user.setdefault(user_id, []).append((event, event_id))
+        for user_items in by_user.values():
+            self._run(func, user_items, pending, [event for event, _ in user_items])
+
+    def _mark(self, event):
+        # 記録した event_id を返す。処理済みのイベントなら False、記録しなかった場合は None
+        if self.deduplicator is None:
+            return None
+        event_id = getattr(event, "webhook_event_id", None)
+        if event_id is None:
+            return None
+        context = getattr(event, "delivery_context", None)
+        redelivery = bool(getattr(context, "is_redelivery", False))
+        try:
+            if self.deduplicator.seen(event_id, redelivery):
+                logger.info(f"Skipping duplicate event {event_id}")
+                return False
+        except Exception as e:
+            # 重複の判定に失敗した場合はイベントを取りこぼさないよう処理を続ける
+            logger.error(f"Failed to check duplicate event {event_id}: {e}")
+            return None
+        return event_id
+
+    def _key(self, event):
+        if isinstance(event, MessageEvent):
+            return event.__class__.__name__ + "_" + event.message.__class__.__name__
+        return event.__class__.__name__
+
+    def _find_handler(self, event):
+        # WebhookHandler.handle と同じ規則でハンドラを探す
+        func = None
+        if isinstance(event, MessageEvent):
+            func = self._handlers.get(self._key(event))
+        if func is None:
+            func = self._handlers.get(event.__class__.__name__)
+        if func is None:
+            func = self._default
+        return func
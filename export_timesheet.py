@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+attendance テーブルから勤務時間（分）を計算して CSV / JSON Lines で出力する。
+
+サーバー側カーソル（名前付きカーソル）で少しずつ読み込み、1行ずつ計算して書き出すため、
+データ量が増えてもメモリ使用量は一定。--totals を指定すると、ユーザ・月ごとの合計を出力する。
+
+使い方:
+    python export_timesheet.py --from 2024-01-01 --to 2024-01-31 > 2024-01.csv
+    python export_timesheet.py --line-id U1234... --totals --format jsonl
+"""
+import argparse
+import csv
+import io
+import json
+import sys
+
+from dotenv import load_dotenv
+
+from db_pool import connect_from_env
+from validators import parse_time, validate_date
+
+
+ROW_FIELDS = (
+    "line_id", "name", "work_day", "work_start", "work_end",
+    "break_start", "break_end", "break_minutes", "worked_minutes"
+)
+TOTAL_FIELDS = ("line_id", "month", "days", "break_minutes", "worked_minutes")
+
+FETCH_SIZE = 2000
+
+
+def _minutes(value):
+    # time 型の列と 'HH:MM' 文字列の列のどちらにも対応する
+    if value is None:
+        return None
+    if hasattr(value, "hour"):
+        return value.hour * 60 + value.minute
+    parsed = parse_time(str(value))
+    if parsed is None:
+        return None
+    return parsed[0] * 60 + parsed[1]
+
+
+def _hhmm(value):
+    return "" if value is None else str(value)[:5]
+
+
+def _span(start, end):
+    # 日付をまたぐ場合（終了が開始より前）は翌日として数える
+    start = _minutes(start)
+    end = _minutes(end)
+    if start is None or end is None:
+        return None
+    if end < start:
+        end += 24 * 60
+    return end - start
+
+
+def worked_minutes(work_start, work_end, break_start, break_end):
+    """
+    (勤務時間, 休憩時間) を分で返す。出勤・退勤が読めない場合の勤務時間は None。
+    """
+    work = _span(work_start, work_end)
+    rest = _span(break_start, break_end) or 0
+    return (None if work is None else work - rest), rest
+
+
+def iter_rows(conn, line_id=None, date_from=None, date_to=None):
+    """
+    条件に合う勤怠を (line_id, 勤務日) 順に読み、勤務時間を付けた dict を1件ずつ返す。
+    """
+    conditions = []
+    params = []
+    if line_id:
+        conditions.append("line_id = %s")
+        params.append(line_id)
+    if date_from:
+        conditions.append("work_day >= %s")
+        params.append(date_from)
+    if date_to:
+        conditions.append("work_day <= %s")
+        params.append(date_to)
+    where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+
+    with conn.cursor(name="timesheet_export") as cur:
+        cur.itersize = FETCH_SIZE
+        cur.execute(
+            "SELECT line_id, name, work_day, work_start, work_end, break_start, break_end "
+            f"FROM attendance {where}ORDER BY line_id, work_day, work_start",
+            params
+        )
+        for line_id, name, work_day, work_start, work_end, break_start, break_end in cur:
+            worked, rest = worked_minutes(work_start, work_end, break_start, break_end)
+            yield {
+                "line_id": line_id,
+                "name": name,
+                "work_day": str(work_day),
+                "work_start": _hhmm(work_start),
+                "work_end": _hhmm(work_end),
+                "break_start": _hhmm(break_start),
+                "break_end": _hhmm(break_end),
+                "break_minutes": rest,
+                "worked_minutes": worked,
+            }
+
+
+def iter_totals(rows):
+    """
+    (line_id, 勤務日) 順の行から、ユーザ・月ごとの合計を順に返す。
+    """
+    current = None
+    for row in rows:
+        key = (row["line_id"], row["work_day"][:7])
+        if current is None or current["key"] != key:
+            if current is not None:
+                yield _total(current)
+            current = {"key": key, "days": set(), "break_minutes": 0, "worked_minutes": 0}
+        current["days"].add(row["work_day"])
+        current["break_minutes"] += row["break_minutes"]
+        current["worked_minutes"] += row["worked_minutes"] or 0
+    if current is not None:
+        yield _total(current)
+
+
+def _total(current):
+    return {
+        "line_id": current["key"][0],
+        "month": current["key"][1],
+        "days": len(current["days"]),
+        "break_minutes": current["break_minutes"],
+        "worked_minutes": current["worked_minutes"],
+    }
+
+
+def render(records, fields, fmt):
+    """
+    dict の反復子を CSV / JSON Lines の文字列片にして1行ずつ返す。
+    """
+    if fmt == "jsonl":
+        for record in records:
+            yield json.dumps(record, ensure_ascii=False) + "\n"
+        return
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields)
+    writer.writeheader()
+    for record in records:
+        writer.writerow(record)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export(conn, fmt="csv", totals=False, line_id=None, date_from=None, date_to=None):
+    """
+    出力内容を文字列片で1つずつ返す（Flask のストリーミング応答でも使う）。
+    """
+    rows = iter_rows(conn, line_id=line_id, date_from=date_from, date_to=date_to)
+    if totals:
+        return render(iter_totals(rows), TOTAL_FIELDS, fmt)
+    return render(rows, ROW_FIELDS, fmt)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export worked minutes from attendance")
+    parser.add_argument("--line-id")
+    parser.add_argument("--from", dest="date_from", help="first work_day (YYYY-MM-DD)")
+    parser.add_argument("--to", dest="date_to", help="last work_day (YYYY-MM-DD)")
+    parser.add_argument("--format", choices=["csv", "jsonl"], default="csv")
+    parser.add_argument("--totals", action="store_true", help="monthly totals per line_id")
+    args = parser.parse_args(argv)
+
+    for value in (args.date_from, args.date_to):
+        if value is not None and validate_date(value) is None:
+            parser.error(f"invalid date: {value}")
+
+    load_dotenv()
+    conn = connect_from_env()
+    try:
+        date_from = args.date_from and validate_date(args.date_from)
+        date_to = args.date_to and validate_date(args.date_to)
+        for chunk in export(conn, args.format, args.totals, args.line_id, date_from, date_to):
+            sys.stdout.write(chunk)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
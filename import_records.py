@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+CSV / Excel から勤怠・休暇の過去データを一括で取り込む。
+
+ファイルを chunk 行ずつ読み込んで COPY で書き込み、chunk ごとに進捗（取り込み済み行数）を
+同じトランザクションで import_checkpoint テーブルに記録する。途中で止まっても、
+同じコマンドを再実行すると続きから取り込む。不正な行は理由を付けて reject ファイルに書き出す。
+取り込んだ日の集計（worked_daily / worked_monthly）も chunk ごとに同じトランザクションで更新する。
+大量の取り込みでは --no-rollup を付け、取り込み後に rollup.py rebuild で作り直すと速い。
+
+使い方:
+    python import_records.py attendance timesheet.csv --line-id U1234...
+    python import_records.py vacation vacation.xlsx --rejects vacation_rejects.csv
+"""
+import argparse
+import csv
+import io
+import os
+import sys
+import time
+from datetime import date, datetime
+from datetime import time as dt_time
+
+from dotenv import load_dotenv
+
+import rollup
+from db_pool import connect_from_env
+from validators import validate_date, validate_time
+
+# テーブルごとの列と、各列の検証方法（"date" / "time" / "text" / "optional" / "optional_time"）
+# optional / optional_time は空でもよい列（空のセルは NULL にする）
+TABLES = {
+    "attendance": (
+        ("name", "text"),
+        ("work_day", "date"),
+        ("work_start", "time"),
+        ("work_end", "time"),
+        ("break_start", "optional_time"),
+        ("break_end", "optional_time"),
+        ("work_summary", "optional"),
+        ("device", "text"),
+        ("line_id", "text"),
+    ),
+    "vacation": (
+        ("vacation_date", "date"),
+        ("vacation_type", "text"),
+        ("line_id", "text"),
+    ),
+}
+
+# 見出しの日本語表記（チャットの確認文と同じもの）
+HEADER_ALIASES = {
+    "名前": "name",
+    "勤務日": "work_day",
+    "出勤時間": "work_start",
+    "退勤時間": "work_end",
+    "休憩開始時間": "break_start",
+    "休憩終了時間": "break_end",
+    "業務日報": "work_summary",
+    "勤怠打刻デバイス": "device",
+    "休暇日": "vacation_date",
+    "休暇種類": "vacation_type",
+    "LINE ID": "line_id",
+}
+
+VALIDATORS = {"date": validate_date, "time": validate_time, "optional_time": validate_time}
+OPTIONAL_KINDS = ("optional", "optional_time")
+
+
+class RowError(Exception):
+    pass
+
+
+def _cell_text(value):
+    # Excelのセルは日付・時刻・数値で届くことがあるため文字列にそろえる
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        if value.time() == dt_time(0, 0):
+            return value.strftime("%Y-%m-%d")
+        return value.strftime("%H:%M")
+    if isinstance(value, date):
+        return value.strftime("%Y-%m-%d")
+    if isinstance(value, dt_time):
+        return value.strftime("%H:%M")
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+
+def read_rows(path, encoding):
+    """
+    ファイルを1行ずつ読み、(見出し, 行の反復子) を返す。Excelは openpyxl の read_only で読む。
+    """
+    if path.lower().endswith((".xlsx", ".xlsm")):
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            raise SystemExit("Excel files require openpyxl (pip install openpyxl)")
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [_cell_text(v) for v in next(rows, ())]
+        return header, ([_cell_text(v) for v in row] for row in rows)
+
+    f = open(path, newline="", encoding=encoding)
+    reader = csv.reader(f)
+    header = [v.strip() for v in next(reader, [])]
+
+    def rows():
+        with f:
+            yield from reader
+
+    return header, rows()
+
+
+def build_mapping(table, header):
+    """
+    テーブルの各列がファイルの何列目にあるかを返す。
+    """
+    names = [HEADER_ALIASES.get(h, h) for h in header]
+    return {column: names.index(column) for column, _ in TABLES[table] if column in names}
+
+
+def convert_row(table, mapping, row, defaults):
+    values = []
+    for column, kind in TABLES[table]:
+        index = mapping.get(column)
+        text = row[index].strip() if index is not None and index < len(row) else ""
+        if not text:
+            text = defaults.get(column, "")
+        if not text and kind == "optional_time":
+            value = None
+        elif kind in VALIDATORS:
+            value = VALIDATORS[kind](text)
+            if value is None:
+                raise RowError(f"invalid {column}: {text!r}")
+        elif kind == "text" and not text:
+            raise RowError(f"missing {column}")
+        else:
+            value = text
+        values.append(value)
+    return values
+
+
+def _ensure_checkpoint_table(cur):
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS import_checkpoint ("
+        "source TEXT PRIMARY KEY, "
+        "rows_done BIGINT NOT NULL, "
+        "updated_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+    )
+
+
+def load_checkpoint(conn, source):
+    with conn.cursor() as cur:
+        _ensure_checkpoint_table(cur)
+        cur.execute("SELECT rows_done FROM import_checkpoint WHERE source = %s", (source,))
+        row = cur.fetchone()
+    conn.commit()
+    return row[0] if row else 0
+
+
+def copy_chunk(conn, table, buffer, source, rows_done, refresh_rollup=True):
+    """
+    chunk を一時テーブルへ COPY してから本テーブルへ移し、進捗と一緒にコミットする。
+    主キーが重複する行（取り込み済みの行）は読み飛ばすため、同じファイルを再度取り込んでも増えない。
+    refresh_rollup が真の場合は、chunk に含まれる日の集計も計算し直す。
+    """
+    columns = ", ".join(column for column, _ in TABLES[table])
+    stage = f"import_stage_{table}"
+    buffer.seek(0)
+    with conn.cursor() as cur:
+        cur.execute(
+            f"CREATE TEMP TABLE IF NOT EXISTS {stage} "
+            f"(LIKE {table} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS"
+        )
+        cur.copy_expert(f"COPY {stage} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+        cur.execute(
+            f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {stage} "
+            f"ON CONFLICT DO NOTHING"
+        )
+        if refresh_rollup:
+            cur.execute(f"SELECT DISTINCT line_id, {rollup.DAY_COLUMNS[table]} FROM {stage}")
+            rollup.refresh(cur, set(cur.fetchall()))
+        cur.execute(
+            "INSERT INTO import_checkpoint (source, rows_done) VALUES (%s, %s) "
+            "ON CONFLICT (source) DO UPDATE SET rows_done = EXCLUDED.rows_done, updated_at = now()",
+            (source, rows_done)
+        )
+    conn.commit()
+
+
+def run_import(conn, table, path, defaults, rejects_path, chunk_size=10000,
+               encoding="utf-8-sig", source=None, out=sys.stderr, refresh_rollup=True):
+    """
+    ファイルを取り込み、(取り込んだ行数, 不正な行数) を返す。
+    """
+    source = source or f"{table}:{os.path.abspath(path)}"
+    header, rows = read_rows(path, encoding)
+    mapping = build_mapping(table, header)
+    missing = [
+        column for column, kind in TABLES[table]
+        if kind not in OPTIONAL_KINDS and column not in mapping and column not in defaults
+    ]
+    if missing:
+        raise SystemExit(f"missing columns in {path}: {', '.join(missing)}")
+
+    skip = load_checkpoint(conn, source)
+    if skip:
+        print(f"resuming {source} after {skip} rows", file=out)
+
+    rejects_file = open(rejects_path, "a", newline="", encoding="utf-8")
+    rejects = csv.writer(rejects_file)
+    # 不正な行はコミット後に書き出す（再開時に同じ行を二重に書かないため）
+    chunk_rejects = []
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    pending = 0
+    rows_done = 0
+    loaded = 0
+    rejected = 0
+    started = time.monotonic()
+    try:
+        for row in rows:
+            rows_done += 1
+            if rows_done <= skip:
+                continue
+            try:
+                writer.writerow(convert_row(table, mapping, row, defaults))
+                pending += 1
+            except RowError as e:
+                chunk_rejects.append([rows_done, str(e)] + list(row))
+                rejected += 1
+            if pending >= chunk_size:
+                copy_chunk(conn, table, buffer, source, rows_done, refresh_rollup)
+                rejects.writerows(chunk_rejects)
+                rejects_file.flush()
+                chunk_rejects.clear()
+                loaded += pending
+                pending = 0
+                buffer.seek(0)
+                buffer.truncate()
+                elapsed = time.monotonic() - started
+                print(f"{rows_done} rows read, {loaded} loaded, {rejected} rejected "
+                      f"({loaded / elapsed:,.0f} rows/s)", file=out)
+        copy_chunk(conn, table, buffer, source, rows_done, refresh_rollup)
+        rejects.writerows(chunk_rejects)
+        loaded += pending
+    finally:
+        rejects_file.close()
+        rows.close()
+
+    elapsed = time.monotonic() - started
+    print(f"done: {loaded} rows loaded, {rejected} rejected in {elapsed:.1f}s "
+          f"({loaded / elapsed if elapsed else 0:,.0f} rows/s)", file=out)
+    return loaded, rejected
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import attendance / vacation records from CSV or Excel")
+    parser.add_argument("table", choices=sorted(TABLES))
+    parser.add_argument("path")
+    parser.add_argument("--line-id", help="line_id for files that do not have the column")
+    parser.add_argument("--device", default="IMPORT", help="device for attendance rows (default: IMPORT)")
+    parser.add_argument("--rejects", help="reject file (default: <path>.rejects.csv)")
+    parser.add_argument("--chunk", type=int, default=10000, help="rows per COPY / checkpoint")
+    parser.add_argument("--encoding", default="utf-8-sig", help="CSV encoding, e.g. cp932")
+    parser.add_argument("--no-rollup", action="store_true",
+                        help="skip worked_daily / worked_monthly updates (run rollup.py rebuild afterwards)")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    defaults = {}
+    if args.line_id:
+        defaults["line_id"] = args.line_id
+    if args.table == "attendance":
+        defaults["device"] = args.device
+
+    conn = connect_from_env()
+    try:
+        run_import(
+            conn, args.table, args.path, defaults,
+            args.rejects or args.path + ".rejects.csv",
+            chunk_size=args.chunk, encoding=args.encoding, refresh_rollup=not args.no_rollup
+        )
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+処理段階ごとの所要時間のヒストグラムとカウンタを集計し、Prometheus のテキスト形式で出力する。
+
+stage() で囲んだ区間の時間を inout_stage_seconds{stage=...} に記録する。
+trace() の中で実行された区間は1件の処理としてまとめ、slow_seconds を超えた場合は
+区間ごとの内訳をログに出す。
+"""
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+logger = logging.getLogger(__name__)
+
+# 実行中の trace() の区間の一覧（スレッドごと・asyncio のタスクごとに別になる）
+_current_stages = ContextVar("current_stages", default=None)
+
+# ヒストグラムの区切り（秒）
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels_text(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    ラベルの組み合わせごとに増え続ける値。
+    """
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels_text(self.labels, label_values)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    """
+    ラベルの組み合わせごとの値の分布。quantile() は区切りの間を線形補間して分位点を推定する。
+    """
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # ラベル -> [区切りごとの件数..., 上限超えの件数], 合計, 件数
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def quantile(self, q, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None or not series[2]:
+                return None
+            counts = list(series[0])
+            total = series[2]
+        rank = q * total
+        seen = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            if count and seen + count >= rank:
+                if bound == float("inf"):
+                    return lower
+                return lower + (bound - lower) * (rank - seen) / count
+            seen += count
+            lower = bound
+        return lower
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = sorted((k, list(v[0]), v[1], v[2]) for k, v in self._series.items())
+        names = self.labels + ("le",)
+        for label_values, counts, total, count in snapshot:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                lines.append(
+                    f"{self.name}_bucket{_labels_text(names, label_values + (_number(bound),))} {cumulative}"
+                )
+            labels = _labels_text(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {_number(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+    def render_quantiles(self, name):
+        # PromQL を使わずに分位点を見られるよう、推定値をゲージとしても出力する
+        lines = [
+            f"# HELP {name} Estimated quantiles of {self.name}",
+            f"# TYPE {name} gauge",
+        ]
+        with self._lock:
+            keys = sorted(self._series)
+        names = self.labels + ("quantile",)
+        for label_values in keys:
+            for q in QUANTILES:
+                value = self.quantile(q, *label_values)
+                if value is not None:
+                    lines.append(f"{name}{_labels_text(names, label_values + (q,))} {_number(value)}")
+        return lines
+
+
+class Registry:
+    """
+    メトリクスと、stats() の辞書をゲージとして出力する collector をまとめる。
+    """
+
+    def __init__(self, prefix="inout"):
+        self.prefix = prefix
+        self._metrics = []
+        self._collectors = []
+        self.slow_seconds = None
+        self.stage_seconds = self.histogram(
+            "stage_seconds", "Time spent in each stage of webhook handling", ("stage",)
+        )
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(f"{self.prefix}_{name}", help, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(f"{self.prefix}_{name}", help, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_stats(self, component, func):
+        """
+        func() が返す辞書の数値を inout_<component>_<キー> のゲージとして出力する。
+        """
+        self._collectors.append((component, func))
+
+    @contextmanager
+    def trace(self, name):
+        """
+        1件の処理（Webhookリクエストやイベント）の区間。入れ子になった場合は外側にまとめる。
+        """
+        if _current_stages.get() is not None:
+            with self.stage(name):
+                yield
+            return
+        stages = []
+        token = _current_stages.set(stages)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            _current_stages.reset(token)
+            self.stage_seconds.observe(elapsed, name)
+            if self.slow_seconds is not None and elapsed >= self.slow_seconds:
+                breakdown = " ".join(f"{stage}={seconds * 1000:.1f}ms" for stage, seconds in stages)
+                logger.warning(f"Slow {name}: {elapsed * 1000:.1f}ms ({breakdown})")
+
+    @contextmanager
+    def stage(self, name):
+        """
+        区間の時間を記録する。trace() の中であれば内訳にも加える。
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.stage_seconds.observe(elapsed, name)
+            stages = _current_stages.get()
+            if stages is not None:
+                stages.append((name, elapsed))
+
+    def render(self):
+        """
+        Prometheus のテキスト形式で全メトリクスを返す。
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+            if isinstance(metric, Histogram):
+                lines.extend(metric.render_quantiles(f"{metric.name}_quantile"))
+        for component, func in self._collectors:
+            try:
+                stats = func()
+            except Exception as e:
+                logger.error(f"Failed to collect {component} stats: {e}")
+                continue
+            for key, value in stats.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                name = f"{self.prefix}_{component}_{key}"
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+# アプリ全体で共有するレジストリ
+METRICS = Registry()
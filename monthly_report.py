@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+「確認」コマンドで返す、ユーザの今月の登録内容（勤怠・休暇と合計勤務時間）。
+
+同じ月の内容は月末に繰り返し確認されるため、(line_id, 月) ごとに返信文をキャッシュする。
+保存処理は保存した月のキャッシュを無効にする。キャッシュはプロセスごとに持つため、
+複数ワーカーの場合は他のワーカーでの保存は ttl 秒以内に反映される。
+"""
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+
+from export_timesheet import worked_minutes
+
+
+ATTENDANCE_SQL = (
+    "SELECT work_day, work_start, work_end, break_start, break_end FROM attendance "
+    "WHERE line_id = %s AND work_day >= %s AND work_day < %s ORDER BY work_day, work_start"
+)
+VACATION_SQL = (
+    "SELECT vacation_date, vacation_type FROM vacation "
+    "WHERE line_id = %s AND vacation_date >= %s AND vacation_date < %s ORDER BY vacation_date"
+)
+
+
+def month_range(month):
+    """
+    'YYYY-MM' から (月初, 翌月初) の date を返す。
+    """
+    first = date(int(month[:4]), int(month[5:7]), 1)
+    if first.month == 12:
+        return first, date(first.year + 1, 1, 1)
+    return first, date(first.year, first.month + 1, 1)
+
+
+def _hhmm(value):
+    return "--:--" if value is None else str(value)[:5]
+
+
+def _mmdd(value):
+    return str(value)[5:].replace('-', '/')
+
+
+def _duration(templates, minutes):
+    return templates.render("monthly.duration", hours=minutes // 60, minutes=minutes % 60)
+
+
+def format_month(month, attendance, vacation, templates):
+    """
+    勤怠 (work_day, work_start, work_end, break_start, break_end) と
+    休暇 (vacation_date, vacation_type) の行から、templates（ReplyTemplates）の言語で返信文を作る。
+    """
+    lines = [templates.render("monthly.title", year=int(month[:4]), month=int(month[5:7]))]
+    days = set()
+    total = 0
+    for work_day, work_start, work_end, break_start, break_end in attendance:
+        worked, rest = worked_minutes(work_start, work_end, break_start, break_end)
+        days.add(work_day)
+        total += worked or 0
+        lines.append(templates.render(
+            "monthly.day", day=_mmdd(work_day), start=_hhmm(work_start), end=_hhmm(work_end),
+            rest=rest, worked="-" if worked is None else _duration(templates, worked)
+        ))
+    if not attendance:
+        lines.append(templates.text("monthly.no_attendance"))
+    if vacation:
+        lines.append(templates.text("monthly.vacation"))
+        for vacation_date, vacation_type in vacation:
+            lines.append(f"{_mmdd(vacation_date)} {vacation_type}")
+    lines.append(templates.render("monthly.total", days=len(days), worked=_duration(templates, total)))
+    return "\n".join(lines)
+
+
+def load_month(conn, line_id, month, templates):
+    """
+    ユーザの指定月の勤怠・休暇を読み込み、templates の言語で返信文を返す。
+    """
+    first, following = month_range(month)
+    with conn.cursor() as cur:
+        cur.execute(ATTENDANCE_SQL, (line_id, first, following))
+        attendance = cur.fetchall()
+        cur.execute(VACATION_SQL, (line_id, first, following))
+        vacation = cur.fetchall()
+    conn.commit()
+    return format_month(month, attendance, vacation, templates)
+
+
+class MonthlyCache:
+    """
+    (line_id, 月) -> 返信文 の読み込み時キャッシュ。
+    最終読み込みから ttl 秒経過したものと、max_entries を超えた最も古いものを破棄する。
+    """
+
+    def __init__(self, ttl=300, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # (line_id, 月) -> (期限, 返信文)。先頭ほど最近使われていない
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # 無効化のたびに増やす。読み込み中に無効化された結果はキャッシュしない
+        self._generation = 0
+
+        # メトリクス
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+        self._loads = 0
+        self._load_total = 0.0
+        self._load_max = 0.0
+
+    def get(self, line_id, month):
+        """
+        キャッシュされた返信文を返す。ない場合は None。
+        """
+        key = (line_id, month)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[1]
+
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    def put(self, line_id, month, text, generation):
+        """
+        generation() を取得した後に無効化がなければ、返信文をキャッシュする。
+        """
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[(line_id, month)] = (time.monotonic() + self.ttl, text)
+            self._entries.move_to_end((line_id, month))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def record_load(self, seconds):
+        with self._lock:
+            self._loads += 1
+            self._load_total += seconds
+            if seconds > self._load_max:
+                self._load_max = seconds
+
+    def fetch(self, line_id, month, loader):
+        """
+        キャッシュになければ loader() で読み込み、キャッシュして返す。
+        """
+        text = self.get(line_id, month)
+        if text is not None:
+            return text
+        generation = self.generation()
+        started = time.monotonic()
+        text = loader()
+        self.record_load(time.monotonic() - started)
+        self.put(line_id, month, text, generation)
+        return text
+
+    def invalidate(self, line_id, month):
+        with self._lock:
+            self._generation += 1
+            self._invalidations += 1
+            self._entries.pop((line_id, month), None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / lookups if lookups else 0.0,
+                "invalidations": self._invalidations,
+                "loads": self._loads,
+                "load_seconds_avg": self._load_total / self._loads if self._loads else 0.0,
+                "load_seconds_max": self._load_max,
+            }
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+メッセージを送りすぎるユーザ（または不具合のあるクライアント）からのイベントを、
+状態の読み込みやデータベース・LINE APIの呼び出しの前に止める。
+
+- UserRateLimiter: ユーザごとのトークンバケット（rate 件/秒、最大 burst 件）
+- ConcurrencyLimiter: 同時に処理するイベント数の上限
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class UserRateLimiter:
+    """
+    ユーザごとのトークンバケット。check() はイベントを処理してよいかと、
+    制限中であることをユーザに知らせるかどうか（制限されてから最初の1件のみ True）を返す。
+
+    バケットは最後に使われた順に並べ、満タンに戻るだけの時間が経ったものから破棄する
+    （破棄しても満タンのバケットと同じ扱いになる）。max_entries を超えた場合も古いものから破棄する。
+    """
+
+    def __init__(self, rate=1.0, burst=10, max_entries=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_entries = max_entries
+        # 満タンに戻るまでの秒数
+        self._refill_seconds = burst / rate
+        # user_id -> [残りトークン, 更新時刻, 制限を通知済みか]。先頭ほど最近使われていない
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+        # メトリクス
+        self._allowed = 0
+        self._throttled = 0
+        self._capacity_evictions = 0
+
+    def _sweep(self, now):
+        while self._buckets:
+            bucket = next(iter(self._buckets.values()))
+            if now - bucket[1] < self._refill_seconds:
+                break
+            self._buckets.popitem(last=False)
+
+    def check(self, user_id):
+        """
+        (処理してよいか, 制限中の通知をするか) を返す。
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._sweep(now)
+            bucket = self._buckets.get(user_id)
+            if bucket is None:
+                bucket = self._buckets[user_id] = [float(self.burst), now, False]
+                if len(self._buckets) > self.max_entries:
+                    self._buckets.popitem(last=False)
+                    self._capacity_evictions += 1
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+                self._buckets.move_to_end(user_id)
+            if bucket[0] >= 1.0:
+                bucket[0] -= 1.0
+                bucket[2] = False
+                self._allowed += 1
+                return True, False
+            notify = not bucket[2]
+            bucket[2] = True
+            self._throttled += 1
+            return False, notify
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._buckets),
+                "max_entries": self.max_entries,
+                "allowed": self._allowed,
+                "throttled": self._throttled,
+                "capacity_evictions": self._capacity_evictions,
+            }
+
+
+class ConcurrencyLimiter:
+    """
+    同時に処理するイベントを limit 件までにする。acquire() は空きを timeout 秒まで待ち、
+    取れなかった場合は False を返す。
+    """
+
+    def __init__(self, limit=32, timeout=1.0):
+        self.limit = limit
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(limit)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._in_flight_max = 0
+        self._rejected = 0
+
+    def acquire(self):
+        return self._record(self._slots.acquire(timeout=self.timeout))
+
+    def _record(self, acquired):
+        with self._lock:
+            if not acquired:
+                self._rejected += 1
+                return False
+            self._in_flight += 1
+            if self._in_flight > self._in_flight_max:
+                self._in_flight_max = self._in_flight
+        return True
+
+    def release(self):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "limit": self.limit,
+                "in_flight": self._in_flight,
+                "in_flight_max": self._in_flight_max,
+                "rejected": self._rejected,
+            }
+
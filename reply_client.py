@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+"""
+LINEへの返信をまとめて扱う。
+
+- 一時的な失敗（接続エラー、タイムアウト、429、5xx）は揺らぎ付きの指数バックオフで再試行する
+  （返信は retry key がなく二重に届くため、LINEに届いた可能性のある読み込みのタイムアウトなどは再試行しない）
+- 失敗が続いた場合はサーキットブレーカーを開き、reset_timeout 秒の間は呼び出さない
+  （応答しないAPIに処理スレッドが溜まり続けないようにする）
+- 応答トークンが期限切れの場合（処理に時間がかかった場合）はプッシュメッセージで送る
+- messages に PreparedReply（JSON変換済み）を渡した場合は、pydantic のモデルを作らずに
+  本文を組み立て、line-bot-sdk の接続プールでそのまま送る（raw_json=False の場合はモデルに戻す）
+"""
+import asyncio
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+
+import urllib3
+from linebot.v3.messaging import ApiException, PushMessageRequest, ReplyMessageRequest
+from urllib3.exceptions import ConnectTimeoutError, HTTPError, MaxRetryError
+
+from reply_templates import PreparedReply
+
+
+logger = logging.getLogger(__name__)
+
+# 失敗の分類
+_RETRY = "retry"
+_EXPIRED = "expired"
+_FAIL = "fail"
+
+# 送信方法ごとのパスと、本文の宛先のキー
+_PATHS = {"reply": "/v2/bot/message/reply", "push": "/v2/bot/message/push"}
+_TARGET_KEYS = {"reply": b'{"replyToken":', "push": b'{"to":'}
+
+
+def _classify(error, transient):
+    if isinstance(error, ApiException):
+        status = error.status or 0
+        body = error.body or b""
+        if isinstance(body, bytes):
+            body = body.decode("utf-8", "replace")
+        if status == 400 and "reply token" in body.lower():
+            return _EXPIRED
+        if status == 0 or status == 429 or status >= 500:
+            return _RETRY
+        return _FAIL
+    if isinstance(error, transient):
+        return _RETRY
+    return _FAIL
+
+
+class CircuitBreaker:
+    """
+    threshold 回続けて失敗すると開き、reset_timeout 秒後に1件だけ試す（半開）。
+    試した1件が成功すれば閉じ、失敗すれば再び開く。
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, threshold=5, reset_timeout=30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial = False
+        self._lock = threading.Lock()
+        self.opens = 0
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._trial = False
+            if self.state == self.HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.threshold:
+                if self.state != self.OPEN:
+                    self.opens += 1
+                    logger.warning(f"LINE API circuit opened after {self._failures} failures")
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class ReplyClient:
+    """
+    MessagingApi で返信する。reply() は結果を "replied" / "pushed" / "failed" / "rejected"
+    （ブレーカーが開いていて送らなかった）のいずれかで返し、例外は送出しない。
+    """
+
+    # 一時的な失敗とみなす例外（ApiException 以外）
+    TRANSIENT = (OSError, HTTPError)
+    # 接続の確立前の失敗（リクエストがLINEに届いていない）とみなす例外
+    CONNECT_ERRORS = (ConnectTimeoutError, ConnectionRefusedError)
+
+    def __init__(self, messaging_api, timeout=(3.0, 10.0), retries=2, backoff=0.2,
+                 max_backoff=2.0, breaker=None, push_fallback=True, token_ttl=50.0, raw_json=True):
+        self.api = messaging_api
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.push_fallback = push_fallback
+        self.token_ttl = token_ttl
+        self.raw_json = raw_json
+        self._headers = None
+        self._lock = threading.Lock()
+        self._counts = {"replied": 0, "pushed": 0, "failed": 0, "rejected": 0, "retries": 0}
+
+    def _count(self, key):
+        with self._lock:
+            self._counts[key] += 1
+
+    def _delay(self, attempt):
+        # full jitter: 0 から上限までの一様乱数
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+
+    def _token_expired(self, event_time):
+        # event_time は Webhook イベントの timestamp（ミリ秒）
+        return event_time is not None and time.time() - event_time / 1000 > self.token_ttl
+
+    def _plan(self, reply_token, user_id, messages, event_time):
+        # 最初に使う (送信方法, リクエスト) を返す
+        if self.push_fallback and user_id and self._token_expired(event_time):
+            return "push", self._request("push", user_id, messages)
+        return "reply", self._request("reply", reply_token, messages)
+
+    def _request(self, method, target, messages):
+        # PreparedReply は本文の bytes、それ以外は line-bot-sdk のリクエストにする
+        if isinstance(messages, PreparedReply):
+            if self.raw_json:
+                return (_TARGET_KEYS[method] + json.dumps(target).encode("ascii")
+                        + b',"messages":' + messages.json + b"}")
+            messages = messages.models()
+        if method == "reply":
+            return ReplyMessageRequest(reply_token=target, messages=messages)
+        return PushMessageRequest(to=target, messages=messages)
+
+    def _raw_headers(self, retry_key=None):
+        # 認証などのヘッダーは最初の送信時に line-bot-sdk の設定から作る
+        if self._headers is None:
+            client = self.api.api_client
+            headers = {**client.default_headers, "Content-Type": "application/json"}
+            client.update_params_for_auth(headers, [], ["Bearer"], _PATHS["reply"], "POST", None)
+            self._headers = headers
+        if retry_key is None:
+            return self._headers
+        return {**self._headers, "X-Line-Retry-Key": retry_key}
+
+    def _post(self, method, body, retry_key):
+        from linebot.v3.messaging.rest import RESTResponse
+
+        connect, read = self.timeout
+        response = self.api.api_client.rest_client.pool_manager.request(
+            "POST", self.api.line_base_path + _PATHS[method], body=body,
+            headers=self._raw_headers(retry_key if method == "push" else None),
+            timeout=urllib3.Timeout(connect=connect, read=read)
+        )
+        if not 200 <= response.status <= 299:
+            raise ApiException(http_resp=RESTResponse(response))
+
+    def _send(self, method, request, retry_key):
+        if isinstance(request, bytes):
+            self._post(method, request, retry_key)
+        elif method == "reply":
+            self.api.reply_message(request, _request_timeout=self.timeout)
+        else:
+            # 再試行しても二重に送られないよう同じ retry key を使う
+            self.api.push_message(request, x_line_retry_key=retry_key, _request_timeout=self.timeout)
+
+    def _unsent(self, error):
+        # LINEがリクエストを処理していないことが確実なら True（接続前の失敗と 429）
+        if isinstance(error, ApiException):
+            return error.status in (None, 0, 429)
+        if isinstance(error, MaxRetryError):
+            error = error.reason
+        return isinstance(error, self.CONNECT_ERRORS)
+
+    def _handle_error(self, error, attempt, method, delivered):
+        """
+        次の動作（_RETRY / _EXPIRED / _FAIL）を返す。delivered は同じ返信の以前の試行が
+        LINEに届いた可能性があるかどうか。
+        """
+        kind = _classify(error, self.TRANSIENT)
+        if kind == _EXPIRED and delivered:
+            # 以前の試行で応答トークンが使われた可能性があるため、プッシュで二重に送らない
+            kind = _FAIL
+        if kind != _RETRY:
+            # APIは応答しているのでブレーカーには成功として数える
+            self.breaker.record_success()
+            return kind
+        self.breaker.record_failure()
+        if method == "reply" and not self._unsent(error) and not (
+                isinstance(error, ApiException) and error.status >= 500):
+            # 届いたか分からない返信（読み込みのタイムアウトなど）は再送しない
+            return _FAIL
+        if attempt >= self.retries or not self.breaker.allow():
+            return _FAIL
+        self._count("retries")
+        return kind
+
+    def _fail(self, method, user_id, error):
+        logger.error(f"Failed to {method} to {user_id}: {error}")
+        self._count("failed")
+        return "failed"
+
+    def reply(self, reply_token, user_id, messages, event_time=None):
+        if not self.breaker.allow():
+            logger.warning(f"LINE API circuit is open, dropping reply to {user_id}")
+            self._count("rejected")
+            return "rejected"
+        method, request = self._plan(reply_token, user_id, messages, event_time)
+        retry_key = str(uuid.uuid4())
+        attempt = 0
+        delivered = False
+        while True:
+            try:
+                self._send(method, request, retry_key)
+                result = "replied" if method == "reply" else "pushed"
+                self.breaker.record_success()
+                self._count(result)
+                return result
+            except Exception as e:
+                if method == "push" and isinstance(e, ApiException) and e.status == 409:
+                    # 同じ retry key の送信は受付済み
+                    self.breaker.record_success()
+                    self._count("pushed")
+                    return "pushed"
+                kind = self._handle_error(e, attempt, method, delivered)
+                delivered = delivered or (method == "reply" and not self._unsent(e))
+                if kind == _EXPIRED and self.push_fallback and user_id and method == "reply":
+                    logger.info(f"Reply token expired, pushing to {user_id}")
+                    method, request = "push", self._request("push", user_id, messages)
+                    continue
+                if kind != _RETRY:
+                    return self._fail(method, user_id, e)
+                time.sleep(self._delay(attempt))
+                attempt += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+        stats["circuit_open"] = 0 if self.breaker.state == CircuitBreaker.CLOSED else 1
+        stats["circuit_opens"] = self.breaker.opens
+        return stats
+
+
+class AsyncReplyClient(ReplyClient):
+    """
+    AsyncMessagingApi 用の ReplyClient。
+    """
+
+    def __init__(self, messaging_api, **kwargs):
+        super().__init__(messaging_api, **kwargs)
+        from aiohttp import ClientConnectorError, ClientError, ClientTimeout
+
+        self.TRANSIENT = (OSError, HTTPError, ClientError, asyncio.TimeoutError)
+        self.CONNECT_ERRORS = (ClientConnectorError, ConnectionRefusedError)
+        connect, read = self.timeout
+        self._client_timeout = ClientTimeout(total=connect + read, connect=connect)
+
+    async def _post(self, method, body, retry_key):
+        from linebot.v3.messaging.async_rest import RESTResponse
+
+        async with self.api.api_client.rest_client.pool_manager.request(
+            "POST", self.api.line_base_path + _PATHS[method], data=body,
+            headers=self._raw_headers(retry_key if method == "push" else None),
+            timeout=self._client_timeout
+        ) as response:
+            data = await response.read()
+            if not 200 <= response.status <= 299:
+                raise ApiException(http_resp=RESTResponse(response, data))
+
+    async def _send(self, method, request, retry_key):
+        if isinstance(request, bytes):
+            await self._post(method, request, retry_key)
+        elif method == "reply":
+            await self.api.reply_message(request, _request_timeout=self._client_timeout)
+        else:
+            await self.api.push_message(request, x_line_retry_key=retry_key,
+                                        _request_timeout=self._client_timeout)
+
+    async def reply(self, reply_token, user_id, messages, event_time=None):
+        if not self.breaker.allow():
+            logger.warning(f"LINE API circuit is open, dropping reply to {user_id}")
+            self._count("rejected")
+            return "rejected"
+        method, request = self._plan(reply_token, user_id, messages, event_time)
+        retry_key = str(uuid.uuid4())
+        attempt = 0
+        delivered = False
+        while True:
+            try:
+                await self._send(method, request, retry_key)
+                result = "replied" if method == "reply" else "pushed"
+                self.breaker.record_success()
+                self._count(result)
+                return result
+            except Exception as e:
+                if method == "push" and isinstance(e, ApiException) and e.status == 409:
+                    self.breaker.record_success()
+                    self._count("pushed")
+                    return "pushed"
+                kind = self._handle_error(e, attempt, method, delivered)
+                delivered = delivered or (method == "reply" and not self._unsent(e))
+                if kind == _EXPIRED and self.push_fallback and user_id and method == "reply":
+                    logger.info(f"Reply token expired, pushing to {user_id}")
+                    method, request = "push", self._request("push", user_id, messages)
+                    continue
+                if kind != _RETRY:
+                    return self._fail(method, user_id, e)
+                await asyncio.sleep(self._delay(attempt))
+                attempt += 1
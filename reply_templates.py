@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+返信文のテンプレート（言語ごと）と、JSONに変換済みの返信メッセージ。
+
+入力ステップの案内やエラーなどの固定の文は、ReplyTemplates の作成時に LINE API の
+messages 配列の JSON にしておく。返信のたびに TextMessage / ReplyMessageRequest（pydantic）を
+作って検証・変換せず、ReplyClient はこの JSON から本文を組み立てて送る。
+確認文（入力内容を含む）や「確認」の月次の一覧などの可変の文は、返信のたびに変換する。
+"""
+import json
+
+
+DEFAULT_LOCALE = "ja"
+
+# 書式（{name} など）を含み、render() で作るもの
+DYNAMIC_KEYS = frozenset({
+    "attendance.confirm", "vacation.confirm",
+    "monthly.title", "monthly.day", "monthly.total", "monthly.duration",
+})
+# 「確認」の一覧（monthly_report.format_month）の部品。単独では返信しないため変換しておかない
+PART_KEYS = frozenset({"monthly.no_attendance", "monthly.vacation"})
+
+TEMPLATES = {
+    "ja": {
+        "help": "勤怠または休暇情報を入力する場合は、「勤怠」または「休暇」というメッセージを書いてください。",
+        "expired": "入力セッションの有効期限が切れました。最初から「勤怠」または「休暇」と入力してください。",
+        "throttled": "メッセージが多すぎます。しばらく待ってからもう一度送信してください。",
+        "monthly_failed": "登録内容の取得に失敗しました。もう一度お試しください。",
+        "process_failed": "メッセージを処理できませんでした。しばらくしてからもう一度送信してください。",
+
+        "monthly.title": "{year}年{month}月の登録内容:",
+        "monthly.day": "{day} {start}-{end} (休憩{rest}分) {worked}",
+        "monthly.no_attendance": "勤怠の登録はありません。",
+        "monthly.vacation": "休暇:",
+        "monthly.total": "合計: {days}日 {worked}",
+        "monthly.duration": "{hours}時間{minutes:02}分",
+
+        "attendance.entry": "勤怠入力モードに入りました。名前を入力してください:",
+        "attendance.name": "名前を入力してください:",
+        "attendance.work_day":
+            "勤務日を入力してください (YYYY-MM-DD) 例えば2024-01-01でも20240101でも認識されます:",
+        "attendance.work_day.invalid":
+            "無効な勤務日です。もう一度入力してください (YYYY-MM-DD) 例 2024-01-01 or 20240101:",
+        "attendance.work_start":
+            "出勤時間を入力してください (HH:MM) 例えば8:00でも8でも800でも08:00と認識されます:",
+        "attendance.work_start.invalid":
+            "無効な出勤時間です。もう一度入力してください (HH:MM) 例 8:00 or 800:",
+        "attendance.work_end":
+            "退勤時間を入力してください (HH:MM) 例えば17:00でも17でも1700でも17:00と認識されます :",
+        "attendance.work_end.invalid":
+            "無効な退勤時間です。もう一度入力してください (HH:MM) 例 17:00 or 1700:",
+        "attendance.break_start":
+            "休憩開始時間を入力してください (HH:MM) 例えば12:00でも12でも1200でも12:00と認識されます:",
+        "attendance.break_start.invalid":
+            "無効な休憩開始時間です。もう一度入力してください (HH:MM) 例 12:00 or 1200:",
+        "attendance.break_end":
+            "休憩終了時間を入力してください (HH:MM) 例えば13:00でも13でも1300でも13:00と認識されます:",
+        "attendance.break_end.invalid":
+            "無効な休憩終了時間です。もう一度入力してください (HH:MM) 例 13:00 or 1300:",
+        "attendance.work_summary": "業務日報を入力してください 例 アプリ開発:",
+        "attendance.confirm": (
+            "確認してください:\n"
+            "名前: {name}\n"
+            "勤務日: {work_day}\n"
+            "出勤時間: {work_start}\n"
+            "退勤時間: {work_end}\n"
+            "休憩開始時間: {break_start}\n"
+            "休憩終了時間: {break_end}\n"
+            "業務日報: {work_summary}\n"
+            "勤怠打刻デバイス: {device}\n"
+            "この内容でよろしいですか? [Y or N] 例えば、yでもYでもはいでもYと認識されます"
+        ),
+        "attendance.retry": "もう一度最初から入力してください。名前を入力してください:",
+        "attendance.invalid_answer": "無効な入力です。「Y」または「N」を入力してください。",
+        "attendance.saved": "勤怠情報が保存されました。",
+        "attendance.save_failed": "勤怠情報の保存に失敗しました。もう一度お試しください。",
+
+        "vacation.entry": "休暇入力モードに入りました。休暇日を入力してください (YYYY-MM-DD):",
+        "vacation.vacation_date": "休暇日を入力してください (YYYY-MM-DD):",
+        "vacation.vacation_date.invalid":
+            "無効な休暇日です。もう一度入力してください (YYYY-MM-DD) 例 2024-01-01 or 20240101:",
+        "vacation.vacation_type": "休暇の種類を選択してください (全日休, 午前休, 午後休):",
+        "vacation.confirm": (
+            "確認してください:\n休暇日: {vacation_date}\n休暇種類: {vacation_type}\n"
+            "この内容でよろしいですか? (y/n) 例 y"
+        ),
+        "vacation.retry": "もう一度最初から入力してください。休暇日を入力してください (YYYY-MM-DD):",
+        "vacation.saved": "休暇情報が保存されました。",
+        "vacation.save_failed": "休暇情報の保存に失敗しました。もう一度お試しください。",
+    },
+    "en": {
+        # コマンド（勤怠・休暇・確認）は言語によらず同じため、日本語のまま案内する
+        "help": 'To enter attendance or vacation, send the message "勤怠" (attendance) or "休暇" (vacation).',
+        "expired": 'Your input session has expired. Start again by sending "勤怠" or "休暇".',
+        "throttled": "Too many messages. Please wait a moment and try again.",
+        "monthly_failed": "Could not load your records. Please try again.",
+        "process_failed": "Your message could not be processed. Please send it again in a moment.",
+
+        "monthly.title": "Your records for {year}-{month:02}:",
+        "monthly.day": "{day} {start}-{end} (break {rest} min) {worked}",
+        "monthly.no_attendance": "No attendance recorded.",
+        "monthly.vacation": "Vacation:",
+        "monthly.total": "Total: {days} days {worked}",
+        "monthly.duration": "{hours}h {minutes:02}m",
+
+        "attendance.entry": "Attendance mode. Enter your name:",
+        "attendance.name": "Enter your name:",
+        "attendance.work_day": "Enter the work day (YYYY-MM-DD), e.g. 2024-01-01 or 20240101:",
+        "attendance.work_day.invalid":
+            "Invalid work day. Enter it again (YYYY-MM-DD), e.g. 2024-01-01 or 20240101:",
+        "attendance.work_start": "Enter the start time (HH:MM), e.g. 8:00, 8 or 800 for 08:00:",
+        "attendance.work_start.invalid": "Invalid start time. Enter it again (HH:MM), e.g. 8:00 or 800:",
+        "attendance.work_end": "Enter the end time (HH:MM), e.g. 17:00, 17 or 1700 for 17:00:",
+        "attendance.work_end.invalid": "Invalid end time. Enter it again (HH:MM), e.g. 17:00 or 1700:",
+        "attendance.break_start": "Enter the break start time (HH:MM), e.g. 12:00, 12 or 1200:",
+        "attendance.break_start.invalid":
+            "Invalid break start time. Enter it again (HH:MM), e.g. 12:00 or 1200:",
+        "attendance.break_end": "Enter the break end time (HH:MM), e.g. 13:00, 13 or 1300:",
+        "attendance.break_end.invalid":
+            "Invalid break end time. Enter it again (HH:MM), e.g. 13:00 or 1300:",
+        "attendance.work_summary": "Enter a work summary, e.g. app development:",
+        "attendance.confirm": (
+            "Please check:\n"
+            "Name: {name}\n"
+            "Work day: {work_day}\n"
+            "Start: {work_start}\n"
+            "End: {work_end}\n"
+            "Break start: {break_start}\n"
+            "Break end: {break_end}\n"
+            "Summary: {work_summary}\n"
+            "Device: {device}\n"
+            "Is this correct? [Y or N]"
+        ),
+        "attendance.retry": "Let's start over. Enter your name:",
+        "attendance.invalid_answer": 'Invalid answer. Enter "Y" or "N".',
+        "attendance.saved": "Attendance saved.",
+        "attendance.save_failed": "Could not save the attendance. Please try again.",
+
+        "vacation.entry": "Vacation mode. Enter the vacation date (YYYY-MM-DD):",
+        "vacation.vacation_date": "Enter the vacation date (YYYY-MM-DD):",
+        "vacation.vacation_date.invalid":
+            "Invalid vacation date. Enter it again (YYYY-MM-DD), e.g. 2024-01-01 or 20240101:",
+        # 種類は保存する値（集計でも使う）のため日本語のまま選んでもらう
+        "vacation.vacation_type":
+            "Choose the vacation type: 全日休 (full day), 午前休 (morning) or 午後休 (afternoon):",
+        "vacation.confirm": (
+            "Please check:\nVacation date: {vacation_date}\nVacation type: {vacation_type}\n"
+            "Is this correct? (y/n)"
+        ),
+        "vacation.retry": "Let's start over. Enter the vacation date (YYYY-MM-DD):",
+        "vacation.saved": "Vacation saved.",
+        "vacation.save_failed": "Could not save the vacation. Please try again.",
+    },
+}
+
+
+class PreparedReply:
+    """
+    返信する messages 配列。json は LINE API の本文にそのまま埋め込める JSON（bytes）。
+    """
+
+    __slots__ = ("texts", "json")
+
+    def __init__(self, *texts):
+        self.texts = texts
+        self.json = json.dumps(
+            [{"type": "text", "text": text} for text in texts],
+            ensure_ascii=False, separators=(",", ":")
+        ).encode("utf-8")
+
+    def models(self):
+        """
+        line-bot-sdk の TextMessage の一覧（JSONを直接送れない場合に使う）。
+        """
+        from linebot.v3.messaging import TextMessage
+
+        return [TextMessage(text=text) for text in self.texts]
+
+
+class ReplyTemplates:
+    """
+    1つの言語の返信文。足りないキーは DEFAULT_LOCALE の文を使う。
+    prepare() は固定の文なら作成時に変換しておいた PreparedReply を返し、それ以外はその場で変換する。
+    """
+
+    def __init__(self, locale=DEFAULT_LOCALE, templates=TEMPLATES):
+        if locale not in templates:
+            raise ValueError(f"unknown locale: {locale}")
+        self.locale = locale
+        self._texts = {**templates[DEFAULT_LOCALE], **templates[locale]}
+        # 返信文 -> PreparedReply（同じ文字列オブジェクトはハッシュが再計算されない）
+        self._prepared = {
+            text: PreparedReply(text) for key, text in self._texts.items()
+            if key not in DYNAMIC_KEYS and key not in PART_KEYS
+        }
+        # メトリクス（ロックを取らないため、並行時は概数）
+        self._static = 0
+        self._dynamic = 0
+
+    def text(self, key):
+        return self._texts[key]
+
+    def render(self, key, **values):
+        return self._texts[key].format(**values)
+
+    def prepare(self, text):
+        prepared = self._prepared.get(text)
+        if prepared is None:
+            self._dynamic += 1
+            return PreparedReply(text)
+        self._static += 1
+        return prepared
+
+    def stats(self):
+        return {
+            "templates": len(self._prepared),
+            "static_replies": self._static,
+            "dynamic_replies": self._dynamic,
+        }
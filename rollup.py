@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+ユーザごとの日別・月別の勤務時間の集計（worked_daily / worked_monthly）。
+
+勤怠・休暇を保存するトランザクションの中で、保存した (line_id, 日) の日別の行を元データから
+計算し直し、その月の月別の行を日別の行から計算し直す（refresh）。同じ内容の再送で行が上書き
+されても集計はずれない。チームの集計表示は worked_monthly をユーザ数分読むだけで済む。
+
+使い方:
+    python rollup.py rebuild --from 2023-04 --to 2024-03  # 過去分の作り直し（月ごとにコミット）
+    python rollup.py check --from 2024-01 --to 2024-03    # 元データと照合（不一致があれば終了コード 1）
+    python rollup.py check --from 2024-01 --repair        # 不一致のあった月を作り直す
+    python rollup.py show --month 2024-03                 # 月別の集計を表示
+"""
+import argparse
+import sys
+from datetime import date, timedelta
+
+from dotenv import load_dotenv
+
+from db_pool import connect_from_env
+from export_timesheet import iter_rows
+from monthly_report import month_range
+
+
+# 集計の対象と、日付の列
+DAY_COLUMNS = {"attendance": "work_day", "vacation": "vacation_date"}
+
+# 休暇の種類ごとの日数（それ以外は1日）
+VACATION_DAYS = {"午前休": 0.5, "午後休": 0.5}
+
+
+def _minutes_sql(column):
+    return f"(extract(hour FROM {column}) * 60 + extract(minute FROM {column}))::int"
+
+
+def _span_sql(start, end):
+    # export_timesheet._span と同じく、日付をまたぐ場合は翌日として数える
+    return f"mod({_minutes_sql(end)} - {_minutes_sql(start)} + 1440, 1440)"
+
+
+_VACATION_DAYS_SQL = (
+    "CASE vacation_type "
+    + " ".join(f"WHEN '{kind}' THEN {days}" for kind, days in VACATION_DAYS.items())
+    + " ELSE 1 END"
+)
+
+# 勤怠1行ごとの (勤務時間, 休憩時間)
+_SHIFT_SQL = (
+    f"{_span_sql('work_start', 'work_end')} - coalesce({_span_sql('break_start', 'break_end')}, 0) AS worked, "
+    f"coalesce({_span_sql('break_start', 'break_end')}, 0) AS rest"
+)
+
+_DAILY_UPDATE = (
+    "ON CONFLICT (line_id, day) DO UPDATE SET shifts = EXCLUDED.shifts, "
+    "worked_minutes = EXCLUDED.worked_minutes, break_minutes = EXCLUDED.break_minutes, "
+    "vacation_days = EXCLUDED.vacation_days, updated_at = now()"
+)
+_MONTHLY_UPDATE = (
+    "ON CONFLICT (line_id, month) DO UPDATE SET work_days = EXCLUDED.work_days, "
+    "shifts = EXCLUDED.shifts, worked_minutes = EXCLUDED.worked_minutes, "
+    "break_minutes = EXCLUDED.break_minutes, vacation_days = EXCLUDED.vacation_days, updated_at = now()"
+)
+_MONTHLY_COLUMNS = (
+    "count(*) FILTER (WHERE d.shifts > 0), coalesce(sum(d.shifts), 0), "
+    "coalesce(sum(d.worked_minutes), 0), coalesce(sum(d.break_minutes), 0), "
+    "coalesce(sum(d.vacation_days), 0)"
+)
+
+# refresh の各文。引数は (line_id の配列,) または (line_id の配列, 日付の配列)
+# 同じユーザの集計を並行して計算し直さないよう、ユーザ単位のロックを順番に取る
+LOCK_SQL = (
+    "SELECT count(pg_advisory_xact_lock(hashtext('worked_rollup'), h)) "
+    "FROM (SELECT DISTINCT hashtext(x) AS h FROM unnest(%s::text[]) AS x ORDER BY h) AS locks"
+)
+DAILY_SQL = (
+    "INSERT INTO worked_daily "
+    "(line_id, day, shifts, worked_minutes, break_minutes, vacation_days) "
+    "SELECT k.line_id, k.day, a.shifts, coalesce(a.worked, 0), coalesce(a.rest, 0), coalesce(v.days, 0) "
+    "FROM (SELECT DISTINCT * FROM unnest(%s::text[], %s::date[]) AS u(line_id, day)) AS k "
+    "CROSS JOIN LATERAL (SELECT count(*) AS shifts, sum(worked) AS worked, sum(rest) AS rest "
+    f"FROM (SELECT {_SHIFT_SQL} FROM attendance "
+    "WHERE line_id = k.line_id AND work_day = k.day) AS s) AS a "
+    f"CROSS JOIN LATERAL (SELECT sum({_VACATION_DAYS_SQL}) AS days FROM vacation "
+    "WHERE line_id = k.line_id AND vacation_date = k.day) AS v "
+    + _DAILY_UPDATE
+)
+MONTHLY_SQL = (
+    "INSERT INTO worked_monthly "
+    "(line_id, month, work_days, shifts, worked_minutes, break_minutes, vacation_days) "
+    f"SELECT k.line_id, k.month, {_MONTHLY_COLUMNS} "
+    "FROM (SELECT DISTINCT line_id, date_trunc('month', day)::date AS month "
+    "FROM unnest(%s::text[], %s::date[]) AS u(line_id, day)) AS k "
+    "LEFT JOIN worked_daily AS d ON d.line_id = k.line_id "
+    "AND d.day >= k.month AND d.day < k.month + interval '1 month' "
+    "GROUP BY k.line_id, k.month "
+    + _MONTHLY_UPDATE
+)
+
+# 期間 [%s, %s) の作り直し
+REBUILD_SQL = (
+    ("LOCK TABLE worked_daily, worked_monthly IN EXCLUSIVE MODE", 0),
+    ("DELETE FROM worked_daily WHERE day >= %s AND day < %s", 1),
+    (
+        "INSERT INTO worked_daily "
+        "(line_id, day, shifts, worked_minutes, break_minutes, vacation_days) "
+        "SELECT line_id, day, sum(shifts), sum(worked), sum(rest), sum(days) FROM ("
+        f"SELECT line_id, work_day AS day, 1 AS shifts, {_SHIFT_SQL}, 0 AS days FROM attendance "
+        "WHERE work_day >= %s AND work_day < %s "
+        "UNION ALL "
+        f"SELECT line_id, vacation_date, 0, 0, 0, {_VACATION_DAYS_SQL} FROM vacation "
+        "WHERE vacation_date >= %s AND vacation_date < %s"
+        ") AS r GROUP BY line_id, day",
+        2
+    ),
+    ("DELETE FROM worked_monthly WHERE month >= %s AND month < %s", 1),
+    (
+        "INSERT INTO worked_monthly "
+        "(line_id, month, work_days, shifts, worked_minutes, break_minutes, vacation_days) "
+        f"SELECT d.line_id, date_trunc('month', d.day)::date, {_MONTHLY_COLUMNS} "
+        "FROM worked_daily AS d WHERE d.day >= %s AND d.day < %s GROUP BY 1, 2",
+        1
+    ),
+)
+
+MONTH_SQL = (
+    "SELECT line_id, work_days, shifts, worked_minutes, break_minutes, vacation_days "
+    "FROM worked_monthly WHERE month = %s ORDER BY line_id"
+)
+
+
+def keys_of(table, columns, rows):
+    """
+    保存する行から、集計し直す (line_id, 日付) の集合を返す。集計の対象外のテーブルは空。
+    """
+    day_column = DAY_COLUMNS.get(table)
+    if day_column is None:
+        return set()
+    line_index = columns.index("line_id")
+    day_index = columns.index(day_column)
+    return {(values[line_index], values[day_index]) for values in rows}
+
+
+def refresh_statements(keys):
+    """
+    keys の日別・月別の行を計算し直す (SQL, 引数) の一覧を返す（非同期版でも使う）。
+    """
+    if not keys:
+        return []
+    line_ids, days = (list(column) for column in zip(*sorted(keys, key=lambda k: (k[0], str(k[1])))))
+    return [
+        (LOCK_SQL, (line_ids,)),
+        (DAILY_SQL, (line_ids, days)),
+        (MONTHLY_SQL, (line_ids, days)),
+    ]
+
+
+def refresh(cur, keys):
+    """
+    保存と同じトランザクションで、keys の日別・月別の行を計算し直す。
+    """
+    for sql, params in refresh_statements(keys):
+        cur.execute(sql, params)
+
+
+def rebuild_range(cur, first, following):
+    """
+    [first, following) の期間（月初の日付）の集計を作り直す。
+    """
+    for sql, repeat in REBUILD_SQL:
+        cur.execute(sql, (first, following) * repeat)
+
+
+def _data_range(conn):
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT min(day), max(day) FROM ("
+            "SELECT min(work_day) AS day FROM attendance UNION ALL SELECT max(work_day) FROM attendance "
+            "UNION ALL SELECT min(vacation_date) FROM vacation UNION ALL SELECT max(vacation_date) FROM vacation"
+            ") AS r"
+        )
+        first, last = cur.fetchone()
+    conn.commit()
+    return first, last
+
+
+def months(first, last):
+    """
+    first から last までの各月の月初の日付。
+    """
+    month = date(first.year, first.month, 1)
+    while month <= last:
+        yield month
+        month = month_range(f"{month:%Y-%m}")[1]
+
+
+def rebuild(conn, first, last, out=sys.stdout):
+    """
+    月ごとに1トランザクションで作り直す。
+    """
+    for month in months(first, last):
+        following = month_range(f"{month:%Y-%m}")[1]
+        with conn.cursor() as cur:
+            rebuild_range(cur, month, following)
+        conn.commit()
+        print(f"rebuilt {month:%Y-%m}", file=out)
+
+
+def _expected(conn, month):
+    # 元データから、集計の SQL を使わずに日別の値を計算する
+    following = month_range(f"{month:%Y-%m}")[1]
+    daily = {}
+    for row in iter_rows(conn, date_from=month, date_to=following - timedelta(days=1)):
+        key = (row["line_id"], date.fromisoformat(row["work_day"]))
+        entry = daily.setdefault(key, [0, 0, 0, 0.0])
+        entry[0] += 1
+        entry[1] += row["worked_minutes"] or 0
+        entry[2] += row["break_minutes"] or 0
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT line_id, vacation_date, vacation_type FROM vacation "
+            "WHERE vacation_date >= %s AND vacation_date < %s",
+            (month, following)
+        )
+        for line_id, day, kind in cur.fetchall():
+            entry = daily.setdefault((line_id, day), [0, 0, 0, 0.0])
+            entry[3] += VACATION_DAYS.get(kind, 1.0)
+    conn.commit()
+    return daily
+
+
+def check_month(conn, month):
+    """
+    1か月分の集計を元データと照合し、不一致の説明の一覧を返す。
+    """
+    following = month_range(f"{month:%Y-%m}")[1]
+    expected = _expected(conn, month)
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT line_id, day, shifts, worked_minutes, break_minutes, vacation_days "
+            "FROM worked_daily WHERE day >= %s AND day < %s",
+            (month, following)
+        )
+        actual = {(r[0], r[1]): [r[2], r[3], r[4], float(r[5])] for r in cur.fetchall()}
+        cur.execute(MONTH_SQL, (month,))
+        monthly = {r[0]: [r[1], r[2], r[3], r[4], float(r[5])] for r in cur.fetchall()}
+    conn.commit()
+
+    problems = []
+    zero = [0, 0, 0, 0.0]
+    for key in sorted(set(expected) | set(actual), key=lambda k: (k[0], k[1])):
+        want = expected.get(key, zero)
+        have = actual.get(key, zero)
+        if want != have:
+            problems.append(f"daily {key[0]} {key[1]}: expected {want}, found {have}")
+
+    totals = {}
+    for (line_id, _), (shifts, worked, rest, days) in expected.items():
+        total = totals.setdefault(line_id, [0, 0, 0, 0, 0.0])
+        total[0] += 1 if shifts else 0
+        total[1] += shifts
+        total[2] += worked
+        total[3] += rest
+        total[4] += days
+    for line_id in sorted(set(totals) | set(monthly)):
+        want = totals.get(line_id, [0, 0, 0, 0, 0.0])
+        have = monthly.get(line_id, [0, 0, 0, 0, 0.0])
+        if want != have:
+            problems.append(f"monthly {line_id} {month:%Y-%m}: expected {want}, found {have}")
+    return problems
+
+
+def _month_arg(value):
+    try:
+        return date(int(value[:4]), int(value[5:7]), 1)
+    except (ValueError, IndexError):
+        raise argparse.ArgumentTypeError(f"expected YYYY-MM: {value}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the worked-hours rollup tables")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name in ("rebuild", "check"):
+        command = sub.add_parser(name)
+        command.add_argument("--from", dest="first", type=_month_arg, help="first month (YYYY-MM)")
+        command.add_argument("--to", dest="last", type=_month_arg, help="last month (YYYY-MM)")
+        if name == "check":
+            command.add_argument("--repair", action="store_true", help="rebuild months that differ")
+            command.add_argument("--limit", type=int, default=20, help="differences to print per month")
+    show = sub.add_parser("show")
+    show.add_argument("--month", type=_month_arg, default=date.today().replace(day=1))
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    conn = connect_from_env()
+    try:
+        if args.command == "show":
+            with conn.cursor() as cur:
+                cur.execute(MONTH_SQL, (args.month,))
+                print("line_id\twork_days\tshifts\tworked_minutes\tbreak_minutes\tvacation_days")
+                for row in cur.fetchall():
+                    print("\t".join(str(value) for value in row))
+            conn.commit()
+            return
+
+        first, last = args.first, args.last
+        if first is None or last is None:
+            data_first, data_last = _data_range(conn)
+            if data_first is None:
+                print("no attendance or vacation rows", file=sys.stderr)
+                return
+            first = first or data_first
+            last = last or data_last
+        if args.command == "rebuild":
+            rebuild(conn, first, last)
+            return
+
+        failed = []
+        for month in months(first, last):
+            problems = check_month(conn, month)
+            for problem in problems[:args.limit]:
+                print(problem)
+            if len(problems) > args.limit:
+                print(f"... {len(problems) - args.limit} more in {month:%Y-%m}")
+            print(f"{month:%Y-%m}: {'OK' if not problems else f'{len(problems)} differences'}",
+                  file=sys.stderr)
+            if problems:
+                failed.append(month)
+        if failed and args.repair:
+            for month in failed:
+                rebuild(conn, month, month)
+        elif failed:
+            sys.exit(1)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
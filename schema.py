@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+"""
+データベースのテーブル定義とマイグレーション。
+
+attendance は勤務日(work_day)で月ごとにパーティション分割し、主キー (line_id, work_day, work_start)
+で同じ入力の二重登録を防ぐ（INSERT は upsert になる）。主キーの索引は line_id と work_day による
+検索にも使われる。
+worked_daily / worked_monthly は勤務時間の日別・月別の集計（rollup.py が保存と同時に更新する）。
+既存の文字列型のテーブルがある場合は *_legacy に名前を変えて残し、型変換できた行だけを移す。
+
+使い方:
+    python schema.py migrate              # 未適用のマイグレーションを適用
+    python schema.py status               # 適用状況を表示
+    python schema.py partitions --ahead 3 # 3か月先までのパーティションを作成（月1回実行）
+"""
+import argparse
+import sys
+from datetime import date
+
+from dotenv import load_dotenv
+
+from db_pool import connect_from_env
+from rollup import rebuild_range
+
+
+# テーブルごとの列と型（created_at は自動で付く）
+TABLES = {
+    "attendance": (
+        ("name", "TEXT NOT NULL"),
+        ("work_day", "DATE NOT NULL"),
+        ("work_start", "TIME NOT NULL"),
+        ("work_end", "TIME NOT NULL"),
+        ("break_start", "TIME"),
+        ("break_end", "TIME"),
+        ("work_summary", "TEXT"),
+        ("device", "TEXT"),
+        ("line_id", "TEXT NOT NULL"),
+    ),
+    "vacation": (
+        ("vacation_date", "DATE NOT NULL"),
+        ("vacation_type", "TEXT NOT NULL"),
+        ("line_id", "TEXT NOT NULL"),
+    ),
+}
+
+# 同じ内容の再送を1件として扱うための主キー
+PRIMARY_KEYS = {
+    "attendance": ("line_id", "work_day", "work_start"),
+    "vacation": ("line_id", "vacation_date", "vacation_type"),
+}
+
+
+def column_type(table, column):
+    """
+    列の型名（DATE, TIME, TEXT など）を返す。
+    """
+    return dict(TABLES[table])[column].split()[0]
+
+
+def conflict_clause(table, columns):
+    """
+    主キーが重複した場合に、キー以外の列を新しい値で上書きする ON CONFLICT 句を返す。
+    """
+    keys = PRIMARY_KEYS.get(table)
+    if not keys:
+        return ""
+    updates = [c for c in columns if c not in keys]
+    if not updates:
+        return f" ON CONFLICT ({', '.join(keys)}) DO NOTHING"
+    assignments = ", ".join(f"{c} = EXCLUDED.{c}" for c in updates)
+    return f" ON CONFLICT ({', '.join(keys)}) DO UPDATE SET {assignments}"
+
+
+def _columns_ddl(table):
+    return ",\n    ".join(f"{name} {ddl}" for name, ddl in TABLES[table])
+
+
+def _add_months(day, months):
+    month = day.month - 1 + months
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+def _table_kind(cur, table):
+    # None: 存在しない / "p": パーティション親 / "r": 通常のテーブル
+    cur.execute(
+        "SELECT c.relkind FROM pg_class c "
+        "WHERE c.oid = to_regclass(%s)",
+        (table,)
+    )
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def _create_safe_casts(cur):
+    # 変換できない値は NULL にする（旧テーブルには検証されていない値が残っている）
+    cur.execute(
+        "CREATE OR REPLACE FUNCTION pg_temp.try_date(t TEXT) RETURNS DATE AS $$ "
+        "BEGIN RETURN t::DATE; EXCEPTION WHEN others THEN RETURN NULL; END "
+        "$$ LANGUAGE plpgsql IMMUTABLE"
+    )
+    cur.execute(
+        "CREATE OR REPLACE FUNCTION pg_temp.try_time(t TEXT) RETURNS TIME AS $$ "
+        "BEGIN RETURN t::TIME; EXCEPTION WHEN others THEN RETURN NULL; END "
+        "$$ LANGUAGE plpgsql IMMUTABLE"
+    )
+
+
+def _rename_legacy(cur, table):
+    kind = _table_kind(cur, table)
+    if kind is None or kind == "p":
+        return False
+    cur.execute(f"ALTER TABLE {table} RENAME TO {table}_legacy")
+    return True
+
+
+def _copy_legacy(cur, table, casts, out):
+    columns = [name for name, _ in TABLES[table]]
+    select = ", ".join(casts.get(c, c) for c in columns)
+    required = " AND ".join(f"{casts.get(c, c)} IS NOT NULL" for c, ddl in TABLES[table] if "NOT NULL" in ddl)
+    cur.execute(
+        f"INSERT INTO {table} ({', '.join(columns)}) "
+        f"SELECT {select} FROM {table}_legacy WHERE {required}"
+        f" ON CONFLICT DO NOTHING"
+    )
+    moved = cur.rowcount
+    cur.execute(f"SELECT count(*) FROM {table}_legacy")
+    total = cur.fetchone()[0]
+    print(f"{table}: moved {moved} of {total} legacy rows "
+          f"(the rest stay in {table}_legacy)", file=out)
+
+
+def _migrate_state_tables(cur, out):
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS conversation_state ("
+        "line_id TEXT PRIMARY KEY, "
+        "state JSONB NOT NULL, "
+        "expires_at TIMESTAMPTZ NOT NULL)"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS conversation_state_expires_idx "
+        "ON conversation_state (expires_at)"
+    )
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS import_checkpoint ("
+        "source TEXT PRIMARY KEY, "
+        "rows_done BIGINT NOT NULL, "
+        "updated_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+    )
+
+
+def _migrate_attendance(cur, out):
+    legacy = _rename_legacy(cur, "attendance")
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS attendance (\n"
+        f"    {_columns_ddl('attendance')},\n"
+        "    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),\n"
+        f"    PRIMARY KEY ({', '.join(PRIMARY_KEYS['attendance'])})\n"
+        ") PARTITION BY RANGE (work_day)"
+    )
+    cur.execute("CREATE TABLE IF NOT EXISTS attendance_default PARTITION OF attendance DEFAULT")
+    first = date.today().replace(day=1)
+    if legacy:
+        _create_safe_casts(cur)
+        cur.execute("SELECT min(pg_temp.try_date(work_day::TEXT)) FROM attendance_legacy")
+        oldest = cur.fetchone()[0]
+        if oldest is not None and oldest < first:
+            first = oldest.replace(day=1)
+    ensure_partitions(cur, first, _add_months(date.today(), 3))
+    if legacy:
+        casts = {"work_day": "pg_temp.try_date(work_day::TEXT)"}
+        for column in ("work_start", "work_end", "break_start", "break_end"):
+            casts[column] = f"pg_temp.try_time({column}::TEXT)"
+        _copy_legacy(cur, "attendance", casts, out)
+
+
+def _migrate_vacation(cur, out):
+    legacy = _rename_legacy(cur, "vacation")
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS vacation (\n"
+        f"    {_columns_ddl('vacation')},\n"
+        "    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),\n"
+        f"    PRIMARY KEY ({', '.join(PRIMARY_KEYS['vacation'])})\n"
+        ")"
+    )
+    if legacy:
+        _create_safe_casts(cur)
+        _copy_legacy(cur, "vacation", {"vacation_date": "pg_temp.try_date(vacation_date::TEXT)"}, out)
+
+
+def _migrate_webhook_event(cur, out):
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS webhook_event ("
+        "event_id TEXT PRIMARY KEY, "
+        "seen_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS webhook_event_seen_at_idx ON webhook_event (seen_at)")
+
+
+def _migrate_rollup(cur, out):
+    # rollup.py が保存のたびに更新する日別・月別の集計。月ごとの一覧は月の索引で読む
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS worked_daily ("
+        "line_id TEXT NOT NULL, "
+        "day DATE NOT NULL, "
+        "shifts INTEGER NOT NULL, "
+        "worked_minutes INTEGER NOT NULL, "
+        "break_minutes INTEGER NOT NULL, "
+        "vacation_days NUMERIC(4, 1) NOT NULL, "
+        "updated_at TIMESTAMPTZ NOT NULL DEFAULT now(), "
+        "PRIMARY KEY (line_id, day))"
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS worked_daily_day_idx ON worked_daily (day)")
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS worked_monthly ("
+        "line_id TEXT NOT NULL, "
+        "month DATE NOT NULL, "
+        "work_days INTEGER NOT NULL, "
+        "shifts INTEGER NOT NULL, "
+        "worked_minutes BIGINT NOT NULL, "
+        "break_minutes BIGINT NOT NULL, "
+        "vacation_days NUMERIC(6, 1) NOT NULL, "
+        "updated_at TIMESTAMPTZ NOT NULL DEFAULT now(), "
+        "PRIMARY KEY (line_id, month))"
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS worked_monthly_month_idx ON worked_monthly (month)")
+    # 既存の勤怠・休暇から作成する
+    rebuild_range(cur, date(1, 1, 1), date(9999, 12, 1))
+    cur.execute("SELECT count(*) FROM worked_monthly")
+    print(f"  worked_monthly: {cur.fetchone()[0]} rows", file=out)
+
+
+# (バージョン, 説明, 適用する関数)。適用済みのものは変更せず、末尾に追加していく
+MIGRATIONS = (
+    (1, "conversation_state and import_checkpoint", _migrate_state_tables),
+    (2, "typed, partitioned attendance with (line_id, work_day, work_start) key", _migrate_attendance),
+    (3, "typed vacation with (line_id, vacation_date, vacation_type) key", _migrate_vacation),
+    (4, "webhook_event for redelivery detection", _migrate_webhook_event),
+    (5, "worked_daily and worked_monthly rollups", _migrate_rollup),
+)
+
+
+def _ensure_migrations_table(cur):
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version INTEGER PRIMARY KEY, "
+        "description TEXT NOT NULL, "
+        "applied_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+    )
+
+
+def applied_versions(conn):
+    with conn.cursor() as cur:
+        _ensure_migrations_table(cur)
+        cur.execute("SELECT version FROM schema_migrations")
+        versions = {row[0] for row in cur.fetchall()}
+    conn.commit()
+    return versions
+
+
+def pending_migrations(conn):
+    """
+    未適用のマイグレーションの (バージョン, 説明) の一覧。起動時の確認に使うため、
+    schema_migrations が無くても作成しない（全て未適用として扱う）。
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('schema_migrations') IS NOT NULL")
+        applied = set()
+        if cur.fetchone()[0]:
+            cur.execute("SELECT version FROM schema_migrations")
+            applied = {row[0] for row in cur.fetchall()}
+    conn.commit()
+    return [(version, description) for version, description, _ in MIGRATIONS if version not in applied]
+
+
+def migrate(conn, out=sys.stdout):
+    """
+    未適用のマイグレーションを1つずつ、それぞれ1トランザクションで適用する。
+    """
+    applied = applied_versions(conn)
+    for version, description, func in MIGRATIONS:
+        if version in applied:
+            continue
+        with conn.cursor() as cur:
+            # 複数プロセスから同時に実行された場合に備えて排他する
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext('schema_migrations'))")
+            cur.execute("SELECT 1 FROM schema_migrations WHERE version = %s", (version,))
+            if cur.fetchone() is None:
+                func(cur, out)
+                cur.execute(
+                    "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                    (version, description)
+                )
+                print(f"applied {version}: {description}", file=out)
+        conn.commit()
+
+
+def ensure_partitions(cur, first, last):
+    """
+    first から last の月までの attendance の月別パーティションを作成する。
+    既定パーティションに入っている該当月の行は新しいパーティションへ移す。
+    """
+    month = date(first.year, first.month, 1)
+    while month <= last:
+        following = _add_months(month, 1)
+        name = f"attendance_{month:%Y%m}"
+        if _table_kind(cur, name) is None:
+            cur.execute(f"CREATE TABLE {name} (LIKE attendance INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+            # 移してから ATTACH するまでに、同じ月の行が既定パーティションに保存されないようにする
+            # （保存された行があると ATTACH がパーティションの制約違反で失敗する）
+            cur.execute("LOCK TABLE attendance_default IN SHARE ROW EXCLUSIVE MODE")
+            cur.execute(
+                f"WITH moved AS (DELETE FROM attendance_default "
+                f"WHERE work_day >= %s AND work_day < %s RETURNING *) "
+                f"INSERT INTO {name} SELECT * FROM moved",
+                (month, following)
+            )
+            cur.execute(
+                f"ALTER TABLE attendance ATTACH PARTITION {name} "
+                f"FOR VALUES FROM (%s) TO (%s)",
+                (month, following)
+            )
+        month = following
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage the attendance / vacation schema")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("migrate")
+    sub.add_parser("status")
+    partitions = sub.add_parser("partitions")
+    partitions.add_argument("--ahead", type=int, default=3, help="months to create ahead of today")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    conn = connect_from_env()
+    try:
+        if args.command == "migrate":
+            migrate(conn)
+        elif args.command == "status":
+            applied = applied_versions(conn)
+            for version, description, _ in MIGRATIONS:
+                mark = "x" if version in applied else " "
+                print(f"[{mark}] {version}: {description}")
+        else:
+            with conn.cursor() as cur:
+                ensure_partitions(cur, date.today(), _add_months(date.today(), args.ahead))
+            conn.commit()
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
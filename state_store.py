@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class SessionState(dict):
+    """
+    session() が返す状態。expired は前回の入力途中の状態が期限切れで破棄されたことを示す。
+    """
+
+    def __init__(self, *args, expired=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.expired = expired
+
+
+def _estimate_size(user_id, state):
+    # 状態1件あたりのおおよそのメモリ使用量（バイト）
+    size = sys.getsizeof(user_id) + sys.getsizeof(state)
+    for key, value in state.items():
+        size += sys.getsizeof(key) + sys.getsizeof(value)
+    return size
+
+
+class StateStore:
+    """
+    ユーザごとの入力状態を保持するストアの共通インターフェース。
+    session() で読み込み・更新・書き戻しを1つの排他区間として行う。
+    """
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+
+    @contextmanager
+    def session(self, user_id, ttl=None):
+        """
+        ユーザの状態(SessionState)を排他的に取り出す。with ブロックが正常終了すると書き戻し、
+        空の dict は削除として扱う。例外時は変更を破棄する。
+        """
+        raise NotImplementedError
+
+    def stats(self):
+        return {}
+
+    def get(self, user_id):
+        with self.session(user_id) as state:
+            return SessionState(state, expired=state.expired)
+
+    def put(self, user_id, state, ttl=None):
+        with self.session(user_id, ttl) as current:
+            current.clear()
+            current.update(state)
+
+    def delete(self, user_id):
+        with self.session(user_id) as state:
+            state.clear()
+
+
+class MemoryStateStore(StateStore):
+    """
+    プロセス内の辞書に状態を保持するストア（ワーカー1つの場合用）。
+    最終アクセスから ttl 秒経過した状態と、max_entries を超えた最も古い状態を破棄する。
+    定期的な削除や件数超過で破棄したユーザは、さらに ttl 秒の間（最大 max_entries 件）覚えておき、
+    次の session() で expired を立てる（入力途中で期限切れになったことを知らせるため）。
+    """
+
+    LOCK_STRIPES = 64
+    SWEEP_INTERVAL = 60
+
+    def __init__(self, ttl=3600, max_entries=10000):
+        super().__init__(ttl)
+        self.max_entries = max_entries
+        # user_id -> (期限, 状態, 推定サイズ)。先頭ほど最近使われていない
+        self._entries = OrderedDict()
+        # user_id -> 破棄した時刻。先頭ほど古い
+        self._tombstones = OrderedDict()
+        self._lock = threading.Lock()
+        self._locks = [threading.Lock() for _ in range(self.LOCK_STRIPES)]
+        self._next_sweep = time.monotonic() + self.SWEEP_INTERVAL
+        self._bytes = 0
+        self._expired_evictions = 0
+        self._capacity_evictions = 0
+
+    def _lock_for(self, user_id):
+        return self._locks[hash(user_id) % self.LOCK_STRIPES]
+
+    def _remove(self, user_id):
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+        return entry
+
+    def _bury(self, user_id, now):
+        self._tombstones.pop(user_id, None)
+        self._tombstones[user_id] = now
+        if len(self._tombstones) > self.max_entries:
+            self._tombstones.popitem(last=False)
+
+    def _sweep(self, now):
+        # 古い順に期限切れを削除する（期限内の状態に当たったら打ち切る）
+        self._next_sweep = now + self.SWEEP_INTERVAL
+        while self._entries:
+            user_id, entry = next(iter(self._entries.items()))
+            if entry[0] > now:
+                break
+            self._remove(user_id)
+            self._bury(user_id, now)
+            self._expired_evictions += 1
+        while self._tombstones:
+            user_id, buried_at = next(iter(self._tombstones.items()))
+            if now - buried_at < self.ttl:
+                break
+            self._tombstones.popitem(last=False)
+
+    @contextmanager
+    def session(self, user_id, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock_for(user_id):
+            now = time.monotonic()
+            expired = False
+            with self._lock:
+                if now >= self._next_sweep:
+                    self._sweep(now)
+                entry = self._entries.get(user_id)
+                if entry is not None and entry[0] <= now:
+                    self._remove(user_id)
+                    self._expired_evictions += 1
+                    entry = None
+                    expired = True
+                buried_at = self._tombstones.pop(user_id, None)
+                if buried_at is not None and entry is None and now - buried_at < self.ttl:
+                    expired = True
+            state = SessionState(entry[1] if entry is not None else {}, expired=expired)
+            yield state
+            with self._lock:
+                self._remove(user_id)
+                if state:
+                    data = dict(state)
+                    size = _estimate_size(user_id, data)
+                    self._entries[user_id] = (time.monotonic() + ttl, data, size)
+                    self._bytes += size
+                    while len(self._entries) > self.max_entries:
+                        evicted_id, evicted = self._entries.popitem(last=False)
+                        self._bytes -= evicted[2]
+                        self._bury(evicted_id, now)
+                        self._capacity_evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "live_sessions": len(self._entries),
+                "max_sessions": self.max_entries,
+                "expired_evictions": self._expired_evictions,
+                "capacity_evictions": self._capacity_evictions,
+                "tombstones": len(self._tombstones),
+                "estimated_bytes": self._bytes,
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class PostgresStateStore(StateStore):
+    """
+    PostgreSQLのテーブルに状態を保持するストア（複数ワーカーで共有する場合用）。
+    ユーザ単位のアドバイザリロックで読み込みから書き戻しまでを排他する。
+    入力途中のまま放置された状態は、PURGE_INTERVAL 秒ごとに session() の後で削除する。
+    期限切れの行はさらに ttl 秒残し、その間に戻ってきたユーザには expired を立てる
+    （MemoryStateStore の破棄したユーザの記録と同じ）。
+    """
+
+    PURGE_INTERVAL = 600
+
+    def __init__(self, pool, ttl=3600, table="conversation_state"):
+        super().__init__(ttl)
+        self.pool = pool
+        self.table = table
+        self._table_ready = False
+        self._purge_lock = threading.Lock()
+        self._next_purge = time.monotonic() + self.PURGE_INTERVAL
+
+    def _ensure_table(self, cur):
+        if self._table_ready:
+            return
+        cur.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.table} ("
+            "line_id TEXT PRIMARY KEY, "
+            "state JSONB NOT NULL, "
+            "expires_at TIMESTAMPTZ NOT NULL)"
+        )
+        self._table_ready = True
+
+    @contextmanager
+    def session(self, user_id, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                self._ensure_table(cur)
+                cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (user_id,))
+                cur.execute(
+                    f"SELECT state, expires_at > now() FROM {self.table} WHERE line_id = %s",
+                    (user_id,)
+                )
+                row = cur.fetchone()
+                if row and row[1]:
+                    state = SessionState(row[0])
+                else:
+                    state = SessionState(expired=row is not None)
+                yield state
+                if state:
+                    cur.execute(
+                        f"INSERT INTO {self.table} (line_id, state, expires_at) "
+                        "VALUES (%s, %s, now() + make_interval(secs => %s)) "
+                        "ON CONFLICT (line_id) DO UPDATE "
+                        "SET state = EXCLUDED.state, expires_at = EXCLUDED.expires_at",
+                        (user_id, json.dumps(state, ensure_ascii=False), ttl)
+                    )
+                else:
+                    cur.execute(f"DELETE FROM {self.table} WHERE line_id = %s", (user_id,))
+            conn.commit()
+        # 接続を返してから行う（同時に2本の接続を使わない）
+        self._maybe_purge()
+
+    def _maybe_purge(self):
+        now = time.monotonic()
+        if now < self._next_purge or not self._purge_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_purge = now + self.PURGE_INTERVAL
+            self.purge_expired()
+        finally:
+            self._purge_lock.release()
+
+    def purge_expired(self):
+        """
+        期限切れから ttl 秒以上経った状態を削除し、削除件数を返す。
+        """
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                self._ensure_table(cur)
+                cur.execute(
+                    f"DELETE FROM {self.table} WHERE expires_at <= now() - make_interval(secs => %s)",
+                    (self.ttl,)
+                )
+                deleted = cur.rowcount
+            conn.commit()
+        return deleted
+
+    def stats(self):
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                self._ensure_table(cur)
+                cur.execute(f"SELECT count(*) FROM {self.table} WHERE expires_at > now()")
+                live = cur.fetchone()[0]
+            conn.commit()
+        return {"live_sessions": live}
+
+
+def create_state_store(kind, pool=None, ttl=3600, max_entries=10000):
+    """
+    設定値からストアを作成する。kind は "memory" または "postgres"。
+    """
+    if kind == "memory":
+        return MemoryStateStore(ttl=ttl, max_entries=max_entries)
+    if kind == "postgres":
+        if pool is None:
+            raise ValueError("postgres state store requires a connection pool")
+        return PostgresStateStore(pool, ttl=ttl)
+    raise ValueError(f"unknown state store: {kind}")
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# 日付・時刻入力のバリデーション
+# 正規表現や strptime を使わず、1文字ずつ読んで数値に変換する（全角数字にも対応）
+
+_DAYS_IN_MONTH = (0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+# validate_date の結果のキャッシュ（上限に達したら空にする）
+# 日付として長すぎる入力は覚えない（1通5000文字までのメッセージでメモリを使わせない）
+_DATE_CACHE = {}
+_DATE_CACHE_SIZE = 4096
+_DATE_CACHE_MAX_LENGTH = len("2024-01-01")
+
+# 正規化後の文字列は毎回作らず、作成済みのものを返す
+_TIME_TEXT = tuple(f"{h:02}:{m:02}" for h in range(24) for m in range(60))
+
+
+# 半角・全角の数字 -> 0-9（関数呼び出しを避けるため dict で引く）
+_DIGITS = {ch: i for i, ch in enumerate("0123456789")}
+_DIGITS.update({ch: i for i, ch in enumerate("０１２３４５６７８９")})
+
+
+def parse_time(input_time):
+    """
+    時刻入力を (時, 分) に変換する。無効な場合は None を返す。
+    受け付ける形式: 8, 08, 8:0, 8:30, 800, 0800（全角数字・全角コロン可）
+    """
+    value = 0
+    count = 0
+    hour = -1
+    for ch in input_time:
+        d = _DIGITS.get(ch)
+        if d is not None:
+            value = value * 10 + d
+            count += 1
+            if count > 4:
+                return None
+        elif (ch == ":" or ch == "：") and hour < 0 and 1 <= count <= 2:
+            hour = value
+            value = 0
+            count = 0
+        else:
+            return None
+
+    if hour >= 0:
+        # H:M / H:MM
+        if not 1 <= count <= 2:
+            return None
+        minute = value
+    elif 1 <= count <= 2:
+        # H / HH
+        hour = value
+        minute = 0
+    elif count >= 3:
+        # HMM / HHMM
+        hour, minute = divmod(value, 100)
+    else:
+        return None
+
+    if hour > 23 or minute > 59:
+        return None
+    return hour, minute
+
+
+def parse_date(input_date):
+    """
+    日付入力を (年, 月, 日) に変換する。無効な場合は None を返す。
+    受け付ける形式: 20240101, 2024-01-01, 2024-1-1（全角数字・全角ハイフン可）
+    """
+    value = 0
+    count = 0
+    index = 0
+    year = month = 0
+    year_digits = month_digits = 0
+    for ch in input_date:
+        d = _DIGITS.get(ch)
+        if d is not None:
+            value = value * 10 + d
+            count += 1
+            if count > 8:
+                return None
+        elif ch == "-" or ch == "－":
+            if index == 0:
+                year, year_digits = value, count
+            elif index == 1:
+                month, month_digits = value, count
+            else:
+                return None
+            index += 1
+            value = 0
+            count = 0
+        else:
+            return None
+
+    if index == 0:
+        # YYYYMMDD
+        if count != 8:
+            return None
+        year, rest = divmod(value, 10000)
+        month, day = divmod(rest, 100)
+    elif index == 2:
+        # YYYY-MM-DD
+        if year_digits != 4 or not 1 <= month_digits <= 2 or not 1 <= count <= 2:
+            return None
+        day = value
+    else:
+        return None
+
+    if year < 1 or not 1 <= month <= 12 or day < 1:
+        return None
+    last = _DAYS_IN_MONTH[month]
+    if month == 2 and year % 4 == 0 and (year % 100 != 0 or year % 400 == 0):
+        last = 29
+    if day > last:
+        return None
+    return year, month, day
+
+
+# バリデーション関数
+def validate_date(input_date):
+    """
+    日付入力を検証し、YYYY-MM-DD形式に変換する。
+    """
+    # 同じ日付が繰り返し入力されるため、結果を覚えておく
+    try:
+        return _DATE_CACHE[input_date]
+    except KeyError:
+        pass
+    parsed = parse_date(input_date)
+    text = None if parsed is None else "%04d-%02d-%02d" % parsed
+    if len(input_date) > _DATE_CACHE_MAX_LENGTH:
+        return text
+    if len(_DATE_CACHE) >= _DATE_CACHE_SIZE:
+        _DATE_CACHE.clear()
+    _DATE_CACHE[input_date] = text
+    return text
+
+
+def validate_time(input_time):
+    """
+    時間入力を検証し、HH:MM形式に変換する。
+    """
+    # よく使われる半角の入力は作成済みの表から引く
+    text = _TIME_LOOKUP.get(input_time)
+    if text is not None:
+        return text
+    parsed = parse_time(input_time)
+    if parsed is None:
+        return None  # 無効な時間
+    return _TIME_TEXT[parsed[0] * 60 + parsed[1]]
+
+
+# 半角で書かれた有効な時刻入力 -> HH:MM の表（4,000件程度）
+_TIME_LOOKUP = {}
+for _h in range(24):
+    for _m in range(60):
+        _text = _TIME_TEXT[_h * 60 + _m]
+        for _key in (f"{_h}:{_m:02}", f"{_h:02}:{_m:02}", f"{_h}{_m:02}", f"{_h:02}{_m:02}"):
+            _TIME_LOOKUP[_key] = _text
+        if _m < 10:
+            _TIME_LOOKUP[f"{_h}:{_m}"] = _text
+            _TIME_LOOKUP[f"{_h:02}:{_m}"] = _text
+    _TIME_LOOKUP[str(_h)] = _TIME_TEXT[_h * 60]
+    _TIME_LOOKUP[f"{_h:02}"] = _TIME_TEXT[_h * 60]
+del _h, _m, _text, _key
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+
+from schema import conflict_clause
+
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """
+    INSERTを溜めておき、件数(max_batch)または待ち時間(max_delay秒)に達したら
+    テーブルごとに複数行INSERTでまとめてコミットする。
+    submit() が返す Future はそのレコードがコミットされた時点で完了する。
+    after_insert(cur, テーブル名, 列名, 値の一覧) を指定すると、INSERTと同じトランザクションで
+    コミット前に呼ぶ（集計の更新など）。
+    """
+
+    def __init__(self, pool, max_batch=100, max_delay=0.05, retries=3, retry_delay=0.2,
+                 after_insert=None):
+        self.pool = pool
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.after_insert = after_insert
+        self._pending = []  # (テーブル名, 列名, 値, Future)
+        self._first_at = None
+        self._cond = threading.Condition()
+        self._stopped = False
+
+        # メトリクス
+        self._batches = 0
+        self._rows = 0
+        self._retried = 0
+        self._failed_rows = 0
+
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def submit(self, table, columns, values):
+        """
+        1行分のINSERTを登録し、コミット完了で結果が True になる Future を返す。
+        """
+        future = Future()
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("write-behind buffer is stopped")
+            if not self._pending:
+                self._first_at = time.monotonic()
+            self._pending.append((table, tuple(columns), tuple(values), future))
+            # 最初の1行でも起こす（空の間は書き込みスレッドが期限なしで待っているため）
+            if len(self._pending) == 1 or len(self._pending) >= self.max_batch:
+                self._cond.notify()
+        return future
+
+    def _take(self):
+        # 件数か待ち時間の条件を満たすまで待ち、溜まっている分を取り出す
+        with self._cond:
+            while True:
+                if self._pending:
+                    if self._stopped or len(self._pending) >= self.max_batch:
+                        break
+                    remaining = self._first_at + self.max_delay - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                elif self._stopped:
+                    return None
+                else:
+                    self._cond.wait()
+            items, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+            self._first_at = time.monotonic() if self._pending else None
+            return items
+
+    def _run(self):
+        while True:
+            items = self._take()
+            if items is None:
+                return
+            groups = {}
+            for table, columns, values, future in items:
+                groups.setdefault((table, columns), []).append((values, future))
+            for (table, columns), rows in groups.items():
+                try:
+                    self._flush(table, columns, rows)
+                except Exception as e:
+                    logger.error(f"Failed to flush {table} batch: {e}")
+                    logger.error(traceback.format_exc())
+                    for _, future in rows:
+                        if not future.done():
+                            future.set_exception(e)
+
+    def _insert_sql(self, table, columns):
+        return f"INSERT INTO {table} ({', '.join(columns)}) VALUES %s" + conflict_clause(table, columns)
+
+    def _flush(self, table, columns, rows):
+        import psycopg2
+        from psycopg2.extras import execute_values
+
+        sql = self._insert_sql(table, columns)
+        for attempt in range(self.retries + 1):
+            try:
+                with self.pool.connection() as conn:
+                    with conn.cursor() as cur:
+                        batch = [values for values, _ in rows]
+                        execute_values(cur, sql, batch, page_size=len(rows))
+                        if self.after_insert is not None:
+                            self.after_insert(cur, table, columns, batch)
+                    conn.commit()
+                break
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                # 接続障害は時間を置いて再試行する
+                if attempt >= self.retries:
+                    raise
+                self._count("_retried")
+                logger.warning(f"Retrying {table} batch after error: {e}")
+                time.sleep(self.retry_delay * (2 ** attempt))
+            except psycopg2.Error as e:
+                # データ不正の行を特定するため1行ずつ入れ直す
+                logger.warning(f"{table} batch rejected, isolating bad rows: {e}")
+                self._flush_one_by_one(table, columns, rows)
+                return
+
+        with self._cond:
+            self._batches += 1
+            self._rows += len(rows)
+        for _, future in rows:
+            future.set_result(True)
+
+    def _flush_one_by_one(self, table, columns, rows):
+        import psycopg2
+        from psycopg2.extras import execute_values
+
+        sql = self._insert_sql(table, columns)
+        written = 0
+        with self.pool.connection() as conn:
+            for values, future in rows:
+                try:
+                    with conn.cursor() as cur:
+                        execute_values(cur, sql, [values])
+                        if self.after_insert is not None:
+                            self.after_insert(cur, table, columns, [values])
+                    conn.commit()
+                except psycopg2.Error as e:
+                    conn.rollback()
+                    self._count("_failed_rows")
+                    logger.error(f"Rejected {table} row {values}: {e}")
+                    future.set_exception(e)
+                else:
+                    written += 1
+                    future.set_result(True)
+        with self._cond:
+            self._batches += 1
+            self._rows += written
+
+    def _count(self, name):
+        with self._cond:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def shutdown(self, timeout=30.0):
+        """
+        新規登録を止め、溜まっている分を書き込んでから終了する。
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "pending": len(self._pending),
+                "batches": self._batches,
+                "rows": self._rows,
+                "avg_batch_size": self._rows / self._batches if self._batches else 0.0,
+                "retries": self._retried,
+                "failed_rows": self._failed_rows,
+            }